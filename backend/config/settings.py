@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",  # Must be at the very top
+    "core.middleware.MetricsMiddleware",  # Early, so it times the rest of the stack
+    "core.middleware.ReplicaStickinessMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",  # Must be after SecurityMiddleware
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -60,6 +62,12 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
+# Per-request timings (db, serialize, total) as a Server-Timing response header
+METRICS_SERVER_TIMING = os.environ.get("METRICS_SERVER_TIMING", str(DEBUG)) == "True"
+
+# When set, /api/metrics/ requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
 # ========================
 # URLS / WSGI
 # ========================
@@ -92,13 +100,135 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
-DATABASES = {
-    "default": dj_database_url.parse(
-        DATABASE_URL,
-        conn_max_age=600,
-        ssl_require=True,
+# Check persistent or pooled connections before each use, so a connection
+# the server dropped is replaced instead of failing the request
+DATABASE_HEALTH_CHECKS = os.environ.get("DATABASE_HEALTH_CHECKS", "True") == "True"
+
+# Share a pool of connections between all threads of a process instead of
+# keeping one persistent connection per thread (PostgreSQL, needs
+# psycopg[pool]). Every database in DATABASES gets its own pool.
+DATABASE_POOL = os.environ.get("DATABASE_POOL", "False") == "True"
+DATABASE_POOL_MIN_SIZE = int(os.environ.get("DATABASE_POOL_MIN_SIZE", "2"))
+DATABASE_POOL_MAX_SIZE = int(os.environ.get("DATABASE_POOL_MAX_SIZE", "10"))
+# Seconds a request waits for a free connection before failing
+DATABASE_POOL_TIMEOUT = float(os.environ.get("DATABASE_POOL_TIMEOUT", "10"))
+
+
+def database_config(url):
+    # SQLite (local development, benchmarks) has no notion of TLS or pooling
+    sqlite = url.startswith("sqlite")
+    pooled = DATABASE_POOL and not sqlite
+    config = dj_database_url.parse(
+        url,
+        # Pooled connections go back to the pool at the end of each request
+        conn_max_age=0 if pooled else 600,
+        conn_health_checks=DATABASE_HEALTH_CHECKS,
+        ssl_require=not sqlite,
     )
-}
+    if pooled:
+        config["OPTIONS"]["pool"] = {
+            "min_size": DATABASE_POOL_MIN_SIZE,
+            "max_size": DATABASE_POOL_MAX_SIZE,
+            "timeout": DATABASE_POOL_TIMEOUT,
+        }
+    return config
+
+
+DATABASES = {"default": database_config(DATABASE_URL)}
+
+# Optional read replica for the feed, post detail and leaderboard reads
+# (core.routing); writes and every other read stay on "default"
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+
+if DATABASE_REPLICA_URL:
+    DATABASES["replica"] = database_config(DATABASE_REPLICA_URL)
+    # A read-only replica cannot host a test database; tests use the primary's
+    DATABASES["replica"]["TEST"] = {"MIRROR": "default"}
+
+REPLICA_DATABASE = "replica" if DATABASE_REPLICA_URL else None
+DATABASE_ROUTERS = ["core.routing.ReplicaRouter"]
+
+# Seconds a client reads from the primary after writing; should exceed
+# the replica's usual lag
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", "10"))
+
+# ========================
+# CACHE
+# ========================
+
+# Redis in production (shared across workers, so invalidation reaches all
+# of them); per-process local memory for development and tests
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Seconds; the leaderboard is only refreshed by expiry, post details are
+# also invalidated explicitly whenever the post changes
+LEADERBOARD_CACHE_TTL = int(os.environ.get("LEADERBOARD_CACHE_TTL", "10"))
+POST_DETAIL_CACHE_TTL = int(os.environ.get("POST_DETAIL_CACHE_TTL", "300"))
+# Seconds each process trusts its cached id of the masked user, which
+# anonymous writes are attributed to, before looking it up again
+MASKED_USER_TTL = int(os.environ.get("MASKED_USER_TTL", "300"))
+
+# ========================
+# LIVE EVENTS (SSE)
+# ========================
+
+# Carries events from publishers to the /api/events/ streams. The local
+# broker only reaches streams in the same process; with several worker
+# processes, use "core.events.RedisBroker"
+EVENTS_BROKER = os.environ.get("EVENTS_BROKER", "core.events.LocalBroker")
+EVENTS_REDIS_URL = os.environ.get("EVENTS_REDIS_URL", REDIS_URL)
+
+# Seconds between keep-alive comments on an idle stream
+EVENTS_HEARTBEAT = int(os.environ.get("EVENTS_HEARTBEAT", "15"))
+# Client reconnect delay, sent to browsers in the stream
+EVENTS_RETRY_MS = int(os.environ.get("EVENTS_RETRY_MS", "3000"))
+# Events a slow client may fall behind before its stream is closed
+EVENTS_MAX_PENDING = int(os.environ.get("EVENTS_MAX_PENDING", "100"))
+# Seconds; karma changes are coalesced into one leaderboard push per interval
+EVENTS_LEADERBOARD_INTERVAL = int(os.environ.get("EVENTS_LEADERBOARD_INTERVAL", "5"))
+
+# ========================
+# LIKE BUFFERING
+# ========================
+
+# Accept like toggles into a per-process buffer and write them in batches
+# (core.likebuffer). Toggles not flushed yet are lost if the process dies.
+LIKE_BUFFER_ENABLED = os.environ.get("LIKE_BUFFER_ENABLED", "False") == "True"
+# Seconds between flushes; 0 leaves flushing to the caller
+LIKE_BUFFER_FLUSH_INTERVAL = float(os.environ.get("LIKE_BUFFER_FLUSH_INTERVAL", "0.5"))
+# Pending (user, target) states that trigger an early flush
+LIKE_BUFFER_MAX_PENDING = int(os.environ.get("LIKE_BUFFER_MAX_PENDING", "5000"))
+
+# ========================
+# KARMA LEDGER
+# ========================
+
+# Days of KarmaTransaction rows kept raw; older ones are rolled into daily
+# summaries by "manage.py compact_karma". Must exceed the 24-hour
+# leaderboard window.
+KARMA_COMPACTION_HORIZON_DAYS = int(os.environ.get("KARMA_COMPACTION_HORIZON_DAYS", "30"))
+
+# ========================
+# SEARCH
+# ========================
+
+# Search ranks at most this many matches, the newest, so a word found in
+# most posts costs a bounded amount of ranking (core.search)
+SEARCH_MAX_CANDIDATES = int(os.environ.get("SEARCH_MAX_CANDIDATES", "10000"))
 
 # ========================
 # PASSWORD VALIDATION
@@ -147,6 +277,9 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Default page size of the keyset-paginated feed (?page_size= overrides it)
+FEED_PAGE_SIZE = int(os.environ.get("FEED_PAGE_SIZE", "20"))
+
 # ========================
 # CORS & CSRF
 # ========================
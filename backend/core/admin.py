@@ -1,5 +1,5 @@
 from django.contrib import admin
-from core.models import Post, Comment, Like, KarmaTransaction
+from core.models import Post, Comment, Like, KarmaTransaction, KarmaTotal
 
 
 @admin.register(Post)
@@ -26,3 +26,9 @@ class LikeAdmin(admin.ModelAdmin):
 class KarmaTransactionAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "points", "created_at")
     list_filter = ("created_at",)
+
+
+@admin.register(KarmaTotal)
+class KarmaTotalAdmin(admin.ModelAdmin):
+    list_display = ("user", "points")
+    ordering = ("-points",)
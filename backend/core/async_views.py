@@ -0,0 +1,284 @@
+"""
+Async-native versions of the read endpoints, served under ``/api/async/``
+next to their synchronous counterparts in core.views, with identical
+responses, including their ETags (and 304s) and ``stream=1``.
+
+Under ASGI they wait on the database and the cache without holding a
+worker thread. Under WSGI every async view runs through async_to_sync,
+so there the synchronous views are the better choice.
+"""
+import asyncio
+import functools
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views import View
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from core import events
+from core.authentication import aget_masked_user
+from core.caching import (
+    aget_feed_version,
+    aget_hot_feed_version,
+    aget_leaderboard,
+    aget_post_detail,
+    aget_post_version,
+)
+from core.likebuffer import aget_liked_targets, amark_liked_by_me, merge_pending_likes
+from core.models import Post, Comment
+from core.pagination import CommentCursorPagination
+from core.routing import primary_reads, read_from_replica
+from core.serializers import PostSerializer, CommentTreeSerializer
+from core.services import aget_comment_subtrees, aget_top_users
+from core.streaming import (
+    ITERATOR_CHUNK_SIZE,
+    comment_rows,
+    feed_page_parts,
+    json_parts_response,
+    json_stream_response,
+    post_detail_parts,
+)
+from core.utils import build_comment_tree
+from core.views import (
+    FEED_PAGINATION,
+    PostDetailView,
+    get_feed_sort,
+    get_more_replies_links,
+    get_reply_depth,
+    make_etag,
+    wants_stream,
+)
+
+
+def json_response(data, status=200):
+    return HttpResponse(
+        JSONRenderer().render(data),
+        status=status,
+        content_type='application/json'
+    )
+
+
+async def get_post(post_id):
+    try:
+        return await Post.objects.select_related('author').aget(id=post_id)
+    except Post.DoesNotExist:
+        raise Http404('No Post matches the given query.')
+
+
+async def fetch(queryset):
+    return [obj async for obj in queryset]
+
+
+def get_comments(post_id):
+    """The whole thread in display (path) order."""
+    return (
+        Comment.objects
+        .filter(post_id=post_id)
+        .select_related('author')
+        .order_by('path')
+    )
+
+
+def condition(etag_func):
+    """
+    django.views.decorators.http.condition for async view methods, with an
+    async ``etag_func``: a client holding the current ETag gets a 304
+    before the view runs.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, request, *args, **kwargs):
+            etag = quote_etag(await etag_func(request, *args, **kwargs))
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = await method(self, request, *args, **kwargs)
+            response.headers.setdefault('ETag', etag)
+            return response
+        return wrapper
+    return decorator
+
+
+async def aget_request_user(request):
+    """core.views.get_request_user."""
+    user = await request.auser()
+    # Inactive and anonymous users are turned away by SessionAuthentication
+    if user.is_active:
+        return user
+    return await aget_masked_user()
+
+
+async def feed_etag(request):
+    if request.GET.get('sort') == 'hot':
+        version = await aget_hot_feed_version()
+    else:
+        version = await aget_feed_version()
+    return make_etag(version, request, await aget_request_user(request))
+
+
+async def post_detail_etag(request, post_id):
+    return make_etag(await aget_post_version(post_id), request, await aget_request_user(request))
+
+
+class AsyncReadView(View):
+    """
+    Base class for the async views: exposes DRF's request API (such as
+    ``query_params``) to handlers and turns API errors into the same JSON
+    bodies DRF's exception handler produces.
+    """
+    http_method_names = ['get', 'head', 'options']
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            return await super().dispatch(Request(request), *args, **kwargs)
+        except Http404 as exc:
+            return self.handle_exception(NotFound(*exc.args))
+        except APIException as exc:
+            return self.handle_exception(exc)
+
+    async def get_user(self, request):
+        """The user MaskedUserMixin authenticates the synchronous views as."""
+        return await aget_request_user(request._request)
+
+    def handle_exception(self, exc):
+        if isinstance(exc.detail, (list, dict)):
+            data = exc.detail
+        else:
+            data = {'detail': exc.detail}
+        return json_response(data, status=exc.status_code)
+
+
+class AsyncPostListView(AsyncReadView):
+    @condition(feed_etag)
+    @read_from_replica
+    async def get(self, request):
+        posts = Post.objects.select_related('author')
+        user = await self.get_user(request)
+
+        paginator = FEED_PAGINATION[get_feed_sort(request)]()
+        if wants_stream(request):
+            page_queryset = paginator.get_page_queryset(posts, request)
+            liked = await aget_liked_targets(user, post_ids=page_queryset.values('id'))
+            return json_stream_response(request, feed_page_parts(paginator, page_queryset, liked))
+        page = await paginator.apaginate_queryset(posts, request, view=self)
+        serializer = PostSerializer(page, many=True)
+        data = await amark_liked_by_me(merge_pending_likes(serializer.data), user)
+        return json_response(paginator.get_paginated_response(data).data)
+
+
+class AsyncPostDetailView(AsyncReadView):
+    """
+    Async PostDetailView. The post row and its comments are independent
+    queries and are awaited together. Django's async ORM still runs them one
+    after another on the request's database thread, but the view is ready
+    to overlap them once a natively async database backend can.
+    """
+    pagination_class = CommentCursorPagination
+    bounded_params = PostDetailView.bounded_params
+
+    @condition(post_detail_etag)
+    @read_from_replica
+    async def get(self, request, post_id):
+        user = await self.get_user(request)
+        if self.bounded_params & request.query_params.keys():
+            data = await self.serialize_bounded(request, post_id)
+            return json_response(await amark_liked_by_me(merge_pending_likes(data), user))
+
+        liked = await aget_liked_targets(
+            user,
+            post_ids=[post_id],
+            comment_ids=Comment.objects.filter(post_id=post_id).values('id'),
+        )
+        if wants_stream(request):
+            post = await get_post(post_id)
+            rows = comment_rows(get_comments(post_id).iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+            return json_stream_response(request, post_detail_parts(PostSerializer(post).data, rows, liked))
+        post_data, rows = await aget_post_detail(post_id, lambda: self.serialize(post_id))
+        return json_parts_response(request, post_detail_parts(post_data, rows, liked))
+
+    async def serialize_bounded(self, request, post_id):
+        depth = get_reply_depth(request)
+
+        paginator = self.pagination_class()
+        post, roots = await asyncio.gather(
+            get_post(post_id),
+            paginator.apaginate_queryset(
+                Comment.objects.filter(post_id=post_id, depth=0).only('id', 'post', 'path', 'depth'),
+                request,
+                view=self,
+            ),
+        )
+        comments, truncated = await aget_comment_subtrees(roots, depth)
+
+        more_replies = get_more_replies_links(request, truncated, depth)
+        post_data = PostSerializer(post).data
+        post_data['comments'] = CommentTreeSerializer(build_comment_tree(comments), more_replies).data
+        post_data['comments_next'] = paginator.get_next_link()
+        return post_data
+
+    async def serialize(self, post_id):
+        with primary_reads():
+            post, comments = await asyncio.gather(get_post(post_id), fetch(get_comments(post_id)))
+
+            return PostSerializer(post).data, list(comment_rows(comments))
+
+
+class AsyncLeaderboardView(AsyncReadView):
+    @read_from_replica
+    async def get(self, request):
+        return json_response(await aget_leaderboard(aget_top_users))
+
+
+class EventStreamView(View):
+    """
+    Server-Sent Events: new posts, new comments, like count deltas and
+    leaderboard changes as they happen. ``?post=<id>`` narrows the stream
+    to one post's events plus the leaderboard. Needs the ASGI server;
+    under WSGI every open stream would pin a worker.
+    """
+
+    async def get(self, request):
+        if not isinstance(request, ASGIRequest):
+            return json_response(
+                {'detail': 'Event streaming requires the ASGI server.'},
+                status=503,
+            )
+
+        post_id = request.GET.get('post')
+        if post_id is not None:
+            try:
+                post_id = int(post_id)
+            except ValueError:
+                return json_response({'post': 'A valid integer is required.'}, status=400)
+
+        response = StreamingHttpResponse(
+            self.stream(events.subscribe(post_id)),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx-style proxies from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream(self, subscription):
+        try:
+            # Sent at once so the client sees the stream open; also sets
+            # how long the browser waits before reconnecting
+            yield f'retry: {settings.EVENTS_RETRY_MS}\n\n'.encode()
+            while True:
+                try:
+                    async with asyncio.timeout(settings.EVENTS_HEARTBEAT):
+                        event = await subscription.get()
+                except TimeoutError:
+                    # Keeps idle connections from being cut by proxies
+                    yield b': keep-alive\n\n'
+                    continue
+                except events.StreamOverflow:
+                    return
+                yield event.encoded
+        finally:
+            subscription.close()
@@ -0,0 +1,75 @@
+import functools
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from rest_framework.authentication import BaseAuthentication
+
+User = get_user_model()
+
+MASKED_USERNAME = 'masked-username'
+MASKED_EMAIL = 'masked@example.com'
+
+# Resolved by get_masked_user(): the id, and the monotonic time at which
+# it is looked up again in case the account was deleted meanwhile
+_masked_user_id = None
+_masked_user_expires = 0.0
+
+
+def _cached_masked_user_id():
+    if time.monotonic() >= _masked_user_expires:
+        return None
+    return _masked_user_id
+
+
+def _remember_masked_user(user_id):
+    global _masked_user_id, _masked_user_expires
+    _masked_user_id = user_id
+    _masked_user_expires = time.monotonic() + settings.MASKED_USER_TTL
+
+
+def get_masked_user():
+    """
+    The shared account that unauthenticated writes are attributed to. Its id
+    is looked up (or the account created) on first use and then kept for
+    MASKED_USER_TTL seconds, during which the user is built from the cached
+    id without touching the database. The id is only kept once the
+    transaction it was read in commits, so a rolled back account is never
+    cached.
+    """
+    user_id = _cached_masked_user_id()
+    if user_id is None:
+        user, created = User.objects.get_or_create(
+            username=MASKED_USERNAME,
+            defaults={'email': MASKED_EMAIL}
+        )
+        transaction.on_commit(functools.partial(_remember_masked_user, user.id))
+        return user
+
+    user = User(id=user_id, username=MASKED_USERNAME, email=MASKED_EMAIL)
+    user._state.adding = False
+    return user
+
+
+async def aget_masked_user():
+    if _cached_masked_user_id() is None:
+        return await sync_to_async(get_masked_user)()
+    return get_masked_user()
+
+
+def forget_masked_user():
+    """Drop the cached id, e.g. right after deleting the account."""
+    global _masked_user_id
+    _masked_user_id = None
+
+
+class MaskedUserAuthentication(BaseAuthentication):
+    """
+    Last in the authentication chain: requests no other authenticator
+    claimed act as the masked user.
+    """
+
+    def authenticate(self, request):
+        return (get_masked_user(), None)
@@ -0,0 +1,1096 @@
+"""
+Benchmarks for the core read and write paths.
+
+Scenarios are registered with ``@scenario`` and run through
+``python manage.py benchmark <name>``, which gives each run a throwaway
+test database so real data is never touched. Each scenario writes its
+findings to a ``Report``, which the command can also save as JSON.
+"""
+import asyncio
+import io
+import itertools
+import math
+import pickle
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Count, F, Q, Sum
+from django.db.models.expressions import RawSQL
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from core import events, ranking
+from core.caching import invalidate_post
+from core.likebuffer import LikeBuffer
+from core.models import Comment, KarmaDailySummary, KarmaTransaction, Like, Post
+from core.pagination import FeedCursorPagination, HotFeedCursorPagination
+from core.serializers import CommentSerializer, CommentTreeSerializer, PostSerializer
+from core.services import (
+    POST_KARMA,
+    _ledger_totals,
+    check_karma,
+    compact_karma,
+    create_comment,
+    get_comment_subtrees,
+    like_comment,
+    like_post,
+    record_karma,
+    revoke_karma,
+)
+from core.seeding import seed_community
+from core.streaming import comment_rows, comment_tree_parts
+from core.utils import build_comment_tree
+from core.views import LeaderboardView, PostDetailView, PostListView, SearchView
+
+User = get_user_model()
+
+SCENARIOS = {}
+
+BATCH_SIZE = 10_000
+
+
+def scenario(name, default_size, default_repeat=5):
+    def register(func):
+        func.default_size = default_size
+        func.default_repeat = default_repeat
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat):
+    """Run ``func`` ``repeat`` times and return the median wall time in ms."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
+
+
+def measure_peak_memory(func):
+    """Run ``func`` once and return its peak traced allocation in MiB."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of ``values``."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def profile(func, repeat, setup=None):
+    """
+    Run ``func`` ``repeat`` times, calling ``setup`` untimed before each run,
+    and return its latency percentiles in ms plus the queries and peak
+    memory of one further run.
+    """
+    setup = setup or (lambda: None)
+    timings = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    setup()
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    setup()
+    peak = measure_peak_memory(func)
+
+    return {
+        'p50_ms': percentile(timings, 50),
+        'p95_ms': percentile(timings, 95),
+        'p99_ms': percentile(timings, 99),
+        'queries': len(queries),
+        'peak_mib': peak,
+    }
+
+
+class Report:
+    """Output of one scenario run: free-form lines plus named measurements."""
+
+    def __init__(self, write):
+        self._write = write
+        self.lines = []
+        self.results = {}
+
+    def write(self, line):
+        self.lines.append(line)
+        self._write(line)
+
+    formats = {
+        'requests_per_s': '{:8.0f} req/s',
+        'p50_ms': 'p50 {:8.2f} ms',
+        'p95_ms': 'p95 {:8.2f} ms',
+        'p99_ms': 'p99 {:8.2f} ms',
+        'queries': '{:3d} queries',
+        'peak_mib': 'peak {:7.2f} MiB',
+        'connect_s': 'connected in {:6.2f} s',
+        'threads': '{:5d} threads',
+        'rss_kib_per_client': '{:6.1f} KiB RSS/client',
+        'connections_opened': '{:5d} connections opened',
+        'checkout_wait_ms': 'waited {:7.2f} ms/checkout',
+    }
+
+    def record(self, name, stats):
+        self.results[name] = stats
+        parts = [
+            template.format(stats[key])
+            for key, template in self.formats.items()
+            if key in stats
+        ]
+        self.write(f'  {name:<36} ' + '  '.join(parts))
+
+
+def seed_users(count):
+    User.objects.bulk_create(
+        User(username=f'bench-user-{i}') for i in range(count)
+    )
+    return list(User.objects.filter(username__startswith='bench-user-'))
+
+
+def seed_posts(count, users):
+    for start in range(0, count, BATCH_SIZE):
+        Post.objects.bulk_create(
+            Post(author=users[i % len(users)], content=f'Benchmark post {i}')
+            for i in range(start, min(start + BATCH_SIZE, count))
+        )
+
+
+def get_view(view, path, params=None, **kwargs):
+    request = RequestFactory(HTTP_HOST='localhost').get(path, params or {})
+    response = view(request, **kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+@scenario('feed-pagination', default_size=1_000_000)
+def feed_pagination(size, repeat, report):
+    """Keyset-paginated feed pages at increasing depth vs. the unbounded list."""
+    users = seed_users(100)
+    seed_posts(size, users)
+    report.write(f'Seeded {size} posts')
+
+    view = PostListView.as_view()
+    paginator = FeedCursorPagination()
+    ordered = Post.objects.order_by('-created_at', '-id')
+
+    for offset in sorted({0, size // 10, size // 2, size - 1}):
+        params = {}
+        if offset:
+            created_at, pk = ordered.values_list('created_at', 'id')[offset - 1]
+            params['cursor'] = paginator.encode_cursor(created_at, pk)
+        elapsed = measure(lambda: get_view(view, '/api/posts/', params), repeat)
+        report.write(f'  page at offset {offset:>9}: {elapsed:8.2f} ms')
+
+    def unbounded():
+        posts = Post.objects.select_related('author').order_by('-created_at')
+        PostSerializer(posts, many=True).data
+
+    report.write(f'  unbounded list:             {measure(unbounded, 1):8.2f} ms')
+
+
+def make_comment_thread(size, shape):
+    """
+    Build an unsaved thread of ``size`` comments: ``wide`` attaches each
+    comment to a random earlier one, ``deep`` makes a single reply chain.
+    """
+    author = User(id=1, username='bench-author')
+    post = Post(id=1, author=author)
+    now = timezone.now()
+    rng = random.Random(size)
+
+    comments = []
+    for i in range(1, size + 1):
+        if shape == 'deep':
+            parent_id = i - 1 or None
+        else:
+            parent_id = rng.randint(0, i - 1) or None
+        depth = comments[parent_id - 1].depth + 1 if parent_id else 0
+        comments.append(Comment(
+            id=i, post=post, author=author, parent_id=parent_id, depth=depth,
+            content=f'Benchmark comment {i}', created_at=now,
+        ))
+    return comments
+
+
+def path_order(comments):
+    """``comments`` in path order (a depth-first walk), as the database returns them."""
+    replies = {}
+    for comment in comments:
+        replies.setdefault(comment.parent_id, []).append(comment)
+    ordered = []
+    stack = list(reversed(replies.get(None, [])))
+    while stack:
+        comment = stack.pop()
+        ordered.append(comment)
+        stack.extend(reversed(replies.get(comment.id, [])))
+    return ordered
+
+
+@scenario('comment-tree', default_size=5_000)
+def comment_tree(size, repeat, report):
+    """
+    Recursive CommentSerializer vs. iterative CommentTreeSerializer vs. the
+    flat rows the post detail caches, each serialized, pickled as the cache
+    does and encoded to the response body.
+    """
+    def nested(serialize):
+        def respond(comments):
+            data = serialize(build_comment_tree(comments))
+            pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            return JSONRenderer().render(data)
+        return respond
+
+    def flat(comments):
+        rows = list(comment_rows(path_order(comments)))
+        pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        return b''.join(comment_tree_parts(rows, frozenset()))
+
+    responders = {
+        'recursive': nested(lambda roots: CommentSerializer(roots, many=True).data),
+        'iterative': nested(lambda roots: CommentTreeSerializer(roots).data),
+        'flat rows': flat,
+    }
+
+    for shape in ('wide', 'deep'):
+        comments = make_comment_thread(size, shape)
+        report.write(f'{shape} thread of {size} comments '
+              f'(recursion limit {sys.getrecursionlimit()})')
+
+        for name, respond in responders.items():
+            try:
+                elapsed = measure(lambda: respond(comments), repeat)
+                peak = measure_peak_memory(lambda: respond(comments))
+            except RecursionError:
+                report.write(f'  {name:>9}: RecursionError')
+                continue
+            report.write(f'  {name:>9}: {elapsed:8.2f} ms, '
+                  f'{size / elapsed * 1000:10.0f} comments/s, peak {peak:7.2f} MiB')
+
+
+def seed_thread(post, size, users):
+    """Create a thread of ``size`` comments; one in ten starts a new branch."""
+    rng = random.Random(size)
+    comments = []
+    with transaction.atomic():
+        for i in range(size):
+            parent = None
+            if comments and rng.random() > 0.1:
+                parent = rng.choice(comments[-200:])
+                if parent.depth >= 50:
+                    parent = None
+            comments.append(create_comment(
+                author=users[i % len(users)],
+                post=post,
+                content=f'Benchmark comment {i}',
+                parent=parent,
+            ))
+    return comments
+
+
+def cte_subtree(root_id):
+    """The adjacency-list way to load a subtree: a recursive CTE."""
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    thread = RawSQL(
+        f"""
+        WITH RECURSIVE thread(id) AS (
+            SELECT id FROM {table} WHERE id = %s
+            UNION ALL
+            SELECT c.id FROM {table} c JOIN thread ON c.parent_id = thread.id
+        )
+        SELECT id FROM thread
+        """,
+        [root_id],
+    )
+    return list(Comment.objects.filter(id__in=thread).select_related('author'))
+
+
+@scenario('comment-thread', default_size=20_000)
+def comment_thread(size, repeat, report):
+    """Thread and subtree loading via parent links vs. materialized paths."""
+    users = seed_users(50)
+    post = Post.objects.create(author=users[0], content='Benchmark thread')
+    comments = seed_thread(post, size, users)
+    report.write(f'Seeded a thread of {size} comments')
+
+    thread = Comment.objects.filter(post=post).select_related('author')
+    by_created = measure(lambda: build_comment_tree(list(thread.order_by('created_at'))), repeat)
+    by_path = measure(lambda: list(thread.order_by('path')), repeat)
+    report.write(f'  full thread, tree rebuilt: {by_created:8.2f} ms')
+    report.write(f'  full thread, path order:   {by_path:8.2f} ms')
+
+    # The largest subtree below a top-level comment
+    root = max(
+        (c for c in comments if c.depth == 0),
+        key=lambda c: sum(1 for d in comments if d.path.startswith(c.path)),
+    )
+    descendants = sum(1 for d in comments if d.path.startswith(root.path))
+    by_cte = measure(lambda: cte_subtree(root.id), repeat)
+    by_range = measure(lambda: get_comment_subtrees([root], size), repeat)
+    report.write(f'  subtree of {descendants} comments, recursive CTE: {by_cte:8.2f} ms')
+    report.write(f'  subtree of {descendants} comments, path range:    {by_range:8.2f} ms')
+
+    view = PostDetailView.as_view()
+    bounded = measure(
+        lambda: get_view(view, f'/api/posts/{post.id}/', {'limit': 20, 'depth': 3}, post_id=post.id),
+        repeat,
+    )
+    report.write(f'  first page, 20 top-level comments x 3 levels: {bounded:8.2f} ms')
+
+
+@transaction.atomic
+def locking_like_post(user, post_id):
+    """like_post as it was before it went lock-free, for comparison."""
+    post = Post.objects.select_for_update().get(id=post_id)
+
+    like, created = Like.objects.get_or_create(user=user, post=post)
+    if not created:
+        revoke_karma(KarmaTransaction.objects.filter(like=like))
+        like.delete()
+        Post.objects.filter(id=post.id).update(like_count=F('like_count') - 1)
+        return False
+
+    record_karma(post.author_id, POST_KARMA, post=post, like=like)
+    Post.objects.filter(id=post.id).update(like_count=F('like_count') + 1)
+    return True
+
+
+def hammer(toggle, post, users, toggles_per_user, threads):
+    """
+    Toggle likes on one post from ``threads`` threads, each driving its own
+    slice of users. Returns the elapsed wall time in seconds.
+    """
+    errors = []
+
+    def worker(slice_):
+        try:
+            for _ in range(toggles_per_user):
+                for user in slice_:
+                    toggle(user, post.id)
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            connection.close()
+
+    workers = [
+        threading.Thread(target=worker, args=(users[i::threads],))
+        for i in range(threads)
+    ]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+@scenario('like-contention', default_size=2_000)
+def like_contention(size, repeat, report, threads=8):
+    """
+    ``size`` toggles per run from ``threads`` threads, all on one post,
+    with row-locking and lock-free like_post; checks the resulting counts.
+    """
+    users = seed_users(100)
+    # Odd number of toggles per user, so every user ends up liking the post
+    toggles_per_user = max(1, size // len(users)) | 1
+
+    for name, toggle in (('select_for_update', locking_like_post), ('lock-free', like_post)):
+        post = Post.objects.create(author=users[0], content=f'Hot post ({name})')
+        elapsed = sum(
+            hammer(toggle, post, users, toggles_per_user, threads) for _ in range(repeat)
+        )
+
+        toggles = repeat * toggles_per_user * len(users)
+        post.refresh_from_db()
+        likes = Like.objects.filter(post=post).count()
+        expected = len(users) if repeat % 2 else 0
+        assert likes == post.like_count == expected, (likes, post.like_count, expected)
+        karma = KarmaTransaction.objects.filter(post=post).aggregate(total=Sum('points'))['total']
+        assert (karma or 0) == likes * POST_KARMA, (karma, likes)
+        assert not check_karma(), 'materialized karma drifted from the ledger'
+
+        report.write(f'  {name:>17}: {toggles / elapsed:8.0f} toggles/s '
+              f'({threads} threads, {toggles} toggles, counts and karma consistent)')
+
+
+@scenario('like-buffer', default_size=20_000, default_repeat=3)
+def like_buffer(size, repeat, report, threads=8):
+    """
+    ``size`` toggles per run from ``threads`` threads, all on one post,
+    written directly by like_post and through a LikeBuffer with its
+    background flusher; checks the counts once everything is flushed.
+    """
+    users = seed_users(1_000)
+    toggles_per_user = max(1, size // len(users)) | 1
+    buffer = LikeBuffer(settings.LIKE_BUFFER_FLUSH_INTERVAL, settings.LIKE_BUFFER_MAX_PENDING)
+
+    for name, toggle in (
+        ('direct', like_post),
+        ('buffered', lambda user, post_id: buffer.toggle(user, 'post', post_id)),
+    ):
+        post = Post.objects.create(author=users[0], content=f'Viral post ({name})')
+        elapsed = sum(
+            hammer(toggle, post, users, toggles_per_user, threads) for _ in range(repeat)
+        )
+        pending = buffer.pending_count()
+        start = time.perf_counter()
+        buffer.flush()
+        final_flush = (time.perf_counter() - start) * 1000
+
+        toggles = repeat * toggles_per_user * len(users)
+        post.refresh_from_db()
+        likes = Like.objects.filter(post=post).count()
+        expected = len(users) if repeat % 2 else 0
+        assert likes == post.like_count == expected, (likes, post.like_count, expected)
+        assert not check_karma(), 'materialized karma drifted from the ledger'
+
+        report.write(f'  {name:>8}: {toggles / elapsed:8.0f} toggles/s '
+                     f'({threads} threads, {toggles} toggles)')
+        if name == 'buffered':
+            report.write(f'            {pending} states left for the final flush, '
+                         f'written in {final_flush:.1f} ms; counts and karma consistent')
+
+
+@scenario('community', default_size=10_000, default_repeat=100)
+def community(size, repeat, report):
+    """
+    The main read and write paths over a seeded community of ``size`` posts,
+    with ten comments and twenty likes per post on average.
+    """
+    created = seed_community(
+        users=max(1, size // 10), posts=size, comments=size * 10, likes=size * 20
+    )
+    report.write('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items()))
+
+    feed = PostListView.as_view()
+    detail = PostDetailView.as_view()
+    leaderboard = LeaderboardView.as_view()
+
+    ordered = Post.objects.order_by('-created_at', '-id')
+    created_at, pk = ordered.values_list('created_at', 'id')[size // 2]
+    cursor = FeedCursorPagination().encode_cursor(created_at, pk)
+    hot_post = Post.objects.order_by('-like_count').first()
+    hot_comment = Comment.objects.filter(post=hot_post).order_by('-like_count').first()
+    thread_size = Comment.objects.filter(post=hot_post).count()
+
+    report.record('feed, first page', profile(
+        lambda: get_view(feed, '/api/posts/'), repeat,
+    ))
+    report.record('feed, middle page', profile(
+        lambda: get_view(feed, '/api/posts/', {'cursor': cursor}), repeat,
+    ))
+
+    def hot_detail(params=None):
+        return get_view(detail, f'/api/posts/{hot_post.id}/', params, post_id=hot_post.id)
+
+    report.write(f'Hottest post has {thread_size} comments')
+    report.record('post detail, uncached', profile(
+        hot_detail, repeat, setup=lambda: invalidate_post(hot_post.id),
+    ))
+    report.record('post detail, cached', profile(hot_detail, repeat))
+    report.record('post detail, first page', profile(
+        lambda: hot_detail({'limit': 20, 'depth': 3}), repeat,
+    ))
+
+    # Each user toggles in turn, so runs alternate between liking and unliking
+    users = itertools.cycle(User.objects.filter(username__startswith='member-')[:50])
+    report.record('like_post toggle', profile(
+        lambda: like_post(next(users), hot_post.id), repeat,
+    ))
+    report.record('like_comment toggle', profile(
+        lambda: like_comment(next(users), hot_comment.id), repeat,
+    ))
+
+    report.record('leaderboard, uncached', profile(
+        lambda: get_view(leaderboard, '/api/leaderboard/'), repeat,
+        setup=lambda: cache.delete('leaderboard'),
+    ))
+    report.record('leaderboard, cached', profile(
+        lambda: get_view(leaderboard, '/api/leaderboard/'), repeat,
+    ))
+
+
+@scenario('hot-feed', default_size=50_000, default_repeat=50)
+def hot_feed(size, repeat, report):
+    """
+    The hot feed over ``size`` posts from the last two weeks, from stored
+    scores and ranked per request from Like and Comment, plus the cost of a
+    decay run.
+    """
+    created = seed_community(
+        users=max(1, size // 10), posts=size, comments=size * 2, likes=size * 5,
+        days=ranking.HOT_HORIZON.days * 2,
+    )
+    report.write('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items()))
+
+    feed = PostListView.as_view()
+    ordered = Post.objects.order_by('-hot_score', '-id')
+    report.write('Plan: ' + ordered[:21].explain().replace('\n', ' | '))
+    hot_score, pk = ordered.values_list('hot_score', 'id')[min(size, 10_000) // 2]
+    cursor = HotFeedCursorPagination().encode_cursor(hot_score, pk)
+
+    report.record('hot feed, first page', profile(
+        lambda: get_view(feed, '/api/posts/', {'sort': 'hot'}), repeat,
+    ))
+    report.record('hot feed, deep page', profile(
+        lambda: get_view(feed, '/api/posts/', {'sort': 'hot', 'cursor': cursor}), repeat,
+    ))
+
+    def ranked_per_request():
+        now = timezone.now()
+        recent = Post.objects.filter(created_at__gte=now - ranking.HOT_HORIZON)
+        likes = dict(
+            Like.objects.filter(post__in=recent).order_by().values('post')
+            .annotate(count=Count('id')).values_list('post', 'count')
+        )
+        comments = dict(
+            Comment.objects.filter(post__in=recent).order_by().values('post')
+            .annotate(count=Count('id')).values_list('post', 'count')
+        )
+        scores = {
+            post_id: ranking.hot_score(likes.get(post_id, 0), comments.get(post_id, 0), created_at, now)
+            for post_id, created_at in recent.values_list('id', 'created_at')
+        }
+        top = sorted(scores, key=scores.get, reverse=True)[:settings.FEED_PAGE_SIZE]
+        posts = Post.objects.select_related('author').in_bulk(top)
+        PostSerializer([posts[post_id] for post_id in top], many=True).data
+
+    report.record('hot feed, ranked per request', profile(ranked_per_request, max(1, repeat // 10)))
+    report.record('decay run', profile(ranking.decay_hot_scores, 1))
+
+
+def make_vocabulary(size, rng):
+    """``size`` distinct made-up words of two to four syllables."""
+    syllables = [c + v for c in 'bdfgklmnprstvz' for v in 'aeiou']
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices(syllables, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+@scenario('search', default_size=1_000_000, default_repeat=20)
+def search(size, repeat, report, words_per_post=12):
+    """
+    Full-text search over ``size`` posts of words drawn from a Zipf
+    distribution, against the unindexed ``icontains`` scan the admin
+    search runs. Words are picked at several frequencies.
+    """
+    rng = random.Random(0)
+    vocabulary = make_vocabulary(20_000, rng)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    users = seed_users(100)
+
+    start = time.perf_counter()
+    for batch_start in range(0, size, BATCH_SIZE):
+        Post.objects.bulk_create(
+            Post(
+                author=users[i % len(users)],
+                content=' '.join(rng.choices(vocabulary, cum_weights=weights, k=words_per_post)),
+            )
+            for i in range(batch_start, min(batch_start + BATCH_SIZE, size))
+        )
+    report.write(f'Seeded and indexed {size} posts in {time.perf_counter() - start:.1f} s')
+
+    view = SearchView.as_view()
+    queries = {
+        'common word': vocabulary[0],
+        'word #100': vocabulary[99],
+        'rare word': vocabulary[9_999],
+        'two words': f'{vocabulary[9]} {vocabulary[99]}',
+    }
+    for name, query in queries.items():
+        matches = Post.objects.filter(
+            *(Q(content__icontains=word) for word in query.split())
+        ).count()
+        report.write(f'{name} ({query!r}): {matches} substring matches')
+        report.record(f'{name}, search', profile(
+            lambda: get_view(view, '/api/search/', {'q': query}), repeat,
+        ))
+
+        def scan():
+            posts = (
+                Post.objects
+                .filter(*(Q(content__icontains=word) for word in query.split()))
+                .select_related('author')
+                .order_by('-created_at')[:settings.FEED_PAGE_SIZE]
+            )
+            PostSerializer(posts, many=True).data
+
+        report.record(f'{name}, icontains scan', profile(scan, max(1, repeat // 10)))
+
+
+@scenario('karma-compaction', default_size=200_000, default_repeat=20)
+def karma_compaction(size, repeat, report):
+    """
+    The leaderboard and the ledger aggregations behind rebuild_karma and
+    check_karma over a year of ``size`` likes, before and after compacting
+    everything older than KARMA_COMPACTION_HORIZON_DAYS.
+    """
+    created = seed_community(
+        users=max(1, size // 20), posts=max(1, size // 10), comments=size // 5, likes=size, days=365,
+    )
+    report.write('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items()))
+
+    leaderboard = LeaderboardView.as_view()
+
+    def measure_reads(stage):
+        report.write(
+            f'{stage}: {KarmaTransaction.objects.count()} ledger rows, '
+            f'{KarmaDailySummary.objects.count()} daily summaries'
+        )
+        report.record(f'{stage}, leaderboard', profile(
+            lambda: get_view(leaderboard, '/api/leaderboard/'), repeat, setup=cache.clear,
+        ))
+        report.record(f'{stage}, all-time ledger totals', profile(_ledger_totals, max(1, repeat // 4)))
+        report.record(f'{stage}, check_karma', profile(check_karma, max(1, repeat // 4)))
+
+    measure_reads('before')
+    start = time.perf_counter()
+    compacted = compact_karma()
+    report.write(f'Compacted {compacted} rows in {time.perf_counter() - start:.2f} s')
+    measure_reads('after')
+
+
+def read_response(view, path, params=None, **kwargs):
+    """
+    Serve one GET through ``view`` and read the whole body. Returns the ms
+    until the first body bytes were ready, the ms until the last, and the
+    body size in bytes.
+    """
+    start = time.perf_counter()
+    response = view(RequestFactory(HTTP_HOST='localhost').get(path, params or {}), **kwargs)
+    if response.streaming:
+        chunks = iter(response.streaming_content)
+        size = len(next(chunks, b''))
+        first_byte = time.perf_counter() - start
+        size += sum(len(chunk) for chunk in chunks)
+    else:
+        if hasattr(response, 'render'):
+            response.render()
+        size = len(response.content)
+        first_byte = time.perf_counter() - start
+    return first_byte * 1000, (time.perf_counter() - start) * 1000, size
+
+
+@scenario('streaming', default_size=50_000)
+def streaming(size, repeat, report):
+    """
+    A post with a ``size``-comment thread and a 100-post feed page, rendered
+    whole and streamed: time to first byte, total time and peak memory.
+    The thread is also served through the ASGI handler, which only sends
+    a streamed body as it is read when it gets an async iterator.
+    """
+    created = seed_community(users=100, posts=100, comments=size, likes=size)
+    report.write('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items()))
+    post = Post.objects.order_by('-comment_count').first()
+    report.write(f'Largest thread has {post.comment_count} comments')
+
+    detail = PostDetailView.as_view()
+    feed = PostListView.as_view()
+    cases = (
+        ('thread', detail, f'/api/posts/{post.id}/', {'post_id': post.id}),
+        ('feed page', feed, '/api/posts/', {}),
+    )
+    for name, view, path, kwargs in cases:
+        for mode, params in (('whole', {'page_size': 100}), ('streamed', {'page_size': 100, 'stream': 1})):
+            if view is detail:
+                params.pop('page_size')
+            runs = []
+            for _ in range(repeat):
+                # Uncached, so both modes read the same rows
+                cache.clear()
+                runs.append(read_response(view, path, params, **kwargs))
+            cache.clear()
+            peak = measure_peak_memory(lambda: read_response(view, path, params, **kwargs))
+            report.write(
+                f'  {name:>9}, {mode:>8}: first byte {median(r[0] for r in runs):8.2f} ms, '
+                f'total {median(r[1] for r in runs):8.2f} ms, peak {peak:7.2f} MiB, '
+                f'{runs[0][2] / 1024:8.0f} KiB'
+            )
+
+    handler = ASGIHandler()
+    for mode, query in (('whole', ''), ('streamed', 'stream=1')):
+        runs = []
+        for _ in range(repeat):
+            cache.clear()
+            runs.append(asyncio.run(asgi_read(handler, f'/api/posts/{post.id}/', query)))
+        report.write(
+            f'  ASGI thread, {mode:>8}: first byte {median(r[0] for r in runs):8.2f} ms, '
+            f'total {median(r[1] for r in runs):8.2f} ms'
+        )
+
+
+def wsgi_get(handler, path, query=''):
+    """Serve one GET request through the WSGI handler; returns the latency in ms."""
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    statuses = []
+    start = time.perf_counter()
+    response = handler(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    try:
+        b''.join(response)
+    finally:
+        # Fires request_finished, which closes the thread's connection
+        response.close()
+    assert statuses[0].startswith('200'), (path, statuses[0])
+    return (time.perf_counter() - start) * 1000
+
+
+async def asgi_read(handler, path, query=''):
+    """
+    Serve one GET request through the ASGI handler. Returns the ms until
+    the first body bytes were sent, the ms until the last, and the body
+    size in bytes.
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    body_read = False
+    sent = []
+    first_byte = None
+    size = 0
+
+    async def receive():
+        nonlocal body_read
+        if not body_read:
+            body_read = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client never disconnects; the handler cancels this wait
+        await asyncio.Future()
+
+    async def send(message):
+        nonlocal first_byte, size
+        if message.get('body'):
+            if first_byte is None:
+                first_byte = time.perf_counter() - start
+            size += len(message['body'])
+        else:
+            sent.append(message)
+
+    start = time.perf_counter()
+    await handler(scope, receive, send)
+    assert sent[0]['status'] == 200, (path, sent[0]['status'])
+    return first_byte * 1000, (time.perf_counter() - start) * 1000, size
+
+
+async def asgi_get(handler, path, query=''):
+    """Serve one GET request through the ASGI handler; returns the latency in ms."""
+    return (await asgi_read(handler, path, query))[1]
+
+
+def load_stats(timings, elapsed):
+    return {
+        'requests_per_s': len(timings) / elapsed,
+        'p50_ms': percentile(timings, 50),
+        'p99_ms': percentile(timings, 99),
+    }
+
+
+def wsgi_load(path, query, requests, concurrency):
+    """``requests`` GETs from ``concurrency`` threads, as a threaded WSGI server would."""
+    handler = WSGIHandler()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        timings = list(pool.map(lambda _: wsgi_get(handler, path, query), range(requests)))
+        elapsed = time.perf_counter() - start
+    return load_stats(timings, elapsed)
+
+
+def asgi_load(path, query, requests, concurrency):
+    """``requests`` GETs with ``concurrency`` in flight on one event loop."""
+    handler = ASGIHandler()
+
+    async def run():
+        remaining = iter(range(requests))
+        timings = []
+
+        async def client():
+            for _ in remaining:
+                timings.append(await asgi_get(handler, path, query))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return load_stats(timings, time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+
+@scenario('asgi-vs-wsgi', default_size=2_000, default_repeat=400)
+def asgi_vs_wsgi(size, repeat, report, concurrency_levels=(1, 8, 32)):
+    """
+    Throughput of the read endpoints at increasing concurrency: sync views
+    under WSGI and ASGI, and the async views under ASGI. Requests go
+    through the full handler and middleware stack in process; ``repeat`` is
+    the number of requests per measurement.
+    """
+    created = seed_community(
+        users=max(1, size // 10), posts=size, comments=size * 10, likes=size * 20
+    )
+    report.write('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items()))
+    hot_post = Post.objects.order_by('-like_count').first()
+
+    endpoints = {
+        'feed': ('posts/', ''),
+        'post detail, first page': (f'posts/{hot_post.id}/', 'limit=20&depth=3'),
+        'leaderboard': ('leaderboard/', ''),
+    }
+    setups = {
+        'WSGI, sync': (wsgi_load, '/api/'),
+        'ASGI, sync': (asgi_load, '/api/'),
+        'ASGI, async': (asgi_load, '/api/async/'),
+    }
+
+    for endpoint, (path, query) in endpoints.items():
+        report.write(endpoint)
+        for concurrency in concurrency_levels:
+            for setup, (load, prefix) in setups.items():
+                stats = load(prefix + path, query, repeat, concurrency)
+                report.record(f'{setup}, {concurrency} concurrent', stats)
+
+
+class ConnectionCounter:
+    """Counts database connections opened, in any thread, while connected."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, sender, connection, **kwargs):
+        with self._lock:
+            self.count += 1
+
+
+def set_connection_mode(max_age, pool=None):
+    """
+    Change how every thread connects from its next connection on. All
+    threads share the settings dict of the default database.
+    """
+    connection.close()
+    if getattr(connection, 'pool', None) is not None:
+        connection.close_pool()
+    connection.settings_dict['CONN_MAX_AGE'] = max_age
+    if pool is None:
+        connection.settings_dict['OPTIONS'].pop('pool', None)
+    else:
+        connection.settings_dict['OPTIONS']['pool'] = pool
+
+
+@scenario('connection-pool', default_size=2_000, default_repeat=2_000)
+def connection_pool(size, repeat, report, concurrency_levels=(8, 32)):
+    """
+    Latency and connection churn of the feed under concurrent load with a
+    new connection per request, a persistent connection per thread (what
+    DATABASE_POOL=False gives) and, on PostgreSQL, a pool sized by the
+    DATABASE_POOL_* settings. Under ASGI every request runs its sync view
+    on a new thread, so persistent connections are opened per request too.
+    Connections here are local and without TLS, so opening one costs far
+    less than it does against a remote server.
+    """
+    created = seed_community(users=max(1, size // 10), posts=size, comments=size * 5, likes=size * 10)
+    report.write('Seeded ' + ', '.join(f'{count} {name}' for name, count in created.items()))
+
+    modes = {
+        'connection per request': (0, None),
+        'persistent per thread': (600, None),
+    }
+    if connection.vendor == 'postgresql':
+        modes['pool'] = (0, {
+            'min_size': settings.DATABASE_POOL_MIN_SIZE,
+            'max_size': settings.DATABASE_POOL_MAX_SIZE,
+            'timeout': settings.DATABASE_POOL_TIMEOUT,
+        })
+    else:
+        report.write(f'Pooling needs PostgreSQL, not {connection.vendor}; pool runs skipped')
+
+    original = connection.settings_dict['CONN_MAX_AGE'], connection.settings_dict['OPTIONS'].get('pool')
+    try:
+        for concurrency in concurrency_levels:
+            report.write(f'{concurrency} concurrent clients')
+            for server, load in (('WSGI', wsgi_load), ('ASGI', asgi_load)):
+                for mode, (max_age, pool) in modes.items():
+                    set_connection_mode(max_age, pool)
+                    opened = ConnectionCounter()
+                    connection_created.connect(opened)
+                    try:
+                        stats = load('/api/posts/', '', repeat, concurrency)
+                    finally:
+                        connection_created.disconnect(opened)
+                    if pool is None:
+                        stats['connections_opened'] = opened.count
+                    else:
+                        # connection_created fires on every checkout here
+                        pool_stats = connection.pool.get_stats()
+                        stats['connections_opened'] = pool_stats.get('connections_num', 0)
+                        stats['checkout_wait_ms'] = (
+                            pool_stats.get('requests_wait_ms', 0) / max(1, pool_stats.get('requests_num', 0))
+                        )
+                    report.record(f'{server}, {mode}', stats)
+    finally:
+        set_connection_mode(*original)
+
+
+class StreamClient:
+    """One client of the event stream, driven through the ASGI handler."""
+
+    def __init__(self, handler, path='/api/events/'):
+        self.handler = handler
+        self.path = path
+        self.connected = asyncio.Event()
+        self.received = asyncio.Event()
+        self.received_at = None
+        self.disconnected = asyncio.Event()
+
+    async def run(self):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': self.path,
+            'raw_path': self.path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'localhost'), (b'accept', b'text/event-stream')],
+            'client': ('127.0.0.1', 0),
+            'server': ('localhost', 80),
+        }
+        body_read = False
+
+        async def receive():
+            nonlocal body_read
+            if not body_read:
+                body_read = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await self.disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] != 'http.response.body':
+                return
+            if message['body'].startswith(b'retry:'):
+                self.connected.set()
+            elif message['body'].startswith(b'event:'):
+                self.received_at = time.perf_counter()
+                self.received.set()
+
+        await self.handler(scope, receive, send)
+
+    def expect(self):
+        self.received.clear()
+        self.received_at = None
+
+
+@scenario('sse-fanout', default_size=2_000, default_repeat=20)
+def sse_fanout(size, repeat, report):
+    """
+    ``size`` clients holding /api/events/ open on one process, each of
+    ``repeat`` events published from a worker thread and fanned out to all
+    of them.
+    """
+    handler = ASGIHandler()
+    broker = events.get_broker()
+    event = events.Event(
+        events.LIKE, {'type': 'post', 'id': 1, 'post_id': 1, 'delta': 1}, post_id=1
+    )
+
+    async def run():
+        threads_before = threading.active_count()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        clients = [StreamClient(handler) for _ in range(size)]
+
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(client.run()) for client in clients]
+        await asyncio.gather(*(client.connected.wait() for client in clients))
+        connected = {
+            'connect_s': time.perf_counter() - start,
+            'threads': threading.active_count() - threads_before,
+            'rss_kib_per_client': (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+            ) / size,
+        }
+        assert broker.subscriber_count() == size
+
+        latencies = []
+        fanouts = []
+        for _ in range(repeat):
+            for client in clients:
+                client.expect()
+            published = time.perf_counter()
+            await asyncio.to_thread(broker.publish, event)
+            await asyncio.gather(*(client.received.wait() for client in clients))
+            arrivals = [(client.received_at - published) * 1000 for client in clients]
+            latencies += arrivals
+            fanouts.append(max(arrivals))
+
+        for client in clients:
+            client.disconnected.set()
+        await asyncio.gather(*tasks)
+        assert broker.subscriber_count() == 0
+        return connected, latencies, fanouts
+
+    connected, latencies, fanouts = asyncio.run(run())
+    report.record(f'{size} clients connected', connected)
+    report.record('delivery latency per client', {
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    })
+    report.record('time to reach every client', {
+        'p50_ms': percentile(fanouts, 50),
+        'p99_ms': percentile(fanouts, 99),
+    })
+    report.write(f'  {size * repeat / (sum(fanouts) / 1000):,.0f} deliveries/s')
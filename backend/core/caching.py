@@ -0,0 +1,160 @@
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name, outcome):
+    with _stats_lock:
+        _stats[(name, outcome)] += 1
+
+
+def cache_stats():
+    """Hit/miss counters of this process, as {name: {'hit': n, 'miss': n}}."""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    stats = {}
+    for (name, outcome), count in snapshot.items():
+        stats.setdefault(name, {'hit': 0, 'miss': 0})[outcome] = count
+    return stats
+
+
+def get_or_compute(name, key, compute, timeout):
+    """Read-through lookup of ``key``, counted under ``name``."""
+    value = cache.get(key)
+    if value is not None:
+        _count(name, 'hit')
+        return value
+
+    _count(name, 'miss')
+    value = compute()
+    cache.set(key, value, timeout)
+    return value
+
+
+async def aget_or_compute(name, key, compute, timeout):
+    """Async version of get_or_compute; ``compute`` is a coroutine function."""
+    value = await cache.aget(key)
+    if value is not None:
+        _count(name, 'hit')
+        return value
+
+    _count(name, 'miss')
+    value = await compute()
+    await cache.aset(key, value, timeout)
+    return value
+
+
+FEED_VERSION_KEY = 'feed-version'
+HOT_FEED_VERSION_KEY = 'hot-feed-version'
+
+
+def _post_version_key(post_id):
+    return f'post-version:{post_id}'
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Seed from the clock rather than 1: if the version key is evicted,
+        # the reseeded value can never point back at a stale cache entry or
+        # match an ETag a client already holds
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+async def _aget_version(key):
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns(), timeout=None)
+        version = await cache.aget(key)
+    return version
+
+
+def _bump_version_on_commit(key):
+    """
+    Bump a version once the current transaction commits, so cached data is
+    never refreshed from data that is about to change.
+    """
+    def bump():
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Missing key: the next read reseeds a fresh version anyway
+            pass
+
+    transaction.on_commit(bump)
+
+
+def get_post_version(post_id):
+    """Changes whenever anything shown on the post's detail page changes."""
+    return _get_version(_post_version_key(post_id))
+
+
+async def aget_post_version(post_id):
+    return await _aget_version(_post_version_key(post_id))
+
+
+def invalidate_post(post_id):
+    _bump_version_on_commit(_post_version_key(post_id))
+
+
+def get_feed_version():
+    """Changes whenever a post is created or a post's like or comment count changes."""
+    return _get_version(FEED_VERSION_KEY)
+
+
+async def aget_feed_version():
+    return await _aget_version(FEED_VERSION_KEY)
+
+
+def invalidate_feed():
+    # Whatever changes the feed's posts also changes the hot feed
+    _bump_version_on_commit(FEED_VERSION_KEY)
+    _bump_version_on_commit(HOT_FEED_VERSION_KEY)
+
+
+def get_hot_feed_version():
+    """Like get_feed_version, but also changes with each hot score decay run."""
+    return _get_version(HOT_FEED_VERSION_KEY)
+
+
+async def aget_hot_feed_version():
+    return await _aget_version(HOT_FEED_VERSION_KEY)
+
+
+def invalidate_hot_feed():
+    _bump_version_on_commit(HOT_FEED_VERSION_KEY)
+
+
+def _post_detail_key(post_id, version):
+    # Holds (post data, comment rows) as PostDetailView.serialize returns
+    # them; the name changed with that shape, from nested comment data
+    return f'post-detail-rows:{post_id}:{version}'
+
+
+def get_post_detail(post_id, compute):
+    key = _post_detail_key(post_id, get_post_version(post_id))
+    return get_or_compute('post_detail', key, compute, settings.POST_DETAIL_CACHE_TTL)
+
+
+def get_leaderboard(compute):
+    return get_or_compute('leaderboard', 'leaderboard', compute, settings.LEADERBOARD_CACHE_TTL)
+
+
+async def aget_post_detail(post_id, compute):
+    key = _post_detail_key(post_id, await aget_post_version(post_id))
+    return await aget_or_compute('post_detail', key, compute, settings.POST_DETAIL_CACHE_TTL)
+
+
+async def aget_leaderboard(compute):
+    return await aget_or_compute(
+        'leaderboard', 'leaderboard', compute, settings.LEADERBOARD_CACHE_TTL
+    )
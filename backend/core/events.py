@@ -0,0 +1,262 @@
+"""
+Publish/subscribe for the live event stream at /api/events/.
+
+core.services and the create views publish events once their transaction
+commits, and every open stream holds a Subscription. The broker between
+them is pluggable through settings.EVENTS_BROKER: LocalBroker delivers
+within this process, RedisBroker fans out over Redis pub/sub to every
+process that serves streams.
+
+Subscriptions live on event loops, publishers may run on any thread, so
+an event crosses into each loop with a single call_soon_threadsafe and
+is encoded once, however many streams it reaches.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from functools import cached_property
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from rest_framework.utils.encoders import JSONEncoder
+
+logger = logging.getLogger(__name__)
+
+POST_CREATED = 'post_created'
+COMMENT_CREATED = 'comment_created'
+LIKE = 'like'
+LEADERBOARD = 'leaderboard'
+# Internal: makes each stream-serving loop refresh its leaderboard
+KARMA = 'karma'
+
+
+class Event:
+    def __init__(self, type, data=None, post_id=None):
+        self.type = type
+        self.data = data
+        # The post the event belongs to, for streams following one post
+        self.post_id = post_id
+
+    @cached_property
+    def encoded(self):
+        """The event in the text/event-stream format."""
+        data = json.dumps(self.data, cls=JSONEncoder, separators=(',', ':'))
+        return f'event: {self.type}\ndata: {data}\n\n'.encode()
+
+    def to_json(self):
+        return json.dumps(
+            {'type': self.type, 'data': self.data, 'post_id': self.post_id},
+            cls=JSONEncoder,
+        )
+
+    @classmethod
+    def from_json(cls, raw):
+        return cls(**json.loads(raw))
+
+
+class StreamOverflow(Exception):
+    """The subscriber fell too far behind and missed events."""
+
+
+class Subscription:
+    def __init__(self, broker, post_id=None):
+        self.broker = broker
+        self.loop = asyncio.get_running_loop()
+        self.post_id = post_id
+        self.pending = deque()
+        self.overflowed = False
+        self.ready = asyncio.Event()
+
+    def wants(self, event):
+        if event.type == KARMA:
+            return False
+        return self.post_id is None or event.post_id in (None, self.post_id)
+
+    def deliver(self, event):
+        # Runs on self.loop
+        if len(self.pending) >= settings.EVENTS_MAX_PENDING:
+            self.overflowed = True
+        else:
+            self.pending.append(event)
+        self.ready.set()
+
+    async def get(self):
+        """
+        The next event. Raises StreamOverflow once events were dropped, so
+        the client reconnects and reloads instead of showing stale counts.
+        """
+        while not self.pending:
+            if self.overflowed:
+                raise StreamOverflow
+            self.ready.clear()
+            await self.ready.wait()
+        if self.overflowed:
+            raise StreamOverflow
+        return self.pending.popleft()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class _LoopState:
+    def __init__(self):
+        self.subscriptions = set()
+        self.leaderboard_refresh = None
+        self.leaderboard = None
+
+
+class LocalBroker:
+    """Delivers events to the subscriptions of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loops = {}
+
+    def subscribe(self, post_id=None):
+        subscription = Subscription(self, post_id)
+        with self._lock:
+            state = self._loops.setdefault(subscription.loop, _LoopState())
+            state.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            state = self._loops.get(subscription.loop)
+            if state is None:
+                return
+            state.subscriptions.discard(subscription)
+            if not state.subscriptions:
+                if state.leaderboard_refresh is not None:
+                    state.leaderboard_refresh.cancel()
+                del self._loops[subscription.loop]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(state.subscriptions) for state in self._loops.values())
+
+    def publish(self, event):
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        with self._lock:
+            loops = list(self._loops)
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._deliver, loop, event)
+            except RuntimeError:
+                # The loop was closed under its last subscribers
+                pass
+
+    def _deliver(self, loop, event):
+        with self._lock:
+            state = self._loops.get(loop)
+            subscriptions = list(state.subscriptions) if state else []
+        if not subscriptions:
+            return
+
+        if event.type == KARMA:
+            if state.leaderboard_refresh is None:
+                state.leaderboard_refresh = loop.create_task(self._refresh_leaderboard(loop, state))
+            return
+
+        for subscription in subscriptions:
+            if subscription.wants(event):
+                subscription.deliver(event)
+
+    async def _refresh_leaderboard(self, loop, state):
+        """
+        Recompute the leaderboard at most once per EVENTS_LEADERBOARD_INTERVAL
+        per loop, however many likes arrive meanwhile, and push it only when
+        it actually changed.
+        """
+        from core.services import aget_top_users
+
+        try:
+            await asyncio.sleep(settings.EVENTS_LEADERBOARD_INTERVAL)
+            state.leaderboard_refresh = None
+            leaders = await aget_top_users()
+            await sync_to_async(close_old_connections)()
+        except Exception:
+            state.leaderboard_refresh = None
+            logger.exception("Leaderboard refresh failed")
+            return
+
+        if leaders != state.leaderboard:
+            state.leaderboard = leaders
+            self._deliver(loop, Event(LEADERBOARD, leaders))
+
+
+class RedisBroker(LocalBroker):
+    """
+    Publishes through a Redis channel. Each process listens on it from one
+    background thread, which hands events to its local subscriptions.
+    """
+    channel = 'core-events'
+
+    def __init__(self):
+        super().__init__()
+        import redis
+
+        self._redis = redis.Redis.from_url(settings.EVENTS_REDIS_URL)
+        self._listener = None
+
+    def publish(self, event):
+        self._redis.publish(self.channel, event.to_json())
+
+    def subscribe(self, post_id=None):
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+        return super().subscribe(post_id)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    self.dispatch(Event.from_json(message['data']))
+            except Exception:
+                logger.exception("Lost the events channel, reconnecting")
+                time.sleep(1)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.EVENTS_BROKER)()
+    return _broker
+
+
+def publish(type, data=None, post_id=None):
+    """
+    Publish an event once the current transaction commits. Events are best
+    effort: the data is committed by then, so a broker failure is logged
+    rather than failing the request, which the client would retry.
+    """
+    event = Event(type, data, post_id)
+
+    def send():
+        try:
+            get_broker().publish(event)
+        except Exception:
+            logger.exception("Publishing a %s event failed", event.type)
+
+    transaction.on_commit(send)
+
+
+def subscribe(post_id=None):
+    """Subscribe the running event loop; close the subscription when done."""
+    return get_broker().subscribe(post_id)
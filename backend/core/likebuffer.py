@@ -0,0 +1,353 @@
+"""
+Write-behind buffering of like toggles, enabled by LIKE_BUFFER_ENABLED.
+
+Every direct toggle takes a lock on its target's counter row and writes a
+Like and a KarmaTransaction, so a viral post serializes all of its likers
+on one row. In buffered mode a toggle only records the liker's desired
+state in this process and answers at once; repeated toggles of the same
+(user, target) collapse into that single state (like, unlike, like is one
+like), and a background thread hands everything pending to
+apply_like_states every LIKE_BUFFER_FLUSH_INTERVAL seconds, or sooner once
+LIKE_BUFFER_MAX_PENDING toggles are waiting. A hot post then gets one
+counter update per flush instead of one per like.
+
+Reads stay consistent by merging the net pending change of each target
+into the like counts they return (see merge_pending_likes), and the
+reader's own pending toggles into their liked_by_me flags (see
+mark_liked_by_me).
+
+Durability: a toggle is acknowledged before it is written. Toggles still
+pending when the process dies are lost, up to one flush interval's worth
+(a clean exit flushes first). A flush that fails keeps its toggles for the
+next one, unless only some users' toggles fail, which are dropped. Pending
+state is per process, so other processes see a toggle only once it is
+flushed.
+"""
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Exists, OuterRef
+
+from core.models import Comment, Like, Post
+from core.services import aget_liked_ids, apply_like_states, get_liked_ids
+
+logger = logging.getLogger(__name__)
+
+
+class PendingLike:
+    __slots__ = ('liked', 'base', 'post_id')
+
+    def __init__(self, base, post_id):
+        # ``base`` is the stored state the toggle started from
+        self.liked = base
+        self.base = base
+        self.post_id = post_id
+
+    @property
+    def delta(self):
+        return int(self.liked) - int(self.base)
+
+
+class LikeBuffer:
+    """
+    Pending like states of this process, keyed by (user_id, kind,
+    target_id). ``flush_interval`` of 0 disables the background flusher,
+    leaving flushes to the caller.
+    """
+
+    def __init__(self, flush_interval, max_pending):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        # Toggles being written by the running flush
+        self._flushing = {}
+        # Net pending change per (kind, target_id), for reads
+        self._deltas = {}
+        # Grows with every buffered toggle; part of the read ETags
+        self.revision = 0
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    def toggle(self, user, kind, target_id):
+        """
+        Flip ``user``'s like on a post or comment and return the new state.
+        Raises DoesNotExist for a missing target, like like_post does.
+        """
+        key = (user.id, kind, target_id)
+        stored = None
+        while True:
+            with self._lock:
+                entry = self._pending.get(key)
+                if entry is None:
+                    flushing = self._flushing.get(key)
+                    if flushing is not None:
+                        # Starts from what the running flush is writing
+                        entry = PendingLike(flushing.liked, flushing.post_id)
+                    elif stored is not None:
+                        entry = PendingLike(*stored)
+                if entry is not None:
+                    self._pending[key] = entry
+                    entry.liked = not entry.liked
+                    target = (kind, target_id)
+                    self._deltas[target] = self._deltas.get(target, 0) + (1 if entry.liked else -1)
+                    self.revision += 1
+                    full = len(self._pending) >= self.max_pending
+                    break
+            # The first toggle in a flush window reads the stored state;
+            # later ones are answered from memory
+            stored = self._read_stored(user, kind, target_id)
+
+        self._start_flusher()
+        if full:
+            self._wakeup.set()
+        return entry.liked
+
+    def _read_stored(self, user, kind, target_id):
+        """(liked, post_id) of ``user`` and the target, as stored."""
+        model = Post if kind == 'post' else Comment
+        return (
+            model.objects
+            .filter(id=target_id)
+            .annotate(liked=Exists(Like.objects.filter(user=user, **{kind: OuterRef('pk')})))
+            .values_list('liked', 'id' if kind == 'post' else 'post_id')
+            .get()
+        )
+
+    def pending_delta(self, kind, target_id):
+        return self._deltas.get((kind, target_id), 0)
+
+    def pending_state(self, user_id, kind, target_id):
+        """``user_id``'s unwritten like state of a target, or None."""
+        key = (user_id, kind, target_id)
+        entry = self._pending.get(key) or self._flushing.get(key)
+        return None if entry is None else entry.liked
+
+    def has_pending_changes(self):
+        return bool(self._deltas)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Write every pending toggle in one transaction and return how many
+        (user, target) states were written. Toggles made meanwhile wait for
+        the next flush.
+
+        When the batch fails, each user's toggles are retried in a
+        transaction of their own, so one user whose toggles can never be
+        written (say, one deleted before the flush) does not hold back the
+        rest. Toggles that fail while others are written are dropped; when
+        nothing can be written, everything is kept for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+            if not batch:
+                return 0
+
+            try:
+                try:
+                    apply_like_states(_like_states(batch))
+                    failed = {}
+                except Exception:
+                    failed = self._apply_per_user(batch)
+                    if len(failed) == len(batch):
+                        raise
+            except BaseException:
+                with self._lock:
+                    # Nothing was written: newer toggles of the same key
+                    # still start from the stored state
+                    for key, entry in batch.items():
+                        newer = self._pending.setdefault(key, entry)
+                        newer.base = entry.base
+                    self._flushing = {}
+                    self._recount_deltas()
+                raise
+
+            with self._lock:
+                self._flushing = {}
+                if failed:
+                    for key, entry in failed.items():
+                        if key in self._pending:
+                            self._pending[key].base = entry.base
+                    self._recount_deltas()
+                else:
+                    for (_, kind, target_id), entry in batch.items():
+                        target = (kind, target_id)
+                        delta = self._deltas.get(target, 0) - entry.delta
+                        if delta:
+                            self._deltas[target] = delta
+                        else:
+                            self._deltas.pop(target, None)
+            return len(batch) - len(failed)
+
+    def _apply_per_user(self, batch):
+        """Write ``batch`` one user at a time; returns the toggles that failed."""
+        by_user = defaultdict(dict)
+        for key, entry in batch.items():
+            by_user[key[0]][key] = entry
+
+        failed = {}
+        for user_id, toggles in by_user.items():
+            try:
+                apply_like_states(_like_states(toggles))
+            except Exception:
+                logger.exception("Writing the buffered likes of user %s failed", user_id)
+                failed.update(toggles)
+        if failed and len(failed) < len(batch):
+            logger.error("Dropped %d buffered likes that could not be written", len(failed))
+        return failed
+
+    def discard(self):
+        """Drop every pending toggle, as a crash would."""
+        with self._lock:
+            self._pending = {}
+            self._recount_deltas()
+
+    def _recount_deltas(self):
+        deltas = {}
+        for (_, kind, target_id), entry in [*self._flushing.items(), *self._pending.items()]:
+            deltas[kind, target_id] = deltas.get((kind, target_id), 0) + entry.delta
+        self._deltas = deltas
+
+    def _start_flusher(self):
+        if not self.flush_interval or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, daemon=True)
+                self._flusher.start()
+                atexit.register(self._flush_safely)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush_safely()
+
+    def _flush_safely(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing buffered likes failed, retrying with the next flush")
+        finally:
+            close_old_connections()
+
+
+def _like_states(toggles):
+    return {key: entry.liked for key, entry in toggles.items()}
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_like_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = LikeBuffer(
+                    settings.LIKE_BUFFER_FLUSH_INTERVAL, settings.LIKE_BUFFER_MAX_PENDING
+                )
+    return _buffer
+
+
+def _liked_items(data):
+    """
+    (kind, item) for every serialized post and comment in ``data``: a post,
+    a comment, or lists and pages of them. Comments are told apart from
+    posts by their ``replies``, or the ``post`` of search results.
+    """
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, dict):
+            if 'like_count' in item:
+                yield ('comment' if 'replies' in item or 'post' in item else 'post'), item
+            for key in ('results', 'comments', 'replies'):
+                if isinstance(item.get(key), list):
+                    stack.append(item[key])
+
+
+def merge_pending_likes(data):
+    """
+    Add pending like changes to the ``like_count`` of every post and
+    comment in serialized ``data``.
+    """
+    if not settings.LIKE_BUFFER_ENABLED:
+        return data
+    buffer = get_like_buffer()
+    if not buffer.has_pending_changes():
+        return data
+
+    for kind, item in _liked_items(data):
+        item['like_count'] += buffer.pending_delta(kind, item['id'])
+    return data
+
+
+class LikedTargets:
+    """
+    The (kind, id) targets a user likes, as stored and, with the like
+    buffer enabled, as toggled since.
+    """
+
+    def __init__(self, user, stored):
+        self.user_id = user.id
+        self.stored = stored
+        self.buffer = get_like_buffer() if settings.LIKE_BUFFER_ENABLED else None
+
+    def __contains__(self, target):
+        if self.buffer is not None:
+            pending = self.buffer.pending_state(self.user_id, *target)
+            if pending is not None:
+                return pending
+        return target in self.stored
+
+
+def get_liked_targets(user, post_ids=(), comment_ids=()):
+    return LikedTargets(user, get_liked_ids(user, post_ids, comment_ids))
+
+
+async def aget_liked_targets(user, post_ids=(), comment_ids=()):
+    return LikedTargets(user, await aget_liked_ids(user, post_ids, comment_ids))
+
+
+def _mark_liked(items, liked):
+    for kind, item in items:
+        item['liked_by_me'] = (kind, item['id']) in liked
+
+
+def _liked_item_ids(items):
+    ids = {'post': [], 'comment': []}
+    for kind, item in items:
+        ids[kind].append(item['id'])
+    return ids['post'], ids['comment']
+
+
+def mark_liked_by_me(data, user):
+    """
+    Set ``liked_by_me`` on every post and comment in serialized ``data``,
+    with one query for all of them. Serializers leave the flag out because
+    their output is cached and shared between readers.
+    """
+    items = list(_liked_items(data))
+    _mark_liked(items, get_liked_targets(user, *_liked_item_ids(items)))
+    return data
+
+
+async def amark_liked_by_me(data, user):
+    items = list(_liked_items(data))
+    _mark_liked(items, await aget_liked_targets(user, *_liked_item_ids(items)))
+    return data
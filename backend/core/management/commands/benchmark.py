@@ -0,0 +1,78 @@
+import json
+import os
+import platform
+import tempfile
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from core.benchmarks import SCENARIOS, Report
+
+
+class Command(BaseCommand):
+    help = "Run a benchmark scenario against a throwaway test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument(
+            '--size',
+            type=int,
+            help="Dataset size (defaults to the scenario's own default).",
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            help="Runs per measurement (defaults to the scenario's own default).",
+        )
+        parser.add_argument(
+            '--json',
+            metavar='PATH',
+            help="Also save the results as JSON to PATH, for comparing runs.",
+        )
+
+    def handle(self, *args, **options):
+        bench = SCENARIOS[options['scenario']]
+        size = options['size'] or bench.default_size
+        repeat = options['repeat'] or bench.default_repeat
+        if repeat < 1:
+            raise CommandError("--repeat must be at least 1")
+
+        if connection.vendor == 'sqlite':
+            # On disk, so threaded scenarios can open their own connections,
+            # and with IMMEDIATE transactions and a generous busy timeout so
+            # concurrent writers queue instead of failing with "database is
+            # locked" (the 5 s default runs out on slow disks)
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                tempfile.gettempdir(), 'core-benchmark.sqlite3'
+            )
+            connection.settings_dict['OPTIONS']['transaction_mode'] = 'IMMEDIATE'
+            connection.settings_dict['OPTIONS'].setdefault('timeout', 60)
+
+        report = Report(self.stdout.write)
+        started_at = timezone.now()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report.write(f"{options['scenario']} (size={size}, repeat={repeat})")
+            bench(size, repeat, report)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({
+                    'scenario': options['scenario'],
+                    'size': size,
+                    'repeat': repeat,
+                    'started_at': started_at.isoformat(),
+                    'environment': {
+                        'database': connection.vendor,
+                        'python': platform.python_version(),
+                        'django': django.get_version(),
+                    },
+                    'results': report.results,
+                    'output': report.lines,
+                }, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Saved results to {options['json']}"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import check_karma
+
+
+class Command(BaseCommand):
+    help = "Compare materialized karma totals and hourly buckets with the KarmaTransaction ledger."
+
+    def handle(self, *args, **options):
+        mismatches = check_karma()
+        for kind, key, stored, expected in mismatches:
+            self.stdout.write(f"{kind} {key}: stored {stored}, ledger {expected}")
+
+        if mismatches:
+            raise CommandError(
+                f"{len(mismatches)} karma mismatches; run 'manage.py rebuild_karma' to repair"
+            )
+        self.stdout.write(self.style.SUCCESS("Karma totals match the ledger"))
@@ -0,0 +1,71 @@
+import csv
+from collections import defaultdict
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.services import compact_karma, prune_karma_buckets
+
+
+class MonthlyCsvArchive:
+    """
+    Appends compacted ledger rows to one CSV file per month of their
+    creation. A batch is written before its transaction commits, so a
+    failed batch can appear twice once it is retried.
+    """
+    fields = ['id', 'user_id', 'points', 'created_at', 'post_id', 'comment_id', 'like_id']
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __call__(self, rows):
+        months = defaultdict(list)
+        for row in rows:
+            months[row['created_at'].strftime('%Y-%m')].append(row)
+
+        for month, month_rows in months.items():
+            path = self.directory / f'karma-{month}.csv'
+            new = not path.exists()
+            with path.open('a', newline='') as file:
+                writer = csv.DictWriter(file, self.fields)
+                if new:
+                    writer.writeheader()
+                writer.writerows(
+                    {**row, 'created_at': row['created_at'].isoformat()} for row in month_rows
+                )
+
+
+class Command(BaseCommand):
+    help = (
+        "Roll old KarmaTransaction rows into per-user daily summaries and delete them, "
+        "and delete hourly karma buckets outside the leaderboard window."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.KARMA_COMPACTION_HORIZON_DAYS,
+            help="Keep this many days of ledger rows raw.",
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--archive-dir',
+            help="Also write the compacted rows to monthly CSV files in this directory.",
+        )
+
+    def handle(self, *args, **options):
+        archive = MonthlyCsvArchive(options['archive_dir']) if options['archive_dir'] else None
+        try:
+            compacted = compact_karma(
+                horizon=timedelta(days=options['days']),
+                batch_size=options['batch_size'],
+                archive=archive,
+            )
+        except ValueError as exc:
+            raise CommandError(exc)
+        pruned = prune_karma_buckets()
+        self.stdout.write(self.style.SUCCESS(
+            f"Compacted {compacted} ledger rows, pruned {pruned} karma buckets"
+        ))
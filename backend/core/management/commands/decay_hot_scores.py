@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.ranking import decay_hot_scores
+
+
+class Command(BaseCommand):
+    help = "Recompute the hot scores of recent posts at their current age; run every few minutes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rescored = decay_hot_scores(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rescored {rescored} posts"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.services import rebuild_karma
+
+
+class Command(BaseCommand):
+    help = "Rebuild materialized karma totals and hourly buckets from the KarmaTransaction ledger."
+
+    def handle(self, *args, **options):
+        rebuild_karma()
+        self.stdout.write(self.style.SUCCESS("Rebuilt karma totals and buckets"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core.services import repair_comment_summaries, repair_like_counts
+
+
+class Command(BaseCommand):
+    help = "Recompute denormalized counters on Post and Comment from their source tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        likes = repair_like_counts(batch_size=options['batch_size'])
+        comments = repair_comment_summaries(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Repaired {likes} like counts and {comments} post comment summaries"
+        ))
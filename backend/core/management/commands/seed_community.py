@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.seeding import seed_community
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a synthetic community: users, posts, "
+        "Zipf-distributed threaded comments, likes and the karma they earn."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1_000)
+        parser.add_argument('--posts', type=int, default=10_000)
+        parser.add_argument('--comments', type=int, default=100_000)
+        parser.add_argument('--likes', type=int, default=200_000)
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help="Spread posts over this many days up to now.",
+        )
+        parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+
+    def handle(self, *args, **options):
+        if options['users'] < 1:
+            raise CommandError("--users must be at least 1")
+        if min(options['posts'], options['comments'], options['likes'], options['days']) < 0:
+            raise CommandError("Counts and --days cannot be negative")
+
+        created = seed_community(
+            users=options['users'],
+            posts=options['posts'],
+            comments=options['comments'],
+            likes=options['likes'],
+            days=options['days'],
+            seed=options['seed'],
+        )
+        summary = ", ".join(f"{count} {name}" for name, count in created.items())
+        self.stdout.write(self.style.SUCCESS(f"Created {summary}"))
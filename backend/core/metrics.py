@@ -0,0 +1,131 @@
+"""
+In-process request metrics, exported in the Prometheus text format.
+
+Every worker process keeps its own histograms and database connection
+pools; scrape each worker (or sum across them) to get the full picture.
+"""
+import threading
+from bisect import bisect_left
+
+from django.db import connections
+
+from core.caching import cache_stats
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+HISTOGRAMS = {
+    'core_request_duration_seconds': ('Total time spent handling a request.', SECONDS_BUCKETS),
+    'core_db_duration_seconds': ('Time spent executing SQL per request.', SECONDS_BUCKETS),
+    'core_serialize_duration_seconds': ('Time spent rendering the response body per request.', SECONDS_BUCKETS),
+    'core_db_queries': ('SQL queries executed per request.', QUERY_BUCKETS),
+}
+
+# Read from psycopg_pool's ConnectionPool.get_stats() at scrape time, per
+# database; counters there only appear once they are non-zero
+POOL_METRICS = (
+    ('core_db_pool_connections', 'gauge', 'Connections open in the pool.',
+     lambda stats: stats.get('pool_size', 0)),
+    ('core_db_pool_connections_in_use', 'gauge', 'Pool connections checked out by requests.',
+     lambda stats: stats.get('pool_size', 0) - stats.get('pool_available', 0)),
+    ('core_db_pool_requests_waiting', 'gauge', 'Requests waiting for a free connection.',
+     lambda stats: stats.get('requests_waiting', 0)),
+    ('core_db_pool_checkouts_total', 'counter', 'Connections checked out of the pool.',
+     lambda stats: stats.get('requests_num', 0)),
+    ('core_db_pool_checkout_wait_seconds_total', 'counter',
+     'Time checkouts spent waiting for a free connection.',
+     lambda stats: stats.get('requests_wait_ms', 0) / 1000),
+    ('core_db_pool_checkout_errors_total', 'counter', 'Checkouts that failed, e.g. timed out.',
+     lambda stats: stats.get('requests_errors', 0)),
+    ('core_db_pool_connections_opened_total', 'counter', 'Connections the pool opened.',
+     lambda stats: stats.get('connections_num', 0)),
+    ('core_db_pool_connections_lost_total', 'counter',
+     'Connections found broken by the health check.',
+     lambda stats: stats.get('connections_lost', 0)),
+)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; made cumulative on export
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_histograms = {name: {} for name in HISTOGRAMS}
+
+
+def observe(name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _histograms[name]
+        if key not in series:
+            series[key] = Histogram(HISTOGRAMS[name][1])
+        series[key].observe(value)
+
+
+def reset():
+    with _lock:
+        for series in _histograms.values():
+            series.clear()
+
+
+def pool_stats():
+    """(alias, stats) of each database connection pool of this process."""
+    for alias in connections:
+        # Only PostgreSQL connections have a pool, and only when configured
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None:
+            yield alias, pool.get_stats()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels
+    )
+    return '{' + pairs + '}'
+
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        for name, (help_text, _) in HISTOGRAMS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in sorted(_histograms[name].items()):
+                cumulative = 0
+                bounds = [*histogram.buckets, '+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    bucket_labels = _format_labels([*labels, ('le', bound)])
+                    lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+    lines.append('# HELP core_cache_requests_total Read-through cache lookups.')
+    lines.append('# TYPE core_cache_requests_total counter')
+    for cache_name, outcomes in sorted(cache_stats().items()):
+        for outcome, count in sorted(outcomes.items()):
+            labels = _format_labels([('cache', cache_name), ('result', outcome)])
+            lines.append(f'core_cache_requests_total{labels} {count}')
+
+    pools = list(pool_stats())
+    if pools:
+        for name, kind, help_text, value in POOL_METRICS:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for alias, stats in pools:
+                lines.append(f'{name}{_format_labels([("database", alias)])} {value(stats)}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,172 @@
+import time
+from contextlib import ExitStack, contextmanager, nullcontext
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from core import metrics
+from core.routing import STICKY_COOKIE
+
+
+class RequestMetrics:
+    """Timings of one request, collected by MetricsMiddleware."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self._render_started = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # Installed as a database execute wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+
+    def render_started(self):
+        self._render_started = time.perf_counter()
+
+    def render_finished(self, response):
+        self.serialize_time += time.perf_counter() - self._render_started
+
+    @contextmanager
+    def rendering(self):
+        self.render_started()
+        try:
+            yield
+        finally:
+            self.render_finished(None)
+
+
+def measure_render(request):
+    """
+    Count the time spent in the block as rendering ``request``'s response,
+    for views that encode their own HttpResponse instead of letting DRF
+    render one.
+    """
+    stats = getattr(request, '_metrics', None)
+    return nullcontext() if stats is None else stats.rendering()
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view = getattr(match.func, 'view_class', match.func)
+    return view.__name__
+
+
+def install_execute_wrapper(wrapper):
+    """Wrap every database connection of the current thread."""
+    stack = ExitStack()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(wrapper))
+    return stack
+
+
+class MetricsMiddleware:
+    """
+    Records per-request SQL query count, SQL time, response rendering time
+    and total time into core.metrics histograms labelled by view class, and
+    optionally reports them in a Server-Timing header.
+
+    Rendering covers DRF responses and the blocks views wrap in
+    measure_render. Streamed bodies are encoded after the response leaves
+    the middleware, so their rendering (and the queries it runs) is not
+    counted.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        request._metrics = stats = RequestMetrics()
+        start = time.perf_counter()
+        with install_execute_wrapper(stats):
+            response = self.get_response(request)
+        return self.record(request, response, stats, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        request._metrics = stats = RequestMetrics()
+        start = time.perf_counter()
+        # Connections are per thread; under ASGI the async ORM runs every
+        # query of a request on that request's sync thread
+        stack = await sync_to_async(install_execute_wrapper)(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self.record(request, response, stats, time.perf_counter() - start)
+
+    def record(self, request, response, stats, total):
+        view = get_view_name(request)
+        metrics.observe('core_request_duration_seconds', total, view=view)
+        metrics.observe('core_db_duration_seconds', stats.db_time, view=view)
+        metrics.observe('core_serialize_duration_seconds', stats.serialize_time, view=view)
+        metrics.observe('core_db_queries', stats.queries, view=view)
+
+        if settings.METRICS_SERVER_TIMING:
+            response['Server-Timing'] = ', '.join([
+                f'db;desc="{stats.queries} queries";dur={stats.db_time * 1000:.1f}',
+                f'serialize;dur={stats.serialize_time * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ])
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook returns
+        stats = request._metrics
+        stats.render_started()
+        response.add_post_render_callback(stats.render_finished)
+        return response
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Sends a client's reads to the primary for REPLICA_STICKY_SECONDS after
+    each of its successful writes, so it reads its own writes back even
+    while the replica lags (see core.routing).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if (
+            settings.REPLICA_DATABASE is not None
+            and request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+            and response.status_code < 400
+        ):
+            # Travels wherever the session cookie does
+            response.set_cookie(
+                STICKY_COOKIE,
+                '1',
+                max_age=settings.REPLICA_STICKY_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        return response
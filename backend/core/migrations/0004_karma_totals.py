@@ -0,0 +1,74 @@
+# Generated by Django 5.1.1 on 2026-02-04 14:27
+
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+
+def backfill_karma(apps, schema_editor):
+    KarmaTransaction = apps.get_model('core', 'KarmaTransaction')
+    KarmaTotal = apps.get_model('core', 'KarmaTotal')
+    KarmaBucket = apps.get_model('core', 'KarmaBucket')
+
+    KarmaTotal.objects.bulk_create(
+        KarmaTotal(user_id=row['user'], points=row['points'])
+        for row in (
+            KarmaTransaction.objects
+            .values('user')
+            .annotate(points=Sum('points'))
+        )
+    )
+
+    # Only the buckets the rolling 24h leaderboard can still see
+    since = (timezone.now() - timedelta(hours=24)).replace(minute=0, second=0, microsecond=0)
+    KarmaBucket.objects.bulk_create(
+        KarmaBucket(user_id=row['user'], hour=row['hour'], points=row['points'])
+        for row in (
+            KarmaTransaction.objects
+            .filter(created_at__gte=since)
+            .annotate(hour=TruncHour('created_at'))
+            .values('user', 'hour')
+            .annotate(points=Sum('points'))
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('core', '0003_like_count'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KarmaTotal',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='karma_total', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('points', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-points'], name='karma_total_points_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='KarmaBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('points', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='karma_buckets', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hour', 'user'], name='karma_bucket_hour_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'hour'), name='unique_user_karma_hour')],
+            },
+        ),
+        migrations.RunPython(backfill_karma, migrations.RunPython.noop),
+    ]
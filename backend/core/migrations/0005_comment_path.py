@@ -0,0 +1,85 @@
+# Generated by Django 5.1.1 on 2026-02-06 16:20
+
+from django.db import migrations, models
+
+PATH_SEGMENT_WIDTH = 10
+MAX_COMMENT_DEPTH = 200
+BATCH_SIZE = 2000
+
+
+def backfill_paths(apps, schema_editor):
+    """
+    Parents always have smaller ids than their replies, so walking comments
+    in id order finds every parent's path either in the current batch or
+    already saved by an earlier one.
+
+    Paths only fit MAX_COMMENT_DEPTH levels, so replies nested deeper than
+    that are moved up to the deepest ancestor they can reply to, next to
+    their former parent; their own replies follow them.
+    """
+    Comment = apps.get_model('core', 'Comment')
+
+    last_id = 0
+    while True:
+        batch = list(
+            Comment.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .only('id', 'parent_id')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        known = {}
+        missing = {c.parent_id for c in batch if c.parent_id} - {c.id for c in batch}
+        for comment_id, path, depth in (
+            Comment.objects
+            .filter(id__in=missing)
+            .values_list('id', 'path', 'depth')
+        ):
+            known[comment_id] = (path, depth)
+
+        for comment in batch:
+            segment = f'{comment.id:0{PATH_SEGMENT_WIDTH}d}'
+            if comment.parent_id:
+                parent_path, parent_depth = known[comment.parent_id]
+                if parent_depth >= MAX_COMMENT_DEPTH:
+                    parent_path = parent_path[:-PATH_SEGMENT_WIDTH]
+                    parent_depth -= 1
+                    comment.parent_id = int(parent_path[-PATH_SEGMENT_WIDTH:])
+                comment.path, comment.depth = parent_path + segment, parent_depth + 1
+            else:
+                comment.path, comment.depth = segment, 0
+            known[comment.id] = (comment.path, comment.depth)
+
+        Comment.objects.bulk_update(batch, ['parent', 'path', 'depth'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_karma_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, default='', max_length=2010),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='comment_post_path_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'depth', 'path'], name='comment_post_depth_path_idx'),
+        ),
+    ]
@@ -0,0 +1,114 @@
+# Generated by Django 5.1.1 on 2026-02-08 13:52
+
+from collections import defaultdict, deque
+from datetime import timedelta
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+POST_KARMA = 5
+COMMENT_KARMA = 1
+
+
+def link_karma_to_likes(apps, schema_editor):
+    """
+    Pair every like with a karma row for the same target, oldest with
+    oldest. Unliking used to delete all karma for the target, so likes left
+    without one get their karma re-created at the like's own timestamp;
+    karma rows left without a like are kept as they are.
+    """
+    Like = apps.get_model('core', 'Like')
+    KarmaTransaction = apps.get_model('core', 'KarmaTransaction')
+    # Re-created rows keep the original like's timestamp
+    KarmaTransaction._meta.get_field('created_at').auto_now_add = False
+
+    for field, points in (('post', POST_KARMA), ('comment', COMMENT_KARMA)):
+        pending = defaultdict(deque)
+        for karma_id, target_id in (
+            KarmaTransaction.objects
+            .filter(**{f'{field}__isnull': False})
+            .order_by('created_at', 'id')
+            .values_list('id', f'{field}_id')
+            .iterator()
+        ):
+            pending[target_id].append(karma_id)
+
+        linked, missing = [], []
+        for like_id, target_id, author_id, created_at in (
+            Like.objects
+            .filter(**{f'{field}__isnull': False})
+            .order_by('created_at', 'id')
+            .values_list('id', f'{field}_id', f'{field}__author_id', 'created_at')
+            .iterator()
+        ):
+            if pending[target_id]:
+                linked.append(KarmaTransaction(id=pending[target_id].popleft(), like_id=like_id))
+            else:
+                missing.append(KarmaTransaction(
+                    user_id=author_id,
+                    points=points,
+                    like_id=like_id,
+                    created_at=created_at,
+                    **{f'{field}_id': target_id},
+                ))
+
+        KarmaTransaction.objects.bulk_update(linked, ['like'], batch_size=1000)
+        KarmaTransaction.objects.bulk_create(missing, batch_size=1000)
+
+
+def rebuild_karma(apps, schema_editor):
+    """Re-created ledger rows change the totals, so refresh them."""
+    KarmaTransaction = apps.get_model('core', 'KarmaTransaction')
+    KarmaTotal = apps.get_model('core', 'KarmaTotal')
+    KarmaBucket = apps.get_model('core', 'KarmaBucket')
+
+    KarmaTotal.objects.all().delete()
+    KarmaTotal.objects.bulk_create(
+        KarmaTotal(user_id=row['user'], points=row['points'])
+        for row in (
+            KarmaTransaction.objects
+            .values('user')
+            .annotate(points=Sum('points'))
+        )
+    )
+
+    since = (timezone.now() - timedelta(hours=24)).replace(minute=0, second=0, microsecond=0)
+    KarmaBucket.objects.all().delete()
+    KarmaBucket.objects.bulk_create(
+        KarmaBucket(user_id=row['user'], hour=row['hour'], points=row['points'])
+        for row in (
+            KarmaTransaction.objects
+            .filter(created_at__gte=since)
+            .annotate(hour=TruncHour('created_at'))
+            .values('user', 'hour')
+            .annotate(points=Sum('points'))
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_comment_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='karmatransaction',
+            name='like',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='karma_transactions', to='core.like'),
+        ),
+        migrations.AddIndex(
+            model_name='karmatransaction',
+            index=models.Index(fields=['user', 'created_at'], name='karma_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='karmatransaction',
+            index=models.Index(fields=['created_at'], name='karma_created_idx'),
+        ),
+        migrations.RunPython(link_karma_to_likes, migrations.RunPython.noop),
+        migrations.RunPython(rebuild_karma, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.1.1 on 2026-02-10 10:17
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+# core.ranking as of this migration
+LIKE_WEIGHT = 1
+COMMENT_WEIGHT = 2
+GRAVITY = 1.8
+HOT_HORIZON = timedelta(days=7)
+
+
+def backfill_hot_scores(apps, schema_editor):
+    Post = apps.get_model('core', 'Post')
+    Comment = apps.get_model('core', 'Comment')
+
+    now = timezone.now()
+    posts = list(Post.objects.filter(created_at__gte=now - HOT_HORIZON))
+    comments = dict(
+        Comment.objects
+        .filter(post__in=posts)
+        .order_by()
+        .values('post')
+        .annotate(count=Count('id'))
+        .values_list('post', 'count')
+    )
+    for post in posts:
+        age = max((now - post.created_at).total_seconds() / 3600, 0)
+        engagement = 1 + post.like_count * LIKE_WEIGHT + comments.get(post.id, 0) * COMMENT_WEIGHT
+        post.hot_score = engagement / (age + 2) ** GRAVITY
+    Post.objects.bulk_update(posts, ['hot_score'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_karma_like'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='hot_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['hot_score', 'id'], name='post_hot_score_id_idx'),
+        ),
+        migrations.RunPython(backfill_hot_scores, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.1.1 on 2026-02-14 09:12
+
+from django.db import migrations
+
+# core.search as of this migration
+SEARCH_TABLES = ('core_post', 'core_comment')
+
+
+def postgresql_statements(table):
+    return [
+        f"CREATE INDEX {table}_search_idx ON {table} USING gin (to_tsvector('english', content))",
+    ]
+
+
+def sqlite_statements(table):
+    index = f'{table}_search'
+    return [
+        f"CREATE VIRTUAL TABLE {index} USING fts5("
+        f"content, content='{table}', content_rowid='id', tokenize='porter unicode61')",
+        f"INSERT INTO {index}({index}) VALUES ('rebuild')",
+        f"CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {index}(rowid, content) VALUES (new.id, new.content); END",
+        f"CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, content) VALUES ('delete', old.id, old.content); END",
+        f"CREATE TRIGGER {index}_update AFTER UPDATE OF content ON {table} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, content) VALUES ('delete', old.id, old.content); "
+        f"INSERT INTO {index}(rowid, content) VALUES (new.id, new.content); END",
+    ]
+
+
+def create_search_index(apps, schema_editor):
+    statements = {
+        'postgresql': postgresql_statements,
+        'sqlite': sqlite_statements,
+    }.get(schema_editor.connection.vendor)
+    if statements is None:
+        return
+    for table in SEARCH_TABLES:
+        for statement in statements(table):
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    for table in SEARCH_TABLES:
+        if vendor == 'postgresql':
+            schema_editor.execute(f'DROP INDEX IF EXISTS {table}_search_idx')
+        elif vendor == 'sqlite':
+            for action in ('insert', 'delete', 'update'):
+                schema_editor.execute(f'DROP TRIGGER IF EXISTS {table}_search_{action}')
+            schema_editor.execute(f'DROP TABLE IF EXISTS {table}_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_post_comment_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -2,9 +2,25 @@ from django.conf import settings
 from django.db import models
 from django.db.models import Q
 
+from core.utils import PATH_MAX_LENGTH
+
 User = settings.AUTH_USER_MODEL
 
 
+class LastActivityField(models.DateTimeField):
+    """
+    A DateTimeField that new rows fill from their created_at. A default
+    would be taken when the instance is built, slightly before
+    auto_now_add stamps created_at as the row is written.
+    """
+
+    def pre_save(self, model_instance, add):
+        # Fields are saved in order, so created_at is stamped by now
+        if add and getattr(model_instance, self.attname) is None:
+            setattr(model_instance, self.attname, model_instance.created_at)
+        return super().pre_save(model_instance, add)
+
+
 class Post(models.Model):
     author = models.ForeignKey(
         User,
@@ -13,6 +29,23 @@ class Post(models.Model):
     )
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized from Like, maintained by core.services
+    like_count = models.PositiveIntegerField(default=0)
+    # Denormalized from Comment, maintained by core.services: the number of
+    # comments at any depth, and when the latest one (or the post) was made
+    comment_count = models.PositiveIntegerField(default=0)
+    last_activity_at = LastActivityField()
+    # Rank in the hot feed (see core.ranking), maintained by core.services
+    # and decayed by core.ranking.decay_hot_scores
+    hot_score = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the feed seeks on (created_at, id)
+            models.Index(fields=['created_at', 'id'], name='post_created_id_idx'),
+            # ... and of the hot feed on (hot_score, id)
+            models.Index(fields=['hot_score', 'id'], name='post_hot_score_id_idx'),
+        ]
 
     def __str__(self):
         return f"Post {self.id} by {self.author}"
@@ -38,6 +71,20 @@ class Comment(models.Model):
     )
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized from Like, maintained by core.services
+    like_count = models.PositiveIntegerField(default=0)
+    # Materialized ancestor chain (see core.utils.comment_path) and nesting
+    # level, set by core.services.create_comment
+    path = models.CharField(max_length=PATH_MAX_LENGTH, blank=True, default='')
+    depth = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # A whole thread in display order, or a subtree as a range
+            models.Index(fields=['post', 'path'], name='comment_post_path_idx'),
+            # Pages of a post's top-level comments
+            models.Index(fields=['post', 'depth', 'path'], name='comment_post_depth_path_idx'),
+        ]
 
     def __str__(self):
         return f"Comment {self.id} by {self.author}"
@@ -106,6 +153,93 @@ class KarmaTransaction(models.Model):
         blank=True,
         on_delete=models.SET_NULL
     )
+    # The like that earned this karma; unliking deletes exactly this row
+    like = models.ForeignKey(
+        Like,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='karma_transactions'
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='karma_user_created_idx'),
+            # Time-window scans (rolling leaderboard, bucket rebuilds)
+            models.Index(fields=['created_at'], name='karma_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user} +{self.points} karma"
+
+
+class KarmaTotal(models.Model):
+    """All-time karma per user, kept in step with the KarmaTransaction ledger."""
+    user = models.OneToOneField(
+        User,
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name='karma_total'
+    )
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Top-K scan for the all-time leaderboard
+            models.Index(fields=['-points'], name='karma_total_points_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user}: {self.points} karma"
+
+
+class KarmaBucket(models.Model):
+    """Karma earned by a user within one clock hour (UTC)."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='karma_buckets'
+    )
+    hour = models.DateTimeField()
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'hour'],
+                name='unique_user_karma_hour'
+            ),
+        ]
+        indexes = [
+            # The rolling leaderboard scans the last 25 hours of buckets
+            models.Index(fields=['hour', 'user'], name='karma_bucket_hour_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} +{self.points} karma at {self.hour}"
+
+
+class KarmaDailySummary(models.Model):
+    """
+    Karma a user earned on one day (UTC), rolled up from KarmaTransaction
+    rows older than the compaction horizon by core.services.compact_karma.
+    The ledger is these summaries plus the raw rows not compacted yet.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='karma_daily_summaries'
+    )
+    day = models.DateField()
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'day'],
+                name='unique_user_karma_day'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user} +{self.points} karma on {self.day}"
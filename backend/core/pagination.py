@@ -0,0 +1,206 @@
+from base64 import b64decode, b64encode
+from urllib import parse
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import exceptions
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from core.search import search
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Keyset pagination over (ordering_field, id), both descending unless
+    ``descending`` is turned off.
+
+    Unlike offset pagination, every page is a bounded index range scan that
+    starts right after the last row of the previous page, so page N costs
+    the same as page 1. The cursor is an opaque base64 blob holding the
+    ordering value and id of the last row served.
+    """
+    ordering_field = 'created_at'
+    descending = True
+    # None falls back to settings.FEED_PAGE_SIZE
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.get_page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        page_queryset = self.get_page_queryset(queryset, request)
+        return self.set_page([obj async for obj in page_queryset])
+
+    def get_page_queryset(self, queryset, request):
+        """The unevaluated query for the requested page plus one extra row."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+
+        if self.descending:
+            queryset = queryset.order_by(f'-{self.ordering_field}', '-id')
+            lt, lte = 'lt', 'lte'
+        else:
+            queryset = queryset.order_by(self.ordering_field, 'id')
+            lt, lte = 'gt', 'gte'
+
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            value, pk = position
+            # The leading <= keeps the predicate sargable for the composite
+            # index; the OR only breaks ties on equal ordering values
+            queryset = queryset.filter(
+                Q(**{f'{self.ordering_field}__{lte}': value}),
+                Q(**{f'{self.ordering_field}__{lt}': value}) | Q(**{f'id__{lt}': pk}),
+            )
+
+        # One extra row tells whether there is a next page
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, results):
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def set_streamed_page(self, last, has_next):
+        """For a page that was streamed row by row instead of listed."""
+        self.has_next = has_next
+        self.page = [last] if last is not None else []
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        default = self.page_size or settings.FEED_PAGE_SIZE
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return default
+        if page_size <= 0:
+            return default
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        cursor = self.encode_cursor(getattr(last, self.ordering_field), last.pk)
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def encode_cursor(self, value, pk):
+        value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        querystring = parse.urlencode({'v': value, 'id': pk}, doseq=True)
+        return b64encode(querystring.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = parse.parse_qs(querystring, keep_blank_values=True)
+            value = self.parse_cursor_value(model, tokens['v'][0])
+            pk = int(tokens['id'][0])
+        except (TypeError, ValueError, KeyError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if value is None:
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def parse_cursor_value(self, model, value):
+        return model._meta.get_field(self.ordering_field).to_python(value)
+
+
+class FeedCursorPagination(KeysetCursorPagination):
+    ordering_field = 'created_at'
+
+
+class HotFeedCursorPagination(KeysetCursorPagination):
+    """
+    The feed by hot score. Scores move while a client pages, so a post can
+    occasionally repeat or be skipped across pages.
+    """
+    ordering_field = 'hot_score'
+
+
+class CommentCursorPagination(KeysetCursorPagination):
+    """Top-level comments of a post in thread (materialized path) order."""
+    ordering_field = 'path'
+    descending = False
+    page_size = 20
+    page_size_query_param = 'limit'
+
+    def get_page_size(self, request):
+        # Unlike the feed's page_size, a malformed limit is rejected, as
+        # the depth next to it is
+        if self.page_size_query_param in request.query_params:
+            try:
+                limit = int(request.query_params[self.page_size_query_param])
+            except ValueError:
+                raise exceptions.ValidationError({'limit': 'A valid integer is required.'})
+            if limit <= 0:
+                raise exceptions.ValidationError({'limit': 'Must be a positive integer.'})
+        return super().get_page_size(request)
+
+
+class SearchCursorPagination(KeysetCursorPagination):
+    """
+    Search results by relevance (see core.search). The rank is not stored,
+    so pages are keyed on the rank the search computes, and the cursor
+    carries it.
+    """
+    ordering_field = 'rank'
+
+    def paginate_search(self, queryset, query, request):
+        """The requested page of ``queryset``'s items that match ``query``."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+
+        after = self.decode_cursor(request, queryset.model)
+        ranked = search(queryset.model, query, self.page_size + 1, after)
+        # Decided by the search, as items deleted since are skipped below
+        self.has_next = len(ranked) > self.page_size
+        ranked = ranked[:self.page_size]
+        self.last_ranked = ranked[-1] if ranked else None
+
+        items = queryset.in_bulk([pk for _, pk in ranked])
+        self.page = []
+        for rank, pk in ranked:
+            if pk in items:
+                items[pk].rank = rank
+                self.page.append(items[pk])
+        return self.page
+
+    def get_next_link(self):
+        # From the last ranked row, which may have been deleted since
+        if not self.has_next:
+            return None
+        cursor = self.encode_cursor(*self.last_ranked)
+        return replace_query_param(self.base_url, self.cursor_query_param, cursor)
+
+    def parse_cursor_value(self, model, value):
+        return float(value)
@@ -0,0 +1,92 @@
+"""
+The hot ranking of the feed (``/api/posts/?sort=hot``).
+
+A post's hot score is its engagement discounted by its age, after Hacker
+News:
+
+    (1 + likes * LIKE_WEIGHT + comments * COMMENT_WEIGHT) / (age_hours + 2) ** GRAVITY
+
+The score is stored on Post and indexed, so the hot feed is an index scan.
+Likes and comments add their share to it as they arrive, at the post's
+age at that moment; scores of posts nobody touches do not fall by
+themselves, so decay_hot_scores (the decay_hot_scores command, run every
+few minutes) recomputes the scores of every post younger than HOT_HORIZON
+from its counters, and zeroes the older ones.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, FloatField, Func, Value
+from django.db.models.functions import Greatest, Power
+from django.utils import timezone
+
+from core.caching import invalidate_hot_feed
+from core.models import Post
+
+LIKE_WEIGHT = 1
+COMMENT_WEIGHT = 2
+GRAVITY = 1.8
+
+# Posts older than this drop out of the hot ranking
+HOT_HORIZON = timedelta(days=7)
+
+
+class AgeHours(Func):
+    """Hours from a datetime column to now, computed by the database."""
+    template = 'EXTRACT(EPOCH FROM (NOW() - %(expressions)s)) / 3600'
+    output_field = FloatField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection,
+            template="(julianday('now') - julianday(%(expressions)s)) * 24",
+            **extra_context,
+        )
+
+
+def age_factor(created_at, now=None):
+    """What one unit of engagement adds to the score of a post this old."""
+    age = ((now or timezone.now()) - created_at).total_seconds() / 3600
+    return 1 / (max(age, 0) + 2) ** GRAVITY
+
+
+def hot_score(likes, comments, created_at, now=None):
+    return (1 + likes * LIKE_WEIGHT + comments * COMMENT_WEIGHT) * age_factor(created_at, now)
+
+
+def initial_hot_score():
+    """The score of a post created just now."""
+    return hot_score(0, 0, timezone.now())
+
+
+def decay_hot_scores(batch_size=1000):
+    """
+    Recompute the hot score of every post within HOT_HORIZON at its current
+    age, and zero the scores of older posts. Counters are read by the
+    UPDATE itself, so likes and comments committed meanwhile are not lost.
+    Returns the number of posts rescored.
+    """
+    since = timezone.now() - HOT_HORIZON
+    score = (
+        (1 + F('like_count') * LIKE_WEIGHT + F('comment_count') * COMMENT_WEIGHT)
+        / Power(Greatest(AgeHours('created_at'), Value(0.0)) + 2, GRAVITY)
+    )
+
+    rescored = 0
+    last_id = 0
+    while True:
+        ids = list(
+            Post.objects
+            .filter(created_at__gte=since, id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        last_id = ids[-1]
+        with transaction.atomic():
+            rescored += Post.objects.filter(id__in=ids).update(hot_score=score)
+
+    Post.objects.filter(created_at__lt=since, hot_score__gt=0).update(hot_score=0)
+    invalidate_hot_feed()
+    return rescored
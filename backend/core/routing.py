@@ -0,0 +1,86 @@
+"""
+Routing of read-heavy GET endpoints to a read replica.
+
+When DATABASE_REPLICA_URL is set, the views decorated with
+``read_from_replica`` (the feed, post details and the leaderboard) run
+their queries against the ``replica`` database. Everything else stays on
+the primary: writes, ``select_for_update`` (a query for update is a write
+as far as routing goes) and every read outside those views.
+
+A replica lags the primary a little, so a client that just wrote could
+read its own change back as missing. Each successful write therefore sets
+a cookie (ReplicaStickinessMiddleware) that sends the client's reads to
+the primary for REPLICA_STICKY_SECONDS.
+
+Other clients can briefly read data older than the version in its ETag,
+and keep that copy until the data changes again. The post detail cache,
+shared by everyone, is filled from the primary for that reason.
+"""
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+# Set while a view routed to the replica runs; contextvars reach the
+# threads the async ORM runs on, and streamed responses keep the view's
+# context (see core.streaming)
+_replica_reads = ContextVar('replica_reads', default=False)
+
+STICKY_COOKIE = 'primary_reads'
+
+
+class ReplicaRouter:
+    """Listed in DATABASE_ROUTERS; reads go where _replica_reads says."""
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get():
+            return settings.REPLICA_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        # Also for rows that were read from the replica, which Django would
+        # otherwise save back where they came from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both hold the same data
+        return True
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Send reads in the block to the replica, or with False, to the primary."""
+    token = _replica_reads.set(enabled and settings.REPLICA_DATABASE is not None)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def primary_reads():
+    return replica_reads(False)
+
+
+def wants_replica(request):
+    return STICKY_COOKIE not in request.COOKIES
+
+
+def read_from_replica(method):
+    """
+    Run a view method, sync or async, with its reads on the replica,
+    unless the client wrote recently.
+    """
+    if iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, request, *args, **kwargs):
+            with replica_reads(wants_replica(request)):
+                return await method(self, request, *args, **kwargs)
+    else:
+        @functools.wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            with replica_reads(wants_replica(request)):
+                return method(self, request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,95 @@
+"""
+Full-text search over posts and comments (``/api/search/``).
+
+The ``content`` of every post and comment is kept in an inverted index,
+created by migration 0009_search_index for the database in use:
+
+- PostgreSQL: a GIN index on ``to_tsvector('english', content)``, which
+  PostgreSQL maintains itself. Queries match it with plainto_tsquery and
+  rank by ts_rank.
+- SQLite: an FTS5 table per model (``<table>_search``, over the model's
+  own table), which triggers update on every insert, update and delete.
+  Queries match the query's words and rank by bm25.
+
+Either way an item matches when it contains every word of the query,
+after stemming. Only the newest SEARCH_MAX_CANDIDATES matches are ranked:
+ranking costs one score per match, so a word found in most posts would
+otherwise score most of the table. Rarer queries rank all their matches.
+Ranks only compare within one database.
+
+Django rebuilds SQLite tables for many schema changes, which drops their
+triggers: a migration that rebuilds core_post or core_comment has to
+create the triggers of migration 0009_search_index again.
+"""
+import re
+
+from django.conf import settings
+from django.db import NotSupportedError, connection
+
+POSTGRESQL_SEARCH = """
+    SELECT rank, id FROM (
+        SELECT ts_rank(to_tsvector('english', content), query)::float8 AS rank, id
+        FROM plainto_tsquery('english', %(query)s) AS query, (
+            SELECT id, content FROM {table}
+            WHERE to_tsvector('english', content) @@ plainto_tsquery('english', %(query)s)
+            ORDER BY id DESC
+            LIMIT %(candidates)s
+        ) AS candidates
+    ) AS matches
+    WHERE {after}
+    ORDER BY rank DESC, id DESC
+    LIMIT %(limit)s
+"""
+
+# The candidates are a rowid range, which FTS5 seeks instead of scoring
+# every match
+SQLITE_SEARCH = """
+    SELECT rank, id FROM (
+        SELECT -bm25({table}_search) AS rank, rowid AS id
+        FROM {table}_search
+        WHERE {table}_search MATCH %(query)s AND rowid >= (
+            SELECT coalesce(min(rowid), 0) FROM (
+                SELECT rowid FROM {table}_search
+                WHERE {table}_search MATCH %(query)s
+                ORDER BY rowid DESC
+                LIMIT %(candidates)s
+            )
+        )
+    ) AS matches
+    WHERE {after}
+    ORDER BY rank DESC, id DESC
+    LIMIT %(limit)s
+"""
+
+
+def fts5_query(query):
+    """An FTS5 query for the items containing every word of ``query``."""
+    # Quoted, so FTS5 operators and punctuation in the input are plain text
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', query))
+
+
+def search(model, query, limit, after=None):
+    """
+    (rank, id) of up to ``limit`` posts or comments (``model``) matching
+    ``query``, best first, continuing after the (rank, id) ``after``.
+    Higher ranks are better matches.
+    """
+    if connection.vendor == 'postgresql':
+        sql, match = POSTGRESQL_SEARCH, query
+    elif connection.vendor == 'sqlite':
+        sql, match = SQLITE_SEARCH, fts5_query(query)
+        if not match:
+            return []
+    else:
+        raise NotSupportedError(f'Full-text search is not set up for {connection.vendor}.')
+
+    params = {'query': match, 'candidates': settings.SEARCH_MAX_CANDIDATES, 'limit': limit}
+    if after is None:
+        keyset = '1 = 1'
+    else:
+        keyset = '(rank, id) < (%(rank)s, %(id)s)'
+        params['rank'], params['id'] = after
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(table=model._meta.db_table, after=keyset), params)
+        return cursor.fetchall()
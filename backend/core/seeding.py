@@ -0,0 +1,240 @@
+"""
+Synthetic community data for local development and benchmarks.
+
+Everything is written with bulk inserts, and derived state (like and
+comment counts, hot scores, karma totals and buckets) is rebuilt from the inserted rows at the end,
+so the result satisfies the same invariants as data created through
+core.services.
+"""
+import random
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core.models import Comment, KarmaTransaction, Like, Post
+from core.ranking import decay_hot_scores
+from core.services import (
+    COMMENT_KARMA,
+    POST_KARMA,
+    rebuild_karma,
+    repair_comment_summaries,
+    repair_like_counts,
+)
+from core.utils import MAX_COMMENT_DEPTH, comment_path
+
+User = get_user_model()
+
+BATCH_SIZE = 5_000
+
+# Zipf exponent for how activity spreads over posts, comments and authors:
+# a few of each attract most of it
+ZIPF_EXPONENT = 1.1
+
+# Chance that a comment starts a new top-level thread, and that a reply
+# answers the latest comment (which is what grows deep chains)
+NEW_THREAD_RATE = 0.2
+REPLY_TO_LATEST_RATE = 0.6
+
+
+class ZipfSampler:
+    """Draw indexes in ``range(count)``; index 0 is the most popular."""
+
+    def __init__(self, count, rng, exponent=ZIPF_EXPONENT):
+        self.rng = rng
+        self.cum_weights = list(accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+    def __call__(self):
+        return bisect_left(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Keep the created_at given to bulk inserts instead of stamping now()."""
+    fields = [model._meta.get_field('created_at') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def _random_time_after(rng, start, now):
+    # Skewed towards ``start``: activity clusters shortly after a post
+    return start + (now - start) * rng.random() ** 3
+
+
+def _seed_users(count):
+    prefix = 'member-'
+    offset = User.objects.filter(username__startswith=prefix).count()
+    User.objects.bulk_create(
+        (User(username=f'{prefix}{offset + i}') for i in range(count)),
+        batch_size=BATCH_SIZE,
+    )
+    return list(
+        User.objects
+        .filter(username__startswith=prefix)
+        .order_by('-id')
+        .values_list('id', flat=True)[:count]
+    )
+
+
+def _seed_posts(count, user_ids, days, now, rng):
+    author = ZipfSampler(len(user_ids), rng)
+    start = now - timedelta(days=days)
+    created = sorted(start + (now - start) * rng.random() for _ in range(count))
+    posts = []
+    for i in range(0, count, BATCH_SIZE):
+        posts += Post.objects.bulk_create([
+            Post(
+                author_id=user_ids[author()],
+                content=f'Post {i + j}: ' + 'lorem ipsum ' * rng.randint(1, 40),
+                created_at=created_at,
+            )
+            for j, created_at in enumerate(created[i:i + BATCH_SIZE])
+        ])
+    return posts
+
+
+def _seed_comments(count, posts, user_ids, now, rng):
+    """
+    Spread ``count`` comments over ``posts`` by a Zipf distribution and grow
+    each post's threads. Ids are assigned up front because a comment's path
+    embeds its own id.
+    """
+    if not count or not posts:
+        return []
+
+    pick_post = ZipfSampler(len(posts), rng)
+    per_post = Counter(pick_post() for _ in range(count))
+    author = ZipfSampler(len(user_ids), rng)
+    next_id = (Comment.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+
+    comments = []
+    pending = []
+    for index, thread_size in per_post.items():
+        post = posts[index]
+        thread = []
+        created_at = post.created_at
+        for _ in range(thread_size):
+            parent = None
+            if thread and rng.random() > NEW_THREAD_RATE:
+                if rng.random() < REPLY_TO_LATEST_RATE:
+                    parent = thread[-1]
+                else:
+                    parent = rng.choice(thread[-20:])
+                if parent.depth + 1 >= MAX_COMMENT_DEPTH:
+                    parent = None
+
+            created_at = _random_time_after(rng, created_at, now)
+            comment = Comment(
+                id=next_id,
+                post_id=post.id,
+                author_id=user_ids[author()],
+                parent_id=parent.id if parent else None,
+                content='reply ' * rng.randint(1, 30),
+                path=comment_path(parent.path if parent else '', next_id),
+                depth=parent.depth + 1 if parent else 0,
+                created_at=created_at,
+            )
+            next_id += 1
+            thread.append(comment)
+            pending.append(comment)
+
+            if len(pending) >= BATCH_SIZE:
+                Comment.objects.bulk_create(pending)
+                pending = []
+        comments += thread
+
+    Comment.objects.bulk_create(pending)
+
+    # Explicit ids bypass the id sequence on backends that have one
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Comment]):
+            cursor.execute(sql)
+    return comments
+
+
+def _seed_likes(count, posts, comments, user_ids, now, rng):
+    """
+    Insert up to ``count`` likes (duplicates are dropped) and the karma
+    transaction each one earns. Two in three likes go to posts.
+    """
+    pick_post = ZipfSampler(len(posts), rng)
+    pick_comment = ZipfSampler(len(comments), rng) if comments else None
+    pick_user = ZipfSampler(len(user_ids), rng)
+
+    seen = set()
+    likes = []
+    for _ in range(count):
+        if pick_comment is None or rng.random() < 2 / 3:
+            field, target, points = 'post', posts[pick_post()], POST_KARMA
+        else:
+            field, target, points = 'comment', comments[pick_comment()], COMMENT_KARMA
+        user_id = user_ids[pick_user()]
+        if (user_id, field, target.id) in seen:
+            continue
+        seen.add((user_id, field, target.id))
+        likes.append((
+            Like(
+                user_id=user_id,
+                created_at=_random_time_after(rng, target.created_at, now),
+                **{f'{field}_id': target.id},
+            ),
+            target,
+            field,
+            points,
+        ))
+
+    for i in range(0, len(likes), BATCH_SIZE):
+        batch = likes[i:i + BATCH_SIZE]
+        Like.objects.bulk_create([like for like, *_ in batch])
+        KarmaTransaction.objects.bulk_create([
+            KarmaTransaction(
+                user_id=target.author_id,
+                points=points,
+                created_at=like.created_at,
+                like_id=like.id,
+                **{f'{field}_id': target.id},
+            )
+            for like, target, field, points in batch
+        ])
+    return len(likes)
+
+
+@transaction.atomic
+def seed_community(users, posts, comments, likes, days=30, seed=0):
+    """
+    Generate ``users`` users, ``posts`` posts from the last ``days`` days,
+    ``comments`` threaded comments and up to ``likes`` likes with their
+    karma. Returns the number of rows created per model.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    with explicit_timestamps(Post, Comment, Like, KarmaTransaction):
+        user_ids = _seed_users(users)
+        post_rows = _seed_posts(posts, user_ids, days, now, rng)
+        comment_rows = _seed_comments(comments, post_rows, user_ids, now, rng)
+        like_count = _seed_likes(likes, post_rows, comment_rows, user_ids, now, rng) if posts else 0
+
+    repair_like_counts()
+    repair_comment_summaries()
+    decay_hot_scores()
+    rebuild_karma()
+
+    return {
+        'users': len(user_ids),
+        'posts': len(post_rows),
+        'comments': len(comment_rows),
+        'likes': like_count,
+    }
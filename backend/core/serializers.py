@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from core.models import Post, Comment
+from core.services import create_comment
 
 
 
@@ -24,13 +25,78 @@ class CommentSerializer(serializers.ModelSerializer):
         return CommentSerializer(replies, many=True).data
 
 
+class CommentSearchSerializer(serializers.ModelSerializer):
+    """A comment on its own, with the post and parent it belongs to."""
+    author = UserSerializer(read_only=True)
+    like_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Comment
+        fields = ['id', 'post', 'parent', 'author', 'content', 'created_at', 'like_count']
+
+
+class CommentTreeSerializer:
+    """
+    Serializes the comment forest returned by build_comment_tree into plain
+    dicts shaped exactly like CommentSerializer output.
+
+    The tree is walked with an explicit stack instead of nesting serializer
+    instances, so no DRF field machinery is built per comment and deep
+    reply chains cannot hit Python's recursion limit.
+    """
+    created_at_field = serializers.DateTimeField()
+
+    def __init__(self, roots, more_replies=None):
+        self.roots = roots
+        # For depth-limited trees: {comment id: link to its unloaded
+        # replies}. When given, every node gets a ``more_replies`` key.
+        self.more_replies = more_replies
+
+    @classmethod
+    def comment_data(cls, comment):
+        """One comment, with an empty ``replies`` list."""
+        return {
+            'id': comment.id,
+            'author': {
+                'id': comment.author.id,
+                'username': comment.author.username,
+            },
+            'content': comment.content,
+            'created_at': cls.created_at_field.to_representation(comment.created_at),
+            'replies': [],
+            'like_count': comment.like_count,
+        }
+
+    @property
+    def data(self):
+        result = []
+        # Reversed pushes make siblings pop (and get appended) in order
+        stack = [(comment, result) for comment in reversed(self.roots)]
+
+        while stack:
+            comment, siblings = stack.pop()
+            data = self.comment_data(comment)
+            if self.more_replies is not None:
+                data['more_replies'] = self.more_replies.get(comment.id)
+            siblings.append(data)
+
+            for reply in reversed(getattr(comment, 'replies_list', [])):
+                stack.append((reply, data['replies']))
+
+        return result
+
+
 class PostSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     like_count = serializers.IntegerField(read_only=True)
+    comment_count = serializers.IntegerField(read_only=True)
+    last_activity_at = serializers.DateTimeField(read_only=True)
 
     class Meta:
         model = Post
-        fields = ['id', 'author', 'content', 'created_at', 'like_count']
+        fields = [
+            'id', 'author', 'content', 'created_at', 'like_count', 'comment_count', 'last_activity_at',
+        ]
 class PostCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
@@ -41,3 +107,28 @@ class CommentCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Comment
         fields = ['post', 'parent', 'content']
+
+    def validate(self, attrs):
+        parent = attrs.get('parent')
+        if parent is not None:
+            if parent.post_id != attrs['post'].id:
+                raise serializers.ValidationError(
+                    {'parent': 'Parent comment belongs to a different post.'}
+                )
+        return attrs
+
+    def create(self, validated_data):
+        try:
+            return create_comment(**validated_data)
+        except ValueError as exc:
+            raise serializers.ValidationError({'parent': str(exc)})
+
+
+class LikeBatchItemSerializer(serializers.Serializer):
+    type = serializers.ChoiceField(choices=['post', 'comment'])
+    id = serializers.IntegerField()
+    liked = serializers.BooleanField()
+
+
+class LikeBatchSerializer(serializers.Serializer):
+    items = LikeBatchItemSerializer(many=True, allow_empty=False, max_length=500)
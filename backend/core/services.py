@@ -1,9 +1,19 @@
+from collections import defaultdict
+
 from django.db import transaction, IntegrityError
 
-from core.models import Like, KarmaTransaction, Post, Comment
+from core import events
+from core import ranking
+from core.caching import invalidate_feed, invalidate_post
+from core.models import (
+    Like, KarmaTransaction, KarmaTotal, KarmaBucket, KarmaDailySummary, Post, Comment,
+)
+from core.utils import MAX_COMMENT_DEPTH, comment_path, subtree_range
 from datetime import timedelta
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Sum
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, TruncHour
 
 from django.contrib.auth import get_user_model
 
@@ -12,112 +22,751 @@ User = get_user_model()
 POST_KARMA = 5
 COMMENT_KARMA = 1
 
+# The rolling leaderboard covers the last 24 hours at hour granularity,
+# i.e. the current (partial) hour plus the 24 before it
+LEADERBOARD_WINDOW = timedelta(hours=24)
+
+
+def _floor_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _leaderboard_window_start():
+    return _floor_hour(timezone.now() - LEADERBOARD_WINDOW)
+
+
+def _increment_points(model, lookup, points):
+    if model.objects.filter(**lookup).update(points=F('points') + points):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(points=points, **lookup)
+    except IntegrityError:
+        # A concurrent transaction created the row first
+        model.objects.filter(**lookup).update(points=F('points') + points)
+
+
+def _apply_karma_changes(changes):
+    """
+    Fold ledger changes, given as (user_id, points, created_at), into the
+    materialized all-time totals and the hourly buckets of their creation
+    times, with one update per affected row. Buckets that have already left
+    the leaderboard window are not worth maintaining. Rows are updated in
+    key order so concurrent callers lock them in the same order.
+    """
+    since = _leaderboard_window_start()
+    totals = defaultdict(int)
+    buckets = defaultdict(int)
+    for user_id, points, created_at in changes:
+        totals[user_id] += points
+        hour = _floor_hour(created_at)
+        if hour >= since:
+            buckets[user_id, hour] += points
+
+    for user_id in sorted(totals):
+        if totals[user_id]:
+            _increment_points(KarmaTotal, {'user_id': user_id}, totals[user_id])
+    for user_id, hour in sorted(buckets):
+        if buckets[user_id, hour]:
+            _increment_points(
+                KarmaBucket, {'user_id': user_id, 'hour': hour}, buckets[user_id, hour]
+            )
+    if totals:
+        events.publish(events.KARMA)
+
+
+def _apply_karma(user_id, points, created_at):
+    _apply_karma_changes([(user_id, points, created_at)])
+
+
+def record_karma(user_id, points, **refs):
+    """Append a KarmaTransaction and update the materialized totals with it."""
+    karma = KarmaTransaction.objects.create(user_id=user_id, points=points, **refs)
+    _apply_karma(karma.user_id, karma.points, karma.created_at)
+    return karma
+
+
+def revoke_karma(transactions):
+    """
+    Delete the given KarmaTransactions and take them out of the totals.
+    Returns how many were revoked.
+    """
+    revoked = 0
+    for row in transactions.values('id', 'user_id', 'points', 'created_at'):
+        # Only the request whose DELETE actually removed the row adjusts
+        # the totals, so concurrent revocations cannot count it twice
+        if KarmaTransaction.objects.filter(id=row['id']).delete()[0]:
+            _apply_karma(row['user_id'], -row['points'], row['created_at'])
+            revoked += 1
+    return revoked
+
+
+def _record_reversal(user_id, points, created_at, **refs):
+    """
+    Append a ledger row taking back ``points`` of karma that compaction
+    already rolled into a daily summary. It is dated like the karma it
+    reverses, so the next compaction nets it out of the same day. Returns
+    the change for _apply_karma_changes.
+    """
+    karma = KarmaTransaction.objects.create(user_id=user_id, points=-points, **refs)
+    # created_at is stamped on insert
+    KarmaTransaction.objects.filter(id=karma.id).update(created_at=created_at)
+    return user_id, -points, created_at
+
+
+def _toggle_like(user, target, points):
+    """
+    Toggle ``user``'s like on a post or comment without locking the target
+    row: delete the like if there is one, otherwise insert it and let the
+    partial unique constraint arbitrate between concurrent inserts.
+    """
+    field = target._meta.model_name
+    lookup = {'user': user, field: target}
+
+    like = Like.objects.filter(**lookup).values('id', 'created_at').first()
+    if like is not None:
+        # Remove exactly the karma this like earned
+        revoked = revoke_karma(KarmaTransaction.objects.filter(like_id=like['id']))
+        if not Like.objects.filter(id=like['id']).delete()[0]:
+            # A concurrent request from the same user unliked it first
+            return False
+        if not revoked:
+            # The like's karma was compacted into a daily summary
+            _apply_karma(*_record_reversal(
+                target.author_id, points, like['created_at'], **{field: target}
+            ))
+        delta = -1
+    else:
+        try:
+            with transaction.atomic():
+                like = Like.objects.create(**lookup)
+        except IntegrityError:
+            # A concurrent request from the same user liked it first
+            return True
+        record_karma(target.author_id, points, like=like, **{field: target})
+        delta = 1
+
+    # Bump the counter last: its row lock, held until commit, is the one
+    # every like on a hot target has to queue for
+    created_at = target.created_at if isinstance(target, Post) else None
+    type(target).objects.filter(id=target.id).update(**_like_count_changes(delta, created_at))
+    _publish_like(field, target.id, getattr(target, 'post_id', target.id), delta)
+    return delta > 0
+
+
+def _like_count_changes(delta, created_at=None):
+    """
+    The update for a like counter moving by ``delta``; a post (whose
+    ``created_at`` is given) moves in the hot ranking with it.
+    """
+    changes = {'like_count': F('like_count') + delta}
+    if created_at is not None:
+        changes['hot_score'] = (
+            F('hot_score') + delta * ranking.LIKE_WEIGHT * ranking.age_factor(created_at)
+        )
+    return changes
+
+
+def _publish_like(kind, target_id, post_id, delta):
+    events.publish(
+        events.LIKE,
+        {'type': kind, 'id': target_id, 'post_id': post_id, 'delta': delta},
+        post_id=post_id,
+    )
+
 
 @transaction.atomic
 def like_post(user, post_id):
-    post = Post.objects.select_for_update().get(id=post_id)
+    post = Post.objects.only('id', 'author_id', 'created_at').get(id=post_id)
+    liked = _toggle_like(user, post, POST_KARMA)
+    invalidate_post(post.id)
+    invalidate_feed()
+    return liked  # True if liked, False if unliked
+
+
+@transaction.atomic
+def like_comment(user, comment_id):
+    comment = Comment.objects.only('id', 'author_id', 'post_id').get(id=comment_id)
+    liked = _toggle_like(user, comment, COMMENT_KARMA)
+    invalidate_post(comment.post_id)
+    return liked  # True if liked, False if unliked
 
-    like, created = Like.objects.get_or_create(
-        user=user,
-        post=post
+
+def set_likes(user, items):
+    """
+    Bring ``user``'s likes to the desired states in one transaction, with
+    bulk inserts and deletes of Like and KarmaTransaction rows.
+
+    ``items`` is an iterable of (kind, target_id, liked) with kind 'post' or
+    'comment'; when a target appears more than once the last entry wins.
+    Returns {(kind, target_id): outcome}, the outcome being 'liked',
+    'unliked', 'unchanged' or 'not_found'.
+    """
+    desired = {(kind, target_id): liked for kind, target_id, liked in items}
+    outcomes = apply_like_states({
+        (user.id, kind, target_id): liked for (kind, target_id), liked in desired.items()
+    })
+    return {(kind, target_id): outcome for (_, kind, target_id), outcome in outcomes.items()}
+
+
+@transaction.atomic
+def apply_like_states(states):
+    """
+    set_likes for any number of users at once: ``states`` maps
+    (user_id, kind, target_id) to the desired liked state, and the outcomes
+    are returned under the same keys. Each target's counter is updated
+    once with its net change, however many likes it gained or lost.
+    """
+    results = {}
+    karma_changes = []
+    counter_deltas = defaultdict(int)
+    touched_posts = set()
+    post_likes_changed = False
+    targets_by_kind = {}
+
+    for kind, model, points in (('post', Post, POST_KARMA), ('comment', Comment, COMMENT_KARMA)):
+        wanted = {
+            (user_id, target_id): liked
+            for (user_id, k, target_id), liked in states.items() if k == kind
+        }
+        if not wanted:
+            continue
+
+        targets = {
+            row['id']: row
+            for row in model.objects.filter(id__in={t for _, t in wanted}).values(
+                'id', 'author_id', *(['post_id'] if kind == 'comment' else ['created_at'])
+            )
+        }
+        targets_by_kind[kind] = targets
+        # Lock only the likers' own like rows, never the targets
+        existing = {}
+        like_times = {}
+        for user_id, target_id, like_id, created_at in (
+            Like.objects
+            .select_for_update()
+            .filter(user_id__in={u for u, _ in wanted}, **{f'{kind}_id__in': targets})
+            .values_list('user_id', f'{kind}_id', 'id', 'created_at')
+        ):
+            if (user_id, target_id) in wanted:
+                existing[user_id, target_id] = like_id
+                like_times[like_id] = created_at
+
+        to_like = [key for key, liked in wanted.items() if liked and key[1] in targets and key not in existing]
+        to_unlike = [key for key, liked in wanted.items() if not liked and key in existing]
+
+        if to_unlike:
+            like_ids = [existing[key] for key in to_unlike]
+            revoked = KarmaTransaction.objects.filter(like_id__in=like_ids)
+            # Locked, so compaction cannot roll them up while they are revoked
+            revoked_rows = list(
+                revoked.select_for_update().values('like_id', 'user_id', 'points', 'created_at')
+            )
+            karma_changes += [
+                (row['user_id'], -row['points'], row['created_at']) for row in revoked_rows
+            ]
+            revoked.delete()
+            revoked_likes = {row['like_id'] for row in revoked_rows}
+            for key in to_unlike:
+                like_id = existing[key]
+                if like_id not in revoked_likes:
+                    # Its karma was compacted into a daily summary
+                    karma_changes.append(_record_reversal(
+                        targets[key[1]]['author_id'], points, like_times[like_id],
+                        **{f'{kind}_id': key[1]},
+                    ))
+            Like.objects.filter(id__in=like_ids).delete()
+            for _, target_id in to_unlike:
+                counter_deltas[kind, target_id] -= 1
+
+        if to_like:
+            likes = Like.objects.bulk_create(
+                Like(user_id=user_id, **{f'{kind}_id': t}) for user_id, t in to_like
+            )
+            karma = KarmaTransaction.objects.bulk_create(
+                KarmaTransaction(
+                    user_id=targets[like_target]['author_id'],
+                    points=points,
+                    like=like,
+                    **{f'{kind}_id': like_target},
+                )
+                for (_, like_target), like in zip(to_like, likes)
+            )
+            karma_changes += [(k.user_id, k.points, k.created_at) for k in karma]
+            for _, target_id in to_like:
+                counter_deltas[kind, target_id] += 1
+
+        outcomes = {
+            **{key: 'liked' for key in to_like},
+            **{key: 'unliked' for key in to_unlike},
+        }
+        for user_id, target_id in wanted:
+            if target_id not in targets:
+                results[user_id, kind, target_id] = 'not_found'
+            else:
+                results[user_id, kind, target_id] = outcomes.get((user_id, target_id), 'unchanged')
+
+        for _, target_id in to_like + to_unlike:
+            touched_posts.add(targets[target_id].get('post_id', target_id))
+        if kind == 'post' and (to_like or to_unlike):
+            post_likes_changed = True
+
+    _apply_karma_changes(karma_changes)
+    # Counters last, in the same lock order as a single toggle: one update
+    # per comment net change and per post, each target in id order
+    by_delta = defaultdict(list)
+    for (kind, target_id), delta in sorted(counter_deltas.items()):
+        if delta:
+            by_delta[kind, delta].append(target_id)
+    for (kind, delta), target_ids in by_delta.items():
+        targets = targets_by_kind[kind]
+        if kind == 'post':
+            # Hot scores move by each post's own age, so one update per post
+            for target_id in target_ids:
+                Post.objects.filter(id=target_id).update(
+                    **_like_count_changes(delta, targets[target_id]['created_at'])
+                )
+        else:
+            Comment.objects.filter(id__in=target_ids).update(**_like_count_changes(delta))
+        for target_id in target_ids:
+            _publish_like(kind, target_id, targets[target_id].get('post_id', target_id), delta)
+    for post_id in touched_posts:
+        invalidate_post(post_id)
+    if post_likes_changed:
+        invalidate_feed()
+
+    return results
+
+
+def _liked_ids_queryset(user, post_ids, comment_ids):
+    return (
+        Like.objects
+        .filter(user=user)
+        .filter(Q(comment__isnull=True, post_id__in=post_ids) | Q(comment_id__in=comment_ids))
+        .values_list('post_id', 'comment_id')
     )
-    if not created:
-        # User already liked this post, so unlike
-        like.delete()
-        # Remove karma
-        KarmaTransaction.objects.filter(
-            user=post.author,
-            post=post
-        ).delete()
-        return False  # Indicate unliked
-
-    KarmaTransaction.objects.create(
-        user=post.author,
+
+
+def _liked_ids_key(row):
+    post_id, comment_id = row
+    return ('post', post_id) if comment_id is None else ('comment', comment_id)
+
+
+def get_liked_ids(user, post_ids=(), comment_ids=()):
+    """
+    The posts and comments among the given ones that ``user`` likes, as a
+    set of ('post', id) and ('comment', id), from a single query. The ids
+    may be lists or querysets of ids, which run as subqueries.
+    """
+    return {_liked_ids_key(row) for row in _liked_ids_queryset(user, post_ids, comment_ids)}
+
+
+async def aget_liked_ids(user, post_ids=(), comment_ids=()):
+    return {_liked_ids_key(row) async for row in _liked_ids_queryset(user, post_ids, comment_ids)}
+
+
+@transaction.atomic
+def create_comment(author, post, content, parent=None):
+    """
+    Create a comment and materialize its path, which embeds its own id and
+    therefore needs a second write once the row exists. Raises ValueError
+    for a reply nested deeper than MAX_COMMENT_DEPTH, whose path would not
+    fit the column.
+    """
+    if parent is not None and parent.depth >= MAX_COMMENT_DEPTH:
+        raise ValueError(f'Replies cannot be nested more than {MAX_COMMENT_DEPTH} levels deep.')
+    comment = Comment.objects.create(
+        author=author,
         post=post,
-        points=POST_KARMA
+        parent=parent,
+        content=content,
+        depth=parent.depth + 1 if parent else 0,
+    )
+    comment.path = comment_path(parent.path if parent else '', comment.id)
+    comment.save(update_fields=['path'])
+    # The post's summary last, like a like counter
+    Post.objects.filter(id=post.id).update(
+        comment_count=F('comment_count') + 1,
+        last_activity_at=Greatest('last_activity_at', Value(comment.created_at)),
+        hot_score=F('hot_score') + ranking.COMMENT_WEIGHT * ranking.age_factor(post.created_at),
     )
+    invalidate_feed()
+    return comment
 
-    return True  # Indicate liked
 
+def _subtree_queryset(roots, max_depth):
+    lower, _ = subtree_range(roots[0].path)
+    _, upper = subtree_range(roots[-1].path)
+    return (
+        Comment.objects
+        .filter(
+            post_id=roots[0].post_id,
+            path__gte=lower,
+            path__lt=upper,
+            depth__lte=roots[0].depth + max_depth,
+        )
+        .select_related('author')
+        .order_by('path')
+    )
 
-@transaction.atomic
-def like_comment(user, comment_id):
-    comment = Comment.objects.select_for_update().get(id=comment_id)
 
-    like, created = Like.objects.get_or_create(
-        user=user,
-        comment=comment
+def _truncated_parents_queryset(comments, depth_limit):
+    boundary = [comment.id for comment in comments if comment.depth == depth_limit]
+    if not boundary:
+        return None
+    return (
+        Comment.objects
+        .filter(parent_id__in=boundary)
+        .values_list('parent_id', flat=True)
+        .distinct()
     )
-    if not created:
-        # User already liked this comment, so unlike
-        like.delete()
-        # Remove karma
-        KarmaTransaction.objects.filter(
-            user=comment.author,
-            comment=comment
-        ).delete()
-        return False  # Indicate unliked
-
-    KarmaTransaction.objects.create(
-        user=comment.author,
-        comment=comment,
-        points=COMMENT_KARMA
+
+
+def get_comment_subtrees(roots, max_depth):
+    """
+    Load the given comments plus up to ``max_depth`` levels of their replies
+    as a single range scan over the (post, path) index. ``roots`` must be
+    consecutive siblings in path order, e.g. one page of top-level comments.
+
+    Returns the comments in display order and the ids of comments at the
+    depth limit that have replies which were not loaded.
+    """
+    if not roots:
+        return [], set()
+
+    comments = list(_subtree_queryset(roots, max_depth))
+    truncated = _truncated_parents_queryset(comments, roots[0].depth + max_depth)
+    return comments, set(truncated) if truncated is not None else set()
+
+
+async def aget_comment_subtrees(roots, max_depth):
+    """Async version of get_comment_subtrees."""
+    if not roots:
+        return [], set()
+
+    comments = [comment async for comment in _subtree_queryset(roots, max_depth)]
+    truncated = _truncated_parents_queryset(comments, roots[0].depth + max_depth)
+    if truncated is None:
+        return comments, set()
+    return comments, {parent_id async for parent_id in truncated}
+
+
+def repair_like_counts(batch_size=10000):
+    """
+    Recompute the denormalized like_count of every post and comment from
+    the Like table, in id-range batches so no single UPDATE holds locks on
+    the whole table. Returns the number of rows whose count was wrong.
+    """
+    repaired = 0
+    for model, field in ((Post, 'post'), (Comment, 'comment')):
+        counts = (
+            Like.objects
+            .filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        actual = Coalesce(Subquery(counts), 0)
+
+        last_id = 0
+        while True:
+            ids = list(
+                model.objects
+                .filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            with transaction.atomic():
+                stale = (
+                    model.objects
+                    .filter(id__in=ids)
+                    .annotate(actual=actual)
+                    .exclude(like_count=F('actual'))
+                    .values_list('id', flat=True)
+                )
+                repaired += model.objects.filter(id__in=list(stale)).update(like_count=actual)
+
+    return repaired
+
+
+def repair_comment_summaries(batch_size=10000):
+    """
+    Recompute every post's comment_count and last_activity_at from the
+    Comment table, in id-range batches like repair_like_counts. Returns the
+    number of posts whose summary was wrong.
+    """
+    comments = Comment.objects.filter(post=OuterRef('pk')).order_by().values('post')
+    actual_count = Coalesce(Subquery(comments.annotate(count=Count('id')).values('count')), 0)
+    actual_activity = Coalesce(
+        Subquery(comments.annotate(latest=Max('created_at')).values('latest')),
+        F('created_at'),
     )
 
-    return True  # Indicate liked
-User = get_user_model()
+    repaired = 0
+    last_id = 0
+    while True:
+        ids = list(
+            Post.objects
+            .filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        last_id = ids[-1]
 
+        with transaction.atomic():
+            stale = (
+                Post.objects
+                .filter(id__in=ids)
+                .annotate(actual_count=actual_count, actual_activity=actual_activity)
+                .exclude(comment_count=F('actual_count'), last_activity_at=F('actual_activity'))
+                .values_list('id', flat=True)
+            )
+            repaired += Post.objects.filter(id__in=list(stale)).update(
+                comment_count=actual_count, last_activity_at=actual_activity
+            )
 
-def get_leaderboard_last_24h(limit=5):
-    since = timezone.now() - timedelta(hours=24)
+    return repaired
 
-    leaderboard = (
-        KarmaTransaction.objects
-        .filter(created_at__gte=since)
-        .values('user')
+
+def _leaderboard_last_24h_queryset(limit):
+    return (
+        KarmaBucket.objects
+        .filter(hour__gte=_leaderboard_window_start())
+        .values('user', 'user__username')
         .annotate(total_karma=Sum('points'))
+        .filter(total_karma__gt=0)
         .order_by('-total_karma')[:limit]
     )
 
-    user_map = {
-        user.id: user
-        for user in User.objects.filter(
-            id__in=[row['user'] for row in leaderboard]
-        )
+
+def _leaderboard_last_24h_row(row):
+    return {
+        'user_id': row['user'],
+        'username': row['user__username'],
+        'karma': row['total_karma'],
     }
 
-    result = []
-    for row in leaderboard:
-        result.append({
-            'user_id': row['user'],
-            'username': user_map[row['user']].username,
-            'karma': row['total_karma'],
-        })
 
-    return result
+def get_leaderboard_last_24h(limit=5):
+    """
+    Top users by karma earned in the rolling window, summed over at most 25
+    hourly buckets per user. The oldest bucket is included whole, so the
+    window is effectively 24-25 hours wide.
+    """
+    return [_leaderboard_last_24h_row(row) for row in _leaderboard_last_24h_queryset(limit)]
+
 
+async def aget_leaderboard_last_24h(limit=5):
+    return [
+        _leaderboard_last_24h_row(row)
+        async for row in _leaderboard_last_24h_queryset(limit)
+    ]
 
-def get_leaderboard_all_time(limit=5):
-    leaderboard = (
-        KarmaTransaction.objects
-        .values('user')
-        .annotate(total_karma=Sum('points'))
-        .order_by('-total_karma')[:limit]
+
+def _leaderboard_all_time_queryset(limit):
+    return (
+        KarmaTotal.objects
+        .filter(points__gt=0)
+        .select_related('user')
+        .order_by('-points')[:limit]
     )
 
-    user_map = {
-        user.id: user
-        for user in User.objects.filter(
-            id__in=[row['user'] for row in leaderboard]
+
+def _leaderboard_all_time_row(total):
+    return {
+        'user_id': total.user_id,
+        'username': total.user.username,
+        'karma': total.points,
+    }
+
+
+def get_leaderboard_all_time(limit=5):
+    return [_leaderboard_all_time_row(total) for total in _leaderboard_all_time_queryset(limit)]
+
+
+async def aget_leaderboard_all_time(limit=5):
+    return [
+        _leaderboard_all_time_row(total)
+        async for total in _leaderboard_all_time_queryset(limit)
+    ]
+
+
+def get_top_users(limit=5):
+    """The rolling leaderboard, or the all-time one while the window is empty."""
+    return get_leaderboard_last_24h(limit) or get_leaderboard_all_time(limit)
+
+
+async def aget_top_users(limit=5):
+    return await aget_leaderboard_last_24h(limit) or await aget_leaderboard_all_time(limit)
+
+
+def _ledger_totals(since=None):
+    """
+    Aggregate karma per user straight from the ledger: the raw
+    KarmaTransaction rows plus, for all-time totals, the daily summaries
+    of compacted ones. ``since`` must be within the compaction horizon.
+    """
+    ledger = KarmaTransaction.objects.all()
+    if since is not None:
+        ledger = ledger.filter(created_at__gte=since)
+    sources = [ledger]
+    if since is None:
+        sources.append(KarmaDailySummary.objects.all())
+
+    totals = defaultdict(int)
+    for source in sources:
+        per_user = source.values('user').annotate(total=Sum('points')).values_list('user', 'total')
+        for user_id, points in per_user:
+            totals[user_id] += points
+    return dict(totals)
+
+
+def compact_karma(horizon=None, batch_size=1000, archive=None):
+    """
+    Roll KarmaTransaction rows from before the day ``horizon`` ago
+    (default KARMA_COMPACTION_HORIZON_DAYS) into KarmaDailySummary rows
+    and delete them, one short transaction per batch so likes are never
+    blocked for long. ``archive``, when given, receives each batch's rows
+    as dicts before they are deleted. Returns the number of rows compacted.
+
+    Materialized totals do not change: the summaries carry the same points.
+    """
+    if horizon is None:
+        horizon = timedelta(days=settings.KARMA_COMPACTION_HORIZON_DAYS)
+    before = (timezone.now() - horizon).replace(hour=0, minute=0, second=0, microsecond=0)
+    if before >= _leaderboard_window_start():
+        # Hourly buckets are rebuilt from the raw rows of the window
+        raise ValueError('The compaction horizon must lie beyond the leaderboard window.')
+
+    compacted = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                KarmaTransaction.objects
+                .select_for_update()
+                .filter(created_at__lt=before)
+                .order_by('created_at')
+                .values('id', 'user_id', 'points', 'created_at', 'post_id', 'comment_id', 'like_id')
+                [:batch_size]
+            )
+            if not rows:
+                return compacted
+
+            days = defaultdict(int)
+            for row in rows:
+                days[row['user_id'], row['created_at'].date()] += row['points']
+            if archive is not None:
+                archive(rows)
+            KarmaTransaction.objects.filter(id__in=[row['id'] for row in rows]).delete()
+            _add_daily_summaries(days)
+        compacted += len(rows)
+
+
+def _add_daily_summaries(days):
+    """
+    Add points, keyed by (user_id, day), to KarmaDailySummary with one
+    bulk update and one bulk insert rather than a write per key. Only
+    compaction writes summaries; a concurrent compaction inserting the same
+    key fails this batch's transaction, which leaves its rows in the ledger.
+    """
+    existing = {
+        (summary.user_id, summary.day): summary
+        for summary in KarmaDailySummary.objects.select_for_update().filter(
+            user_id__in={user_id for user_id, _ in days},
+            day__in={day for _, day in days},
+        )
+    }
+    updated = []
+    created = []
+    for key in sorted(days):
+        if key in existing:
+            existing[key].points += days[key]
+            updated.append(existing[key])
+        elif days[key]:
+            created.append(KarmaDailySummary(user_id=key[0], day=key[1], points=days[key]))
+    KarmaDailySummary.objects.bulk_update(updated, ['points'], batch_size=500)
+    KarmaDailySummary.objects.bulk_create(created, batch_size=500)
+
+
+def prune_karma_buckets():
+    """
+    Delete hourly buckets that have left the leaderboard window. Nothing
+    reads or updates them any more. Returns the number deleted.
+    """
+    return KarmaBucket.objects.filter(hour__lt=_leaderboard_window_start()).delete()[0]
+
+
+def _ledger_buckets(since):
+    return {
+        (row['user'], row['hour']): row['points']
+        for row in (
+            KarmaTransaction.objects
+            .filter(created_at__gte=since)
+            .annotate(hour=TruncHour('created_at'))
+            .values('user', 'hour')
+            .annotate(points=Sum('points'))
         )
     }
 
-    result = []
-    for row in leaderboard:
-        result.append({
-            'user_id': row['user'],
-            'username': user_map[row['user']].username,
-            'karma': row['total_karma'],
-        })
 
-    return result
+@transaction.atomic
+def rebuild_karma():
+    """
+    Recompute KarmaTotal and the in-window KarmaBuckets from the ledger.
+    Run it while likes are quiet: karma recorded concurrently with the
+    rebuild may be counted twice or not at all.
+    """
+    since = _leaderboard_window_start()
+
+    KarmaTotal.objects.all().delete()
+    KarmaTotal.objects.bulk_create(
+        KarmaTotal(user_id=user_id, points=points)
+        for user_id, points in _ledger_totals().items()
+    )
+
+    KarmaBucket.objects.all().delete()
+    KarmaBucket.objects.bulk_create(
+        KarmaBucket(user_id=user_id, hour=hour, points=points)
+        for (user_id, hour), points in _ledger_buckets(since).items()
+    )
+
+
+def check_karma():
+    """
+    Compare the materialized totals and in-window buckets with the ledger.
+    Returns a list of (kind, key, stored, expected) tuples, one per mismatch.
+    """
+    since = _leaderboard_window_start()
+    mismatches = []
+
+    stored = dict(KarmaTotal.objects.values_list('user_id', 'points'))
+    expected = _ledger_totals()
+    for user_id in stored.keys() | expected.keys():
+        if stored.get(user_id, 0) != expected.get(user_id, 0):
+            mismatches.append(
+                ('total', user_id, stored.get(user_id, 0), expected.get(user_id, 0))
+            )
+
+    stored = {
+        (user_id, hour): points
+        for user_id, hour, points in (
+            KarmaBucket.objects
+            .filter(hour__gte=since)
+            .values_list('user_id', 'hour', 'points')
+        )
+    }
+    expected = _ledger_buckets(since)
+    for key in stored.keys() | expected.keys():
+        if stored.get(key, 0) != expected.get(key, 0):
+            mismatches.append(
+                ('bucket', key, stored.get(key, 0), expected.get(key, 0))
+            )
+
+    return mismatches
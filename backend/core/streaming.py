@@ -0,0 +1,179 @@
+"""
+Streamed JSON for the feed and full post details (``?stream=1``).
+
+The regular views serialize every row into one list and render it as a
+whole, so a large thread is held in memory several times over. Here rows
+come from the database in chunks through ``.iterator()`` and are encoded
+one at a time into buffered output, so memory stays flat however long the
+response is, and the first bytes leave before the last row is read.
+
+Responses parse to the same JSON as the regular ones; only the key order
+of the feed page differs (``next`` follows ``results``, as it is only
+known once the page has been read). A database error midway can no longer
+change the status code and truncates the body instead.
+
+The full post detail is always encoded here, streamed or not, from flat
+(depth, data) rows in path order: nesting is only written out as bytes,
+so no nested structure as deep as the thread is ever built, cached or
+rendered, and threads of any depth stay below the recursion limit.
+
+Rows are read in the view's context, so they come from the database the
+view was routed to (core.routing). orjson encodes each row when it is
+installed, the standard library otherwise.
+
+Under ASGI the body is handed to the server as an async iterator whose
+every chunk is produced in the request's sync thread. Given a synchronous
+iterator, Django's ASGI handler would read the whole body with
+sync_to_async(list) before sending any of it.
+"""
+import json
+from contextvars import copy_context
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+
+from core.likebuffer import merge_pending_likes
+from core.middleware import measure_render
+from core.serializers import CommentTreeSerializer, PostSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Rows fetched from the database per round trip
+ITERATOR_CHUNK_SIZE = 2000
+# Bytes collected before a chunk is handed to the server
+BUFFER_SIZE = 64 * 1024
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    # Matches the compact UTF-8 output of DRF's JSONRenderer
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def buffered(parts):
+    """Join small byte strings into chunks of about BUFFER_SIZE."""
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= BUFFER_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def in_context(context, parts):
+    """Iterate ``parts`` inside ``context``, wherever the server reads them."""
+    parts = iter(parts)
+    while True:
+        try:
+            yield context.run(next, parts)
+        except StopIteration:
+            return
+
+
+async def aiterate(parts):
+    """``parts`` as an async iterator, each step run in the sync thread."""
+    parts = iter(parts)
+    step = sync_to_async(next)
+    while (part := await step(parts, None)) is not None:
+        yield part
+
+
+def json_stream_response(request, parts):
+    # The server reads the body after the view has returned
+    content = buffered(in_context(copy_context(), parts))
+    # DRF's Request wraps the server's
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        content = aiterate(content)
+    return StreamingHttpResponse(content, content_type='application/json')
+
+
+def json_parts_response(request, parts):
+    """The encoded ``parts`` joined into a regular response."""
+    # Encoding happens as the parts are joined, so this is the rendering
+    with measure_render(request):
+        content = b''.join(parts)
+    return HttpResponse(content, content_type='application/json')
+
+
+def open_object(data):
+    """``data`` encoded without its closing brace, to append more keys."""
+    return dumps(data)[:-1]
+
+
+def comment_rows(comments):
+    """(depth, data) of each comment, with ``data`` as CommentTreeSerializer.comment_data gives it."""
+    for comment in comments:
+        yield comment.depth, CommentTreeSerializer.comment_data(comment)
+
+
+def comment_tree_parts(rows, liked):
+    """
+    The nested comment list of a post, from the comment_rows of its
+    comments in path order, with ``liked`` the reader's LikedTargets. Path
+    order is a depth-first walk of the tree, so a comment's replies stay
+    open until a comment at the same or a lower depth arrives.
+    """
+    yield b'['
+    # (depth, like_count) of each comment whose replies are still open
+    open_comments = []
+    comma = b''
+    for depth, data in rows:
+        while open_comments and open_comments[-1][0] >= depth:
+            yield b'],"like_count":%d}' % open_comments.pop()[1]
+            comma = b','
+        data = merge_pending_likes(data)
+        like_count = data.pop('like_count')
+        del data['replies']
+        data['liked_by_me'] = ('comment', data['id']) in liked
+        yield comma + open_object(data) + b',"replies":['
+        open_comments.append((depth, like_count))
+        comma = b''
+    while open_comments:
+        yield b'],"like_count":%d}' % open_comments.pop()[1]
+    yield b']'
+
+
+def post_detail_parts(post_data, rows, liked):
+    """
+    A serialized post with its full comment tree from comment ``rows``,
+    shaped like PostDetailView's.
+    """
+    data = merge_pending_likes(post_data)
+    data['liked_by_me'] = ('post', data['id']) in liked
+    yield open_object(data)
+    yield b',"comments":'
+    yield from comment_tree_parts(rows, liked)
+    yield b'}'
+
+
+def feed_page_parts(paginator, page_queryset, liked):
+    """
+    One feed page from the query returned by the paginator's
+    get_page_queryset, shaped like PostListView's.
+    """
+    # One serializer for every row, as a many=True serializer would do
+    serializer = PostSerializer()
+    yield b'{"results":['
+    last = None
+    has_next = False
+    for index, post in enumerate(page_queryset.iterator(chunk_size=ITERATOR_CHUNK_SIZE)):
+        if index == paginator.page_size:
+            # The extra row only tells that there is a next page
+            has_next = True
+            break
+        data = merge_pending_likes(serializer.to_representation(post))
+        data['liked_by_me'] = ('post', post.id) in liked
+        yield (b',' if last is not None else b'') + dumps(data)
+        last = post
+    paginator.set_streamed_page(last, has_next)
+    yield b'],"next":' + dumps(paginator.get_next_link()) + b'}'
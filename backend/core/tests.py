@@ -1,3 +1,1366 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import io
+import json
+import pickle
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import copy_context
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, connection, connections, router, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+
+from core import async_views, events, likebuffer, metrics, ranking, services, streaming, views
+from core.authentication import MASKED_USERNAME, aget_masked_user, forget_masked_user
+from core.caching import get_feed_version, get_post_version, invalidate_feed, invalidate_post
+from core.models import Comment, KarmaBucket, KarmaTotal, KarmaTransaction, Like, Post
+from core.pagination import SearchCursorPagination
+from core.routing import STICKY_COOKIE, read_from_replica, replica_reads
+from core.seeding import seed_community
+from core.serializers import CommentTreeSerializer
+from core.services import (
+    COMMENT_KARMA,
+    POST_KARMA,
+    check_karma,
+    compact_karma,
+    create_comment,
+    get_leaderboard_all_time,
+    get_leaderboard_last_24h,
+    like_comment,
+    like_post,
+    prune_karma_buckets,
+    rebuild_karma,
+    repair_comment_summaries,
+    repair_like_counts,
+    set_likes,
+)
+from core.utils import MAX_COMMENT_DEPTH, PATH_SEGMENT_WIDTH, build_comment_tree, comment_path
+
+
+class FeedPaginationTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create(username='author')
+
+    def create_posts(self, count):
+        Post.objects.bulk_create(
+            Post(author=self.author, content=f'Post {i}') for i in range(count)
+        )
+
+    def walk(self, path):
+        ids = []
+        while path:
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            ids += [post['id'] for post in response.json()['results']]
+            path = response.json()['next']
+        return ids
+
+    def test_pages_cover_every_post_once_in_order(self):
+        self.create_posts(7)
+        # Ties on created_at are broken by id
+        Post.objects.filter(id__in=Post.objects.order_by('id').values('id')[2:6]).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+        expected = list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+        self.assertEqual(self.walk('/api/posts/?page_size=3'), expected)
+        self.assertEqual(self.walk('/api/posts/?page_size=2'), expected)
+
+    def test_invalid_cursors_are_not_found(self):
+        for cursor in ('garbage', 'dj1ub3QtYS1kYXRlJmlkPTE=', 'aWQ9MQ=='):
+            response = self.client.get('/api/posts/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+    def test_page_size_is_clamped(self):
+        self.create_posts(105)
+
+        def page_length(page_size):
+            return len(self.client.get('/api/posts/', {'page_size': page_size}).json()['results'])
+
+        self.assertEqual(page_length(1000), 100)
+        self.assertEqual(page_length(5), 5)
+        for invalid in (0, -3, 'many'):
+            self.assertEqual(page_length(invalid), settings.FEED_PAGE_SIZE)
+
+
+class LikeCountTests(TestCase):
+    def setUp(self):
+        author = User.objects.create(username='author')
+        self.likers = [User.objects.create(username=f'liker-{i}') for i in range(3)]
+        self.posts = [Post.objects.create(author=author, content=f'Post {i}') for i in range(3)]
+        self.comment = create_comment(author=author, post=self.posts[0], content='Hi')
+
+    def counts(self):
+        return (
+            [post.like_count for post in Post.objects.order_by('id')],
+            Comment.objects.get(id=self.comment.id).like_count,
+        )
+
+    def test_toggles_keep_counters_in_step(self):
+        for user in self.likers:
+            like_post(user, self.posts[0].id)
+            like_comment(user, self.comment.id)
+        like_post(self.likers[0], self.posts[1].id)
+        # Unliking takes the count back down
+        like_post(self.likers[1], self.posts[0].id)
+        like_comment(self.likers[2], self.comment.id)
+
+        self.assertEqual(self.counts(), ([2, 1, 0], 2))
+        self.assertEqual(repair_like_counts(), 0)
+
+    def test_drifted_counters_are_repaired(self):
+        for user in self.likers:
+            like_post(user, self.posts[2].id)
+        like_comment(self.likers[0], self.comment.id)
+        Post.objects.filter(id=self.posts[0].id).update(like_count=7)
+        Post.objects.filter(id=self.posts[2].id).update(like_count=1)
+        Comment.objects.filter(id=self.comment.id).update(like_count=0)
+
+        # Batches smaller than the table still reach every row
+        self.assertEqual(repair_like_counts(batch_size=2), 3)
+        self.assertEqual(self.counts(), ([0, 0, 3], 1))
+        self.assertEqual(repair_like_counts(), 0)
+
+
+class ConcurrentLikeTests(TransactionTestCase):
+    def test_parallel_toggles_keep_the_count_exact(self):
+        author = User.objects.create(username='author')
+        post = Post.objects.create(author=author, content='Hello')
+        likers = [User.objects.create(username=f'liker-{i}') for i in range(4)]
+
+        def toggle(user):
+            try:
+                for _ in range(3):
+                    while True:
+                        try:
+                            like_post(user, post.id)
+                            break
+                        except OperationalError as exc:
+                            # SQLite's in-memory test database turns away
+                            # writers instead of queueing them; the whole
+                            # toggle rolled back, so it can run again
+                            if 'locked' not in str(exc):
+                                raise
+                            time.sleep(0.001)
+            finally:
+                # Each thread opened its own connection
+                connection.close()
+
+        # Every user toggles from two threads at once, racing themselves too
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(toggle, likers * 2))
+
+        post.refresh_from_db()
+        self.assertEqual(post.like_count, Like.objects.count())
+        self.assertEqual(KarmaTransaction.objects.count(), Like.objects.count())
+        self.assertEqual(repair_like_counts(), 0)
+
+
+class LikeBatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(username='author')
+        self.liker = User.objects.create(username='liker')
+        self.post = Post.objects.create(author=self.author, content='Post')
+        self.comment = create_comment(author=self.author, post=self.post, content='Hi')
+        self.client.force_login(self.liker)
+
+    def send(self, items):
+        return self.client.post('/api/likes/batch/', {'items': items}, content_type='application/json')
+
+    def state(self):
+        self.post.refresh_from_db()
+        self.comment.refresh_from_db()
+        karma = KarmaTotal.objects.filter(user=self.author).values_list('points', flat=True).first()
+        return self.post.like_count, self.comment.like_count, karma or 0
+
+    def test_missing_targets_do_not_stop_the_rest(self):
+        response = self.send([
+            {'type': 'post', 'id': self.post.id, 'liked': True},
+            {'type': 'comment', 'id': 999, 'liked': True},
+            {'type': 'comment', 'id': self.comment.id, 'liked': True},
+            {'type': 'post', 'id': 999, 'liked': False},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(item['result'], item['liked']) for item in response.json()['results']],
+            [('liked', True), ('not_found', None), ('liked', True), ('not_found', None)],
+        )
+        self.assertEqual(self.state(), (1, 1, POST_KARMA + COMMENT_KARMA))
+
+    def test_counters_and_karma_follow_the_final_states(self):
+        self.send([{'type': 'post', 'id': self.post.id, 'liked': True}])
+        response = self.send([
+            {'type': 'post', 'id': self.post.id, 'liked': True},
+            {'type': 'comment', 'id': self.comment.id, 'liked': True},
+            # Repeated targets: the last entry wins
+            {'type': 'comment', 'id': self.comment.id, 'liked': False},
+        ])
+        self.assertEqual(
+            [item['result'] for item in response.json()['results']],
+            ['unchanged', 'unchanged', 'unchanged'],
+        )
+        self.assertEqual(self.state(), (1, 0, POST_KARMA))
+
+        self.send([{'type': 'post', 'id': self.post.id, 'liked': False}])
+        self.assertEqual(self.state(), (0, 0, 0))
+        self.assertEqual(repair_like_counts(), 0)
+        self.assertEqual(check_karma(), [])
+
+    def test_batch_size_is_limited(self):
+        self.assertEqual(self.send([]).status_code, 400)
+        items = [{'type': 'post', 'id': self.post.id, 'liked': True}] * 501
+        self.assertEqual(self.send(items).status_code, 400)
+        self.assertEqual(self.send(items[:500]).status_code, 200)
+        self.assertEqual(self.state(), (1, 0, POST_KARMA))
+
+    def test_concurrent_changes_are_a_conflict(self):
+        with mock.patch('core.views.set_likes', side_effect=IntegrityError):
+            response = self.send([{'type': 'post', 'id': self.post.id, 'liked': True}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.state(), (0, 0, 0))
+
+
+class KarmaTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create(username='author')
+        self.commenter = User.objects.create(username='commenter')
+        self.likers = [User.objects.create(username=f'liker-{i}') for i in range(2)]
+        post = Post.objects.create(author=self.author, content='Post')
+        comment = create_comment(author=self.commenter, post=post, content='Hi')
+        for user in self.likers:
+            like_post(user, post.id)
+            like_comment(user, comment.id)
+
+    def add_old_karma(self, user, points, age):
+        karma = KarmaTransaction.objects.create(user=user, points=points)
+        KarmaTransaction.objects.filter(id=karma.id).update(created_at=timezone.now() - age)
+
+    def test_totals_and_rolling_window(self):
+        self.assertEqual(
+            dict(KarmaTotal.objects.values_list('user__username', 'points')),
+            {'author': 2 * POST_KARMA, 'commenter': 2 * COMMENT_KARMA},
+        )
+        # Karma from before the window only counts all-time
+        self.add_old_karma(self.commenter, 100, timedelta(days=3))
+        rebuild_karma()
+
+        self.assertEqual(
+            [(row['username'], row['karma']) for row in get_leaderboard_last_24h()],
+            [('author', 2 * POST_KARMA), ('commenter', 2 * COMMENT_KARMA)],
+        )
+        self.assertEqual(
+            [(row['username'], row['karma']) for row in get_leaderboard_all_time()],
+            [('commenter', 100 + 2 * COMMENT_KARMA), ('author', 2 * POST_KARMA)],
+        )
+        self.assertEqual(check_karma(), [])
+
+    def test_check_karma_finds_drift_that_rebuild_repairs(self):
+        self.assertEqual(check_karma(), [])
+        KarmaTotal.objects.filter(user=self.author).update(points=1)
+        buckets = KarmaBucket.objects.filter(user=self.commenter)
+        missing = [('bucket', (self.commenter.id, b.hour), 0, b.points) for b in buckets]
+        buckets.delete()
+
+        self.assertEqual(
+            sorted(check_karma()),
+            sorted(missing + [('total', self.author.id, 1, 2 * POST_KARMA)]),
+        )
+        rebuild_karma()
+        self.assertEqual(check_karma(), [])
+
+    def test_unliking_revokes_only_that_likes_karma(self):
+        post, comment = Post.objects.get(), Comment.objects.get()
+        like_post(self.likers[0], post.id)
+        set_likes(self.likers[0], [('comment', comment.id, False)])
+
+        kept = Like.objects.filter(user=self.likers[1])
+        self.assertEqual(
+            sorted(KarmaTransaction.objects.values_list('like_id', 'user__username', 'points')),
+            sorted([
+                (kept.get(post=post).id, 'author', POST_KARMA),
+                (kept.get(comment=comment).id, 'commenter', COMMENT_KARMA),
+            ]),
+        )
+        self.assertEqual(
+            dict(KarmaTotal.objects.values_list('user__username', 'points')),
+            {'author': POST_KARMA, 'commenter': COMMENT_KARMA},
+        )
+        self.assertEqual(check_karma(), [])
+
+    def test_migration_links_karma_to_likes(self):
+        post_likes = list(Like.objects.filter(post__isnull=False).order_by('created_at', 'id'))
+        comment_karma = dict(KarmaTransaction.objects.filter(comment__isnull=False).values_list('id', 'like_id'))
+        # Before the migration unliking deleted every karma row of the
+        # target, so the second post like is left without one
+        KarmaTransaction.objects.filter(like=post_likes[1]).delete()
+        KarmaTransaction.objects.update(like=None)
+        self.add_old_karma(self.author, 7, timedelta(days=3))
+
+        migration = importlib.import_module('core.migrations.0006_karma_like')
+        field = KarmaTransaction._meta.get_field('created_at')
+        with mock.patch.object(field, 'auto_now_add', field.auto_now_add):
+            migration.link_karma_to_likes(django_apps, None)
+            migration.rebuild_karma(django_apps, None)
+
+        self.assertEqual(
+            dict(KarmaTransaction.objects.filter(comment__isnull=False).values_list('id', 'like_id')),
+            comment_karma,
+        )
+        for like in post_likes:
+            karma = KarmaTransaction.objects.get(like=like)
+            self.assertEqual((karma.user, karma.post_id, karma.points), (self.author, like.post_id, POST_KARMA))
+        self.assertEqual(KarmaTransaction.objects.get(like=post_likes[1]).created_at, post_likes[1].created_at)
+        self.assertTrue(KarmaTransaction.objects.filter(like=None, points=7).exists())
+        self.assertEqual(
+            dict(KarmaTotal.objects.values_list('user__username', 'points')),
+            {'author': 2 * POST_KARMA + 7, 'commenter': 2 * COMMENT_KARMA},
+        )
+        self.assertEqual(check_karma(), [])
+
+    def test_buckets_outside_the_window_are_pruned(self):
+        hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+        KarmaBucket.objects.create(user=self.commenter, hour=hour - timedelta(hours=26), points=3)
+        KarmaBucket.objects.create(user=self.commenter, hour=hour - timedelta(days=9), points=4)
+        leaderboard = get_leaderboard_last_24h()
+
+        self.assertEqual(prune_karma_buckets(), 2)
+        self.assertEqual(KarmaBucket.objects.count(), 2)
+        self.assertEqual(get_leaderboard_last_24h(), leaderboard)
+        self.assertEqual(prune_karma_buckets(), 0)
+
+
+class CacheVersionTests(TestCase):
+    def setUp(self):
+        # Runs on-commit callbacks, which cache the masked user's id
+        self.addCleanup(forget_masked_user)
+        cache.clear()
+        self.post = Post.objects.create(author=User.objects.create(username='author'), content='Hi')
+
+    def test_versions_are_bumped_when_the_transaction_commits(self):
+        post_version = get_post_version(self.post.id)
+        feed_version = get_feed_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_post(self.post.id)
+            invalidate_feed()
+            # Until then readers may still refill the cache from old data
+            self.assertEqual(get_post_version(self.post.id), post_version)
+            self.assertEqual(get_feed_version(), feed_version)
+        self.assertEqual(get_post_version(self.post.id), post_version + 1)
+        self.assertEqual(get_feed_version(), feed_version + 1)
+
+    def test_rolled_back_changes_keep_the_versions(self):
+        version = get_post_version(self.post.id)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                invalidate_post(self.post.id)
+                Post.objects.create(author_id=None, content='Invalid')
+        self.assertEqual(callbacks, [])
+        self.assertEqual(get_post_version(self.post.id), version)
+
+    def test_cached_post_detail_is_refreshed_after_a_comment(self):
+        path = f'/api/posts/{self.post.id}/'
+        self.assertEqual(self.client.get(path).json()['comments'], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/api/comments/', {'post': self.post.id, 'content': 'New'},
+                content_type='application/json',
+            )
+        self.assertEqual([c['content'] for c in self.client.get(path).json()['comments']], ['New'])
+
+
+class MaskedUserTests(TestCase):
+    def setUp(self):
+        # Runs on-commit callbacks, which cache the masked user's id
+        self.addCleanup(forget_masked_user)
+        author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=author, content='Hello')
+        self.comment = create_comment(author=author, post=self.post, content='Hi')
+
+    def assertNoUserQueries(self, method, path, data=None):
+        user_table = connection.ops.quote_name(User._meta.db_table)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, data, content_type='application/json')
+        self.assertLess(response.status_code, 300, response.content)
+        self.assertEqual(
+            [q['sql'] for q in queries.captured_queries if user_table in q['sql']],
+            [],
+        )
+
+    def test_anonymous_writes_share_one_masked_user(self):
+        self.client.post('/api/posts/', {'content': 'One'}, content_type='application/json')
+        self.client.post('/api/posts/', {'content': 'Two'}, content_type='application/json')
+
+        masked = User.objects.get(username=MASKED_USERNAME)
+        self.assertEqual(Post.objects.filter(author=masked).count(), 2)
+
+    def resolve(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/posts/{self.post.id}/like/')
+
+    def test_write_paths_skip_user_lookup_once_resolved(self):
+        self.resolve()
+
+        self.assertNoUserQueries('post', '/api/posts/', {'content': 'New post'})
+        self.assertNoUserQueries(
+            'post', '/api/comments/', {'post': self.post.id, 'content': 'New comment'}
+        )
+        self.assertNoUserQueries('post', f'/api/posts/{self.post.id}/like/')
+        self.assertNoUserQueries('post', f'/api/comments/{self.comment.id}/like/')
+
+    def test_rolled_back_lookups_are_not_cached(self):
+        with transaction.atomic():
+            self.client.post(f'/api/posts/{self.post.id}/like/')
+            transaction.set_rollback(True)
+        self.assertFalse(User.objects.filter(username=MASKED_USERNAME).exists())
+
+        self.client.post('/api/posts/', {'content': 'New post'}, content_type='application/json')
+        self.assertTrue(Post.objects.filter(author__username=MASKED_USERNAME).exists())
+
+    def test_deleted_user_is_looked_up_again_once_the_id_expires(self):
+        self.resolve()
+        User.objects.filter(username=MASKED_USERNAME).delete()
+
+        expired = time.monotonic() + settings.MASKED_USER_TTL
+        with mock.patch('core.authentication.time.monotonic', return_value=expired):
+            self.client.post('/api/posts/', {'content': 'New post'}, content_type='application/json')
+        self.assertTrue(Post.objects.filter(author__username=MASKED_USERNAME).exists())
+
+    def test_writes_are_attributed_to_the_resolved_user(self):
+        self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.client.post(f'/api/comments/{self.comment.id}/like/')
+        response = self.client.post(
+            '/api/comments/',
+            {'post': self.post.id, 'content': 'Reply'},
+            content_type='application/json',
+        )
+
+        masked = User.objects.get(username=MASKED_USERNAME)
+        self.assertEqual(response.json()['author'], {'id': masked.id, 'username': MASKED_USERNAME})
+        self.assertTrue(masked.likes.filter(post=self.post).exists())
+        self.assertTrue(masked.likes.filter(comment=self.comment).exists())
+        self.assertEqual(Comment.objects.filter(author=masked).count(), 1)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    def test_request_metrics_are_labelled_by_view(self):
+        response = self.client.get('/api/posts/')
+        self.assertIn('db;desc=', response['Server-Timing'])
+
+        body = self.client.get('/api/metrics/').content.decode()
+        self.assertIn('core_request_duration_seconds_count{view="PostListView"} 1', body)
+        self.assertIn('core_db_queries_count{view="PostListView"} 1', body)
+
+    def test_post_detail_rendering_is_timed(self):
+        post = Post.objects.create(author=User.objects.create(username='author'), content='Hello')
+        for path in (f'/api/posts/{post.id}/', f'/api/async/posts/{post.id}/'):
+            self.client.get(path)
+
+        body = self.client.get('/api/metrics/').content.decode()
+        for view in ('PostDetailView', 'AsyncPostDetailView'):
+            # The body is encoded from cached parts, outside DRF's rendering
+            match = re.search(rf'core_serialize_duration_seconds_sum{{view="{view}"}} (\S+)', body)
+            self.assertGreater(float(match[1]), 0, view)
+
+    def test_connection_pool_stats_are_exported(self):
+        pool = mock.Mock()
+        pool.get_stats.return_value = {
+            'pool_size': 5, 'pool_available': 2, 'requests_waiting': 0,
+            'requests_num': 40, 'requests_wait_ms': 1500, 'connections_num': 5,
+        }
+        self.assertNotIn('core_db_pool', self.client.get('/api/metrics/').content.decode())
+        with mock.patch.object(type(connections['default']), 'pool', pool, create=True):
+            body = self.client.get('/api/metrics/').content.decode()
+        self.assertIn('core_db_pool_connections_in_use{database="default"} 3', body)
+        self.assertIn('core_db_pool_checkout_wait_seconds_total{database="default"} 1.5', body)
+        self.assertIn('core_db_pool_connections_lost_total{database="default"} 0', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token_is_required_when_set(self):
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+
+class SeedCommunityTests(TestCase):
+    def test_seeded_data_is_consistent(self):
+        created = seed_community(users=20, posts=30, comments=300, likes=500)
+
+        self.assertEqual(Comment.objects.count(), created['comments'])
+        for comment in Comment.objects.select_related('parent'):
+            parent_path = comment.parent.path if comment.parent else ''
+            self.assertTrue(comment.path.startswith(parent_path))
+            self.assertEqual(comment.depth, comment.parent.depth + 1 if comment.parent else 0)
+        self.assertEqual(repair_like_counts(), 0)
+        self.assertEqual(check_karma(), [])
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=author, content='Hello')
+        root = create_comment(author=author, post=self.post, content='Root')
+        create_comment(author=author, post=self.post, content='Reply', parent=root)
+
+    async def assertSameResponse(self, path):
+        expected = await self.async_client.get(f'/api/{path}')
+        response = await self.async_client.get(f'/api/async/{path}')
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(
+            response.content.replace(b'/api/async/', b'/api/'),
+            expected.content,
+        )
+
+    async def test_async_read_views_match_sync_views(self):
+        await self.assertSameResponse('posts/?page_size=1')
+        await self.assertSameResponse(f'posts/{self.post.id}/')
+        await self.assertSameResponse(f'posts/{self.post.id}/?limit=1&depth=0')
+        await self.assertSameResponse('leaderboard/')
+
+    async def test_async_views_answer_conditional_requests(self):
+        for path in ('posts/', 'posts/?sort=hot', f'posts/{self.post.id}/'):
+            etag = (await self.async_client.get(f'/api/async/{path}'))['ETag']
+            response = await self.async_client.get(f'/api/async/{path}', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+
+    async def test_async_views_stream(self):
+        for path in ('posts/?page_size=1', f'posts/{self.post.id}/'):
+            expected = (await self.async_client.get(f'/api/{path}')).json()
+            separator = '&' if '?' in path else '?'
+            response = await self.async_client.get(f'/api/async/{path}{separator}stream=1')
+            self.assertTrue(response.is_async)
+            streamed = json.loads(b''.join([chunk async for chunk in response.streaming_content]))
+            if streamed.get('next'):
+                streamed['next'] = streamed['next'].replace('/api/async/', '/api/').replace('&stream=1', '')
+            self.assertEqual(streamed, expected)
+
+    async def test_anonymous_etags_match_sync_views(self):
+        masked = await aget_masked_user()
+        etag_funcs = [
+            ('/api/posts/', views.feed_etag, async_views.feed_etag, ()),
+            ('/api/posts/?sort=hot', views.feed_etag, async_views.feed_etag, ()),
+            (f'/api/posts/{self.post.id}/', views.post_detail_etag, async_views.post_detail_etag, (self.post.id,)),
+        ]
+        # The async views answer under /api/async/, so both sides hash one URL
+        for path, sync_etag_func, async_etag_func, args in etag_funcs:
+            etags = []
+            for user in (AnonymousUser(), masked):
+                request = RequestFactory().get(path)
+                request.user = user
+                request.auser = mock.AsyncMock(return_value=user)
+                etags.append(await sync_to_async(sync_etag_func)(request, *args))
+                etags.append(await async_etag_func(request, *args))
+            # Anonymous readers get the masked user's liked_by_me flags
+            self.assertEqual(len(set(etags)), 1, path)
+
+    async def test_async_errors_match_sync_views(self):
+        await self.assertSameResponse('posts/999/')
+        await self.assertSameResponse('posts/?cursor=bogus')
+        await self.assertSameResponse(f'posts/{self.post.id}/?depth=99')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        # Runs on-commit callbacks, which cache the masked user's id
+        self.addCleanup(forget_masked_user)
+        author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=author, content='Hello')
+        self.detail = f'/api/posts/{self.post.id}/'
+
+    def assertNotModified(self, path, etag):
+        with self.assertNumQueries(0):
+            response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def assertModified(self, path, etag):
+        response = self.client.get(path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_unchanged_resources_short_circuit_without_queries(self):
+        for path in ('/api/posts/', self.detail, f'{self.detail}?limit=5&depth=1'):
+            # Also caches the masked user's id, as a committed request would
+            with self.captureOnCommitCallbacks(execute=True):
+                etag = self.client.get(path)['ETag']
+            self.assertNotModified(path, etag)
+
+    def test_likes_and_comments_change_the_etag(self):
+        feed_etag = self.client.get('/api/posts/')['ETag']
+        detail_etag = self.client.get(self.detail)['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'{self.detail}like/')
+        feed_etag = self.assertModified('/api/posts/', feed_etag)
+        detail_etag = self.assertModified(self.detail, detail_etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                '/api/comments/',
+                {'post': self.post.id, 'content': 'Hi'},
+                content_type='application/json',
+            )
+        # The feed shows comment counts too
+        self.assertModified('/api/posts/', feed_etag)
+        self.assertModified(self.detail, detail_etag)
+
+    def test_new_posts_change_the_feed_etag(self):
+        etag = self.client.get('/api/posts/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/posts/', {'content': 'New'}, content_type='application/json')
+        self.assertModified('/api/posts/', etag)
+
+
+class EventBrokerTests(TestCase):
+    def like_event(self, post_id):
+        return events.Event(
+            events.LIKE, {'type': 'post', 'id': post_id, 'post_id': post_id, 'delta': 1}, post_id
+        )
+
+    async def test_events_reach_matching_subscriptions(self):
+        everything = events.subscribe()
+        one_post = events.subscribe(post_id=1)
+        other_post = events.subscribe(post_id=2)
+        self.addCleanup(everything.close)
+        self.addCleanup(one_post.close)
+        self.addCleanup(other_post.close)
+
+        # Publishers run on worker threads, not on the streams' loop
+        await asyncio.to_thread(events.get_broker().publish, self.like_event(1))
+
+        event = await everything.get()
+        self.assertEqual(event.encoded.split(b'\n')[0], b'event: like')
+        self.assertIs(await one_post.get(), event)
+        self.assertFalse(other_post.pending)
+
+    @override_settings(EVENTS_MAX_PENDING=2)
+    async def test_slow_subscribers_are_dropped(self):
+        subscription = events.subscribe()
+        self.addCleanup(subscription.close)
+
+        for _ in range(3):
+            events.get_broker().publish(self.like_event(1))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(events.StreamOverflow):
+            await subscription.get()
+
+    def test_stream_requires_asgi(self):
+        self.assertEqual(self.client.get('/api/events/').status_code, 503)
+
+    def test_broker_failures_do_not_fail_committed_writes(self):
+        post = Post.objects.create(author=User.objects.create(username='author'), content='Hi')
+        self.client.force_login(User.objects.create(username='liker'))
+        broker = mock.Mock(**{'publish.side_effect': ConnectionError})
+        with (
+            mock.patch.object(events, 'get_broker', return_value=broker),
+            self.assertLogs('core.events', 'ERROR'),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            response = self.client.post(f'/api/posts/{post.id}/like/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(broker.publish.called)
+        post.refresh_from_db()
+        self.assertEqual(post.like_count, 1)
+
+
+@override_settings(LIKE_BUFFER_ENABLED=True)
+class LikeBufferTests(TestCase):
+    """
+    Buffered likes are acknowledged before they are written: the tests pin
+    down what a reader sees meanwhile and what survives a failure.
+    """
+
+    def setUp(self):
+        # Post ids repeat across tests, cached details must not
+        cache.clear()
+        # Flushed by hand, no background thread
+        self.buffer = likebuffer.LikeBuffer(flush_interval=0, max_pending=100)
+        patcher = mock.patch.object(likebuffer, '_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=self.author, content='Viral')
+        self.comment = create_comment(author=self.author, post=self.post, content='Hi')
+        self.like_url = f'/api/posts/{self.post.id}/like/'
+
+    def feed_count(self):
+        return self.client.get('/api/posts/').json()['results'][0]['like_count']
+
+    def assertConsistent(self):
+        self.assertFalse(check_karma())
+        self.assertEqual(repair_like_counts(), 0)
+
+    def test_toggles_coalesce_into_one_write(self):
+        for expected in (True, False, True):
+            response = self.client.post(self.like_url)
+            self.assertEqual(response.json(), {'success': expected})
+
+        self.assertFalse(Like.objects.exists())
+        self.assertEqual(self.buffer.flush(), 1)
+
+        self.assertEqual(Like.objects.filter(post=self.post).count(), 1)
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertConsistent()
+
+    def test_reads_include_pending_likes(self):
+        etag = self.client.get('/api/posts/')['ETag']
+        self.client.post(self.like_url)
+        self.client.post(f'/api/comments/{self.comment.id}/like/')
+
+        self.assertEqual(self.feed_count(), 1)
+        self.assertNotEqual(self.client.get('/api/posts/')['ETag'], etag)
+        detail = self.client.get(f'/api/posts/{self.post.id}/').json()
+        self.assertEqual(detail['like_count'], 1)
+        self.assertEqual(detail['comments'][0]['like_count'], 1)
+
+        # Once written, the counts come from the rows alone
+        self.buffer.flush()
+        self.assertFalse(self.buffer.has_pending_changes())
+        self.assertEqual(self.feed_count(), 1)
+
+    def test_liked_by_me_includes_pending_toggles(self):
+        self.client.post(self.like_url)
+        self.assertTrue(self.client.get('/api/posts/').json()['results'][0]['liked_by_me'])
+
+        self.buffer.flush()
+        self.client.post(self.like_url)
+        self.assertFalse(self.client.get('/api/posts/').json()['results'][0]['liked_by_me'])
+
+    def test_unflushed_toggles_are_lost_with_the_process(self):
+        self.client.post(self.like_url)
+        self.buffer.discard()
+
+        self.assertFalse(Like.objects.exists())
+        self.assertEqual(self.feed_count(), 0)
+        self.assertConsistent()
+
+    def test_failed_flush_keeps_toggles_for_the_next(self):
+        self.client.post(self.like_url)
+        with mock.patch.object(likebuffer, 'apply_like_states', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self.assertEqual(self.feed_count(), 1)
+
+        # Toggles made after the failure still start from the stored state
+        self.client.post(self.like_url)
+        self.client.post(self.like_url)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(Like.objects.count(), 1)
+        self.assertConsistent()
+
+    def test_toggles_that_cannot_be_written_do_not_block_the_rest(self):
+        fan, gone = User.objects.bulk_create(User(username=name) for name in ('fan', 'gone'))
+        self.buffer.toggle(fan, 'post', self.post.id)
+        self.buffer.toggle(gone, 'post', self.post.id)
+        self.buffer.toggle(gone, 'comment', self.comment.id)
+
+        # As if ``gone`` was deleted before the flush: their rows fail the
+        # foreign key check
+        def apply_like_states(states):
+            if any(user_id == gone.id for user_id, _, _ in states):
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return services.apply_like_states(states)
+
+        with (
+            mock.patch.object(likebuffer, 'apply_like_states', side_effect=apply_like_states),
+            self.assertLogs('core.likebuffer', 'ERROR'),
+        ):
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(list(Like.objects.values_list('user_id', flat=True)), [fan.id])
+        self.assertFalse(self.buffer.has_pending_changes())
+        self.assertEqual(self.buffer.pending_count(), 0)
+        self.assertEqual(self.feed_count(), 1)
+        self.assertConsistent()
+
+    def test_flush_writes_many_users_in_one_batch(self):
+        users = User.objects.bulk_create(User(username=f'fan-{i}') for i in range(20))
+        for user in users:
+            self.buffer.toggle(user, 'post', self.post.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.buffer.flush(), 20)
+        counter_updates = [q for q in queries.captured_queries if 'like_count' in q['sql']]
+        self.assertEqual(len(counter_updates), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 20)
+        self.assertConsistent()
+
+
+class HotFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.author = User.objects.create(username='author')
+        self.old, self.liked, self.discussed = [
+            Post.objects.create(author=self.author, content=name, hot_score=ranking.initial_hot_score())
+            for name in ('old', 'liked', 'discussed')
+        ]
+        Post.objects.filter(id=self.old.id).update(created_at=timezone.now() - ranking.HOT_HORIZON * 2)
+
+    def hot_feed(self, **headers):
+        return self.client.get('/api/posts/?sort=hot', **headers)
+
+    def test_likes_and_comments_move_posts_up(self):
+        self.client.post(f'/api/posts/{self.liked.id}/like/')
+        for _ in range(2):
+            create_comment(author=self.author, post=self.discussed, content='Hi')
+
+        ids = [post['id'] for post in self.hot_feed().json()['results']]
+        self.assertEqual(ids[:2], [self.discussed.id, self.liked.id])
+
+    def test_decay_recomputes_scores_from_counters(self):
+        self.client.post(f'/api/posts/{self.liked.id}/like/')
+        create_comment(author=self.author, post=self.discussed, content='Hi')
+        Post.objects.update(hot_score=123)
+
+        self.assertEqual(ranking.decay_hot_scores(), 2)
+        scores = dict(Post.objects.values_list('id', 'hot_score'))
+        self.assertEqual(scores[self.old.id], 0)
+        for post, likes, comments in ((self.liked, 1, 0), (self.discussed, 0, 1)):
+            self.assertAlmostEqual(
+                scores[post.id], ranking.hot_score(likes, comments, post.created_at), places=4
+            )
+
+    def test_pages_follow_the_score_order(self):
+        create_comment(author=self.author, post=self.discussed, content='Hi')
+
+        ids = []
+        url = '/api/posts/?sort=hot&page_size=1'
+        while url:
+            page = self.client.get(url).json()
+            ids += [post['id'] for post in page['results']]
+            url = page['next']
+        self.assertEqual(ids, [self.discussed.id, self.liked.id, self.old.id])
+        self.assertEqual(self.client.get('/api/posts/?sort=top').status_code, 400)
+
+    def test_decay_changes_only_the_hot_feed_etag(self):
+        new_etag = self.client.get('/api/posts/')['ETag']
+        hot_etag = self.hot_feed()['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ranking.decay_hot_scores()
+        self.assertEqual(self.client.get('/api/posts/', HTTP_IF_NONE_MATCH=new_etag).status_code, 304)
+        self.assertEqual(self.hot_feed(HTTP_IF_NONE_MATCH=hot_etag).status_code, 200)
+
+
+class CommentSummaryTests(TestCase):
+    def setUp(self):
+        author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=author, content='Hello')
+        root = create_comment(author=author, post=self.post, content='Root')
+        self.reply = create_comment(author=author, post=self.post, content='Reply', parent=root)
+
+    def test_comments_update_the_post_summary(self):
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 2)
+        self.assertEqual(self.post.last_activity_at, self.reply.created_at)
+
+    def test_feed_shows_the_summary_without_touching_comments(self):
+        comment_table = connection.ops.quote_name(Comment._meta.db_table)
+        with CaptureQueriesContext(connection) as queries:
+            post = self.client.get('/api/posts/').json()['results'][0]
+        self.assertEqual(post['comment_count'], 2)
+        self.assertIsNotNone(post['last_activity_at'])
+        self.assertFalse([q for q in queries.captured_queries if comment_table in q['sql']])
+
+    def test_repair_restores_drifted_summaries(self):
+        Post.objects.update(comment_count=0, last_activity_at=self.post.created_at)
+
+        self.assertEqual(repair_comment_summaries(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 2)
+        self.assertEqual(self.post.last_activity_at, self.reply.created_at)
+        self.assertEqual(repair_comment_summaries(), 0)
+
+    def test_new_posts_without_comments_are_consistent(self):
+        post = Post.objects.create(author=self.post.author, content='Quiet')
+        Post.objects.bulk_create([Post(author=self.post.author, content='Bulk')])
+        self.assertEqual(post.last_activity_at, post.created_at)
+        self.assertEqual(repair_comment_summaries(), 0)
+
+
+class StreamingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create(username='author')
+        for i in range(3):
+            Post.objects.create(author=author, content=f'Post {i}')
+        self.post = Post.objects.create(author=author, content='Thread')
+        # Two threads, one of them three levels deep, with a late sibling
+        first = create_comment(author=author, post=self.post, content='First')
+        reply = create_comment(author=author, post=self.post, content='Reply', parent=first)
+        create_comment(author=author, post=self.post, content='Nested', parent=reply)
+        create_comment(author=author, post=self.post, content='Second reply', parent=first)
+        create_comment(author=author, post=self.post, content='Second')
+
+    def assertSameJson(self, path):
+        expected = self.client.get(path).json()
+        separator = '&' if '?' in path else '?'
+        response = self.client.get(f'{path}{separator}stream=1')
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        # Links of streamed pages keep streaming
+        if streamed.get('next'):
+            streamed['next'] = streamed['next'].replace('stream=1&', '').replace('&stream=1', '')
+        self.assertEqual(streamed, expected)
+
+    def test_streamed_responses_match_the_regular_ones(self):
+        for encoder in (streaming.orjson, None):
+            with mock.patch.object(streaming, 'orjson', encoder):
+                self.assertSameJson(f'/api/posts/{self.post.id}/')
+                self.assertSameJson('/api/posts/?page_size=2')
+                self.assertSameJson('/api/posts/?page_size=10')
+
+    def test_missing_post_is_still_a_404(self):
+        self.assertEqual(self.client.get('/api/posts/999/?stream=1').status_code, 404)
+
+    async def test_asgi_servers_get_the_body_chunk_by_chunk(self):
+        path = f'/api/posts/{self.post.id}/'
+        expected = (await self.async_client.get(path)).json()
+        response = await self.async_client.get(f'{path}?stream=1')
+        # A synchronous body would be read whole before it is sent
+        self.assertTrue(response.is_async)
+        self.assertEqual(json.loads(b''.join([chunk async for chunk in response.streaming_content])), expected)
+
+
+class BoundedThreadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=author, content='Thread')
+        self.detail = f'/api/posts/{self.post.id}/'
+
+        def comment(content, parent=None):
+            return create_comment(author=author, post=self.post, content=content, parent=parent)
+
+        # first > first.1 > first.2 > first.3, second > second.1, third
+        self.first = comment('first')
+        self.chain = [self.first]
+        for level in range(1, 4):
+            self.chain.append(comment(f'first.{level}', self.chain[-1]))
+        comment('second.1', comment('second'))
+        comment('third')
+
+    def get(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def outline(self, comments):
+        """(content, replies outline, more_replies link or None) of each comment."""
+        return [
+            (c['content'], self.outline(c['replies']), c['more_replies'])
+            for c in comments
+        ]
+
+    def thread_link(self, comment, depth):
+        return f'http://testserver/api/comments/{comment.id}/thread/?depth={depth}'
+
+    def test_replies_below_the_depth_link_to_their_subtree(self):
+        data = self.get(self.detail, limit=2, depth=1)
+        self.assertEqual(self.outline(data['comments']), [
+            ('first', [('first.1', [], self.thread_link(self.chain[1], 1))], None),
+            ('second', [('second.1', [], None)], None),
+        ])
+
+        data = self.get(self.detail, depth=0)
+        self.assertEqual(self.outline(data['comments']), [
+            ('first', [], self.thread_link(self.first, 0)),
+            ('second', [], self.thread_link(Comment.objects.get(content='second'), 0)),
+            ('third', [], None),
+        ])
+
+    def test_top_level_pages_follow_the_cursor(self):
+        first_page = self.get(self.detail, limit=2, depth=0)
+        self.assertEqual([c['content'] for c in first_page['comments']], ['first', 'second'])
+        second_page = self.client.get(first_page['comments_next']).json()
+        self.assertEqual([c['content'] for c in second_page['comments']], ['third'])
+        self.assertIsNone(second_page['comments_next'])
+        # Each page still carries the post itself
+        self.assertEqual(second_page['id'], self.post.id)
+
+    def test_thread_endpoint_continues_a_truncated_subtree(self):
+        link = self.get(self.detail, depth=1)['comments'][0]['replies'][0]['more_replies']
+        data = self.client.get(link).json()
+        self.assertEqual(self.outline([data]), [
+            ('first.1', [('first.2', [], self.thread_link(self.chain[2], 1))], None),
+        ])
+        data = self.get(f'/api/comments/{self.chain[2].id}/thread/', depth=5)
+        self.assertEqual(self.outline([data]), [('first.2', [('first.3', [], None)], None)])
+
+    def test_invalid_bounds_are_bad_requests(self):
+        for params, field in (
+            ({'depth': 'x'}, 'depth'),
+            ({'depth': -1}, 'depth'),
+            ({'depth': 11}, 'depth'),
+            ({'limit': 'x'}, 'limit'),
+            ({'limit': 0}, 'limit'),
+            ({'limit': 5, 'cursor': 'bogus'}, None),
+        ):
+            response = self.client.get(self.detail, params)
+            if field is None:
+                self.assertEqual(response.status_code, 404)
+            else:
+                self.assertEqual(response.status_code, 400, params)
+                self.assertIn(field, response.json())
+        thread = f'/api/comments/{self.first.id}/thread/'
+        self.assertEqual(self.client.get(thread, {'depth': 99}).status_code, 400)
+        self.assertEqual(self.client.get('/api/comments/999/thread/').status_code, 404)
+
+    async def test_async_view_serves_the_same_bounded_pages(self):
+        for query in ('limit=2&depth=1', 'depth=0', 'limit=x', 'limit=0&depth=1', 'depth=99', 'cursor=bogus'):
+            expected = await self.async_client.get(f'{self.detail}?{query}')
+            response = await self.async_client.get(f'/api/async/posts/{self.post.id}/?{query}')
+            self.assertEqual(response.status_code, expected.status_code, query)
+            self.assertEqual(response.content.replace(b'/api/async/', b'/api/'), expected.content, query)
+
+        # The async view's cursor continues where the sync view's would
+        first_page = (await self.async_client.get(f'/api/async/posts/{self.post.id}/?limit=2&depth=0')).json()
+        second_page = (await self.async_client.get(first_page['comments_next'])).json()
+        self.assertEqual([c['content'] for c in second_page['comments']], ['third'])
+
+
+class DeepThreadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=author, content='Thread')
+        parent = None
+        for i in range(MAX_COMMENT_DEPTH + 1):
+            parent = create_comment(author=author, post=self.post, content=f'Level {i}', parent=parent)
+        # Each level nests a list in a dict, so the nested form of this
+        # thread is deeper than this limit; the request itself fits below it
+        self.limit = MAX_COMMENT_DEPTH + 100
+
+    @contextmanager
+    def recursion_limit(self):
+        original = sys.getrecursionlimit()
+        sys.setrecursionlimit(self.limit)
+        try:
+            yield
+        finally:
+            sys.setrecursionlimit(original)
+
+    def get_body(self, path):
+        with self.recursion_limit():
+            response = self.client.get(path)
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+        self.assertEqual(response.status_code, 200)
+        return body
+
+    def test_threads_deeper_than_the_recursion_limit_are_served(self):
+        nested = CommentTreeSerializer(build_comment_tree(self.post.comments.all())).data
+        with self.recursion_limit(), self.assertRaises(RecursionError):
+            pickle.dumps(nested)
+
+        path = f'/api/posts/{self.post.id}/'
+        # Cache miss, cache hit, streamed and async
+        bodies = {
+            self.get_body(path),
+            self.get_body(path),
+            self.get_body(f'{path}?stream=1'),
+            self.get_body(f'/api/async/posts/{self.post.id}/'),
+        }
+        self.assertEqual(len(bodies), 1)
+        comment = json.loads(bodies.pop())['comments'][0]
+        for i in range(MAX_COMMENT_DEPTH):
+            self.assertEqual(comment['content'], f'Level {i}')
+            comment = comment['replies'][0]
+        self.assertEqual(comment['replies'], [])
+
+
+class CommentDepthTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create(username='author')
+        self.post = Post.objects.create(author=self.author, content='Thread')
+        self.chain = []
+        for i in range(MAX_COMMENT_DEPTH + 1):
+            self.chain.append(create_comment(
+                author=self.author, post=self.post, content=f'Level {i}',
+                parent=self.chain[-1] if self.chain else None,
+            ))
+
+    def test_replies_past_the_maximum_depth_are_rejected(self):
+        with self.assertRaises(ValueError):
+            create_comment(author=self.author, post=self.post, content='Too deep', parent=self.chain[-1])
+        self.client.force_login(self.author)
+        response = self.client.post(
+            '/api/comments/',
+            {'post': self.post.id, 'parent': self.chain[-1].id, 'content': 'Too deep'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('parent', response.json())
+        self.assertEqual(self.post.comments.count(), MAX_COMMENT_DEPTH + 1)
+
+    def test_backfill_moves_over_deep_replies_up(self):
+        # Rows from before paths, two levels deeper than paths can hold
+        for i in range(2):
+            self.chain.append(Comment.objects.create(
+                author=self.author, post=self.post, content=f'Level {len(self.chain)}',
+                parent=self.chain[-1],
+            ))
+        Comment.objects.update(path='', depth=0)
+
+        migration = importlib.import_module('core.migrations.0005_comment_path')
+        migration.backfill_paths(django_apps, None)
+
+        deepest = self.chain[MAX_COMMENT_DEPTH]
+        for comment in self.chain[-3:]:
+            comment.refresh_from_db()
+            self.assertEqual(comment.depth, MAX_COMMENT_DEPTH)
+            self.assertEqual(comment.parent_id, self.chain[MAX_COMMENT_DEPTH - 1].id)
+            self.assertEqual(comment.path, comment_path(deepest.path[:-PATH_SEGMENT_WIDTH], comment.id))
+        for depth, comment in enumerate(self.chain[:MAX_COMMENT_DEPTH]):
+            comment.refresh_from_db()
+            self.assertEqual(comment.depth, depth)
+
+
+class LikedByMeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        author = User.objects.create(username='author')
+        self.reader = User.objects.create(username='reader')
+        self.post = Post.objects.create(author=author, content='Thread')
+        comments = Comment.objects.bulk_create(
+            Comment(author=author, post=self.post, content=f'Comment {i}') for i in range(1000)
+        )
+        for comment in comments:
+            comment.path = comment_path('', comment.id)
+        Comment.objects.bulk_update(comments, ['path'])
+        self.liked = {comments[0].id, comments[500].id, comments[999].id}
+        Like.objects.bulk_create(
+            [Like(user=self.reader, post=self.post)]
+            + [Like(user=self.reader, comment_id=comment_id) for comment_id in self.liked]
+            # Someone else's likes do not count
+            + [Like(user=author, comment=comments[1])]
+        )
+        self.detail = f'/api/posts/{self.post.id}/'
+        self.client.force_login(self.reader)
+
+    def assertOneLikeQuery(self, path):
+        like_table = connection.ops.quote_name(Like._meta.db_table)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+            if response.streaming:
+                data = json.loads(b''.join(response.streaming_content))
+            else:
+                data = response.json()
+        self.assertEqual(
+            len([q for q in queries.captured_queries if like_table in q['sql']]), 1
+        )
+        return data
+
+    def test_thread_flags_come_from_one_query(self):
+        for path in (self.detail, f'{self.detail}?stream=1'):
+            data = self.assertOneLikeQuery(path)
+            self.assertTrue(data['liked_by_me'])
+            self.assertEqual(len(data['comments']), 1000)
+            self.assertEqual(
+                {c['id'] for c in data['comments'] if c['liked_by_me']}, self.liked
+            )
+        # The cached thread still carries the reader's flags
+        self.assertTrue(self.assertOneLikeQuery(self.detail)['liked_by_me'])
+
+    def test_feed_and_bounded_pages_are_flagged(self):
+        for path in ('/api/posts/', '/api/posts/?stream=1'):
+            self.assertTrue(self.assertOneLikeQuery(path)['results'][0]['liked_by_me'])
+        data = self.assertOneLikeQuery(f'{self.detail}?limit=2&depth=0')
+        self.assertEqual([c['liked_by_me'] for c in data['comments']], [True, False])
+
+    def test_flags_follow_the_reader(self):
+        etag = self.client.get(self.detail)['ETag']
+        self.client.logout()
+        response = self.client.get(self.detail, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()['liked_by_me'])
+
+        # Anonymous readers see the likes of the masked user they write as
+        self.client.post(f'{self.detail}like/')
+        self.assertTrue(self.client.get(self.detail).json()['liked_by_me'])
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        author = User.objects.create(username='author')
+        self.best = Post.objects.create(author=author, content='Gardening gardens: the garden in spring')
+        self.other = Post.objects.create(author=author, content='My garden is growing tomatoes')
+        Post.objects.create(author=author, content='Nothing to see here')
+        self.comment = create_comment(author=author, post=self.other, content='Lovely tomatoes!')
+
+    def search(self, **params):
+        response = self.client.get('/api/search/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def ids(self, **params):
+        return [item['id'] for item in self.search(**params)['results']]
+
+    def test_results_are_ranked_and_stemmed(self):
+        self.assertEqual(self.ids(q='garden'), [self.best.id, self.other.id])
+        self.assertEqual(self.ids(q='growing TOMATO'), [self.other.id])
+        self.assertEqual(self.ids(q='tomatoes', type='comment'), [self.comment.id])
+        self.assertEqual(self.search(q='tomatoes', type='comment')['results'][0]['post'], self.other.id)
+        # Query syntax characters are searched as plain words
+        self.assertEqual(self.ids(q='"garden" -spring*'), [self.best.id])
+
+    def test_index_follows_new_and_edited_content(self):
+        self.client.post('/api/posts/', {'content': 'A new garden'}, content_type='application/json')
+        self.assertEqual(len(self.ids(q='garden')), 3)
+
+        Post.objects.filter(id=self.best.id).update(content='Something else')
+        self.best.delete()
+        self.assertEqual(self.ids(q='spring'), [])
+
+    def test_pages_follow_the_cursor(self):
+        first = self.search(q='garden', page_size=1)
+        self.assertEqual([p['id'] for p in first['results']], [self.best.id])
+        second = self.client.get(first['next']).json()
+        self.assertEqual([p['id'] for p in second['results']], [self.other.id])
+        self.assertIsNone(second['next'])
+
+    def test_results_deleted_after_the_search_do_not_end_the_pages(self):
+        # As if the best match was deleted between the search and loading it
+        paginator = SearchCursorPagination()
+        request = Request(RequestFactory().get('/api/search/', {'q': 'garden', 'page_size': 1}))
+        self.assertEqual(paginator.paginate_search(Post.objects.exclude(id=self.best.id), 'garden', request), [])
+        second = self.client.get(paginator.get_next_link()).json()
+        self.assertEqual([p['id'] for p in second['results']], [self.other.id])
+
+    @override_settings(SEARCH_MAX_CANDIDATES=1)
+    def test_only_the_newest_matches_are_ranked(self):
+        self.assertEqual(self.ids(q='garden'), [self.other.id])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/api/search/').status_code, 400)
+        self.assertEqual(self.client.get('/api/search/', {'q': 'x', 'type': 'user'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/search/', {'q': 'x', 'cursor': 'bogus'}).status_code, 404)
+        self.assertEqual(self.search(q='!!!')['results'], [])
+
+
+class KarmaCompactionTests(TestCase):
+    def setUp(self):
+        seed_community(users=20, posts=40, comments=200, likes=600, days=90)
+        self.totals = dict(KarmaTotal.objects.values_list('user_id', 'points'))
+        self.cutoff = timezone.now() - timedelta(days=31)
+
+    def compact(self, **kwargs):
+        return compact_karma(horizon=timedelta(days=30), batch_size=50, **kwargs)
+
+    def stored_totals(self):
+        return dict(KarmaTotal.objects.values_list('user_id', 'points'))
+
+    def test_all_time_totals_survive_compaction(self):
+        ledger = KarmaTransaction.objects.count()
+        archived = []
+        compacted = self.compact(archive=archived.extend)
+
+        self.assertGreater(compacted, 0)
+        self.assertEqual(len(archived), compacted)
+        self.assertEqual(KarmaTransaction.objects.count(), ledger - compacted)
+        self.assertFalse(KarmaTransaction.objects.filter(created_at__lt=self.cutoff).exists())
+        self.assertEqual(check_karma(), [])
+        rebuild_karma()
+        self.assertEqual(self.stored_totals(), self.totals)
+        self.assertEqual(self.compact(), 0)
+
+    def test_unliking_compacted_likes_reverses_their_karma(self):
+        self.compact()
+        old = Like.objects.filter(created_at__lt=self.cutoff)
+        post_like = old.filter(post__isnull=False).select_related('user', 'post').first()
+        comment_like = old.filter(comment__isnull=False).select_related('user', 'comment').first()
+
+        self.assertFalse(like_post(post_like.user, post_like.post_id))
+        set_likes(comment_like.user, [('comment', comment_like.comment_id, False)])
+
+        self.totals[post_like.post.author_id] -= POST_KARMA
+        self.totals[comment_like.comment.author_id] -= COMMENT_KARMA
+        self.assertEqual(self.stored_totals(), self.totals)
+        self.assertEqual(check_karma(), [])
+        # The reversals are dated like the karma they take back
+        self.assertEqual(self.compact(), 2)
+        self.assertEqual(check_karma(), [])
+
+    def test_horizon_must_clear_the_leaderboard_window(self):
+        with self.assertRaises(ValueError):
+            compact_karma(horizon=timedelta(hours=1))
+        # Not taken for "no horizon given"
+        with self.assertRaises(ValueError):
+            compact_karma(horizon=timedelta(0))
+        with self.assertRaises(CommandError):
+            call_command('compact_karma', days=0, stdout=io.StringIO())
+        self.assertEqual(self.stored_totals(), self.totals)
+
+
+@override_settings(REPLICA_DATABASE='replica')
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.post = Post.objects.create(author=User.objects.create(username='author'), content='Hi')
+
+    @staticmethod
+    @read_from_replica
+    def read_database(view, request):
+        return Post.objects.all().db
+
+    def routed_read(self, cookies=None):
+        request = RequestFactory().get('/api/posts/')
+        request.COOKIES.update(cookies or {})
+        return self.read_database(None, request)
+
+    def test_only_reads_in_routed_views_go_to_the_replica(self):
+        self.assertEqual(Post.objects.all().db, 'default')
+        with replica_reads():
+            self.assertEqual(Post.objects.all().db, 'replica')
+            self.assertEqual(Post.objects.select_for_update().db, 'default')
+            # Rows read from the replica are still saved to the primary
+            self.post._state.db = 'replica'
+            self.assertEqual(router.db_for_write(Post, instance=self.post), 'default')
+            # Streamed bodies are read after the view returned
+            parts = streaming.in_context(copy_context(), (Post.objects.all().db for _ in range(1)))
+        self.assertEqual(list(parts), ['replica'])
+        self.assertEqual(self.routed_read(), 'replica')
+
+    def test_writers_read_from_the_primary_for_a_while(self):
+        response = self.client.post(
+            '/api/comments/', {'post': self.post.id, 'content': 'Mine'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 201)
+        cookie = response.cookies[STICKY_COOKIE]
+        self.assertEqual(cookie['max-age'], 10)
+        self.assertEqual(self.routed_read({STICKY_COOKIE: cookie.value}), 'default')
+
+        # Failed writes and reads leave the client where it was
+        response = self.client.post('/api/comments/', {}, content_type='application/json')
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.assertNotIn(STICKY_COOKIE, self.client.get('/api/posts/').cookies)
+
+    @override_settings(REPLICA_DATABASE=None)
+    def test_without_a_replica_everything_stays_on_the_primary(self):
+        response = self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.assertEqual(self.routed_read(), 'default')
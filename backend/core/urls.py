@@ -1,18 +1,41 @@
-from django.urls import path
+from django.urls import include, path
+from core.async_views import (
+    AsyncPostListView,
+    AsyncPostDetailView,
+    AsyncLeaderboardView,
+    EventStreamView,
+)
 from core.views import (
     PostListView,
     PostDetailView,
     CommentCreateView,
+    CommentThreadView,
     LikePostView,
     LikeCommentView,
+    LikeBatchView,
     LeaderboardView,
+    SearchView,
+    MetricsView,
 )
 
+# Async-native read endpoints, for deployments running under ASGI
+async_urlpatterns = [
+    path('posts/', AsyncPostListView.as_view()),
+    path('posts/<int:post_id>/', AsyncPostDetailView.as_view()),
+    path('leaderboard/', AsyncLeaderboardView.as_view()),
+]
+
 urlpatterns = [
     path('posts/', PostListView.as_view()),
     path('posts/<int:post_id>/', PostDetailView.as_view()),
     path('comments/', CommentCreateView.as_view()),
+    path('comments/<int:comment_id>/thread/', CommentThreadView.as_view(), name='comment-thread'),
     path('posts/<int:post_id>/like/', LikePostView.as_view()),
     path('comments/<int:comment_id>/like/', LikeCommentView.as_view()),
+    path('likes/batch/', LikeBatchView.as_view()),
     path('leaderboard/', LeaderboardView.as_view()),
+    path('search/', SearchView.as_view()),
+    path('metrics/', MetricsView.as_view()),
+    path('events/', EventStreamView.as_view()),
+    path('async/', include(async_urlpatterns)),
 ]
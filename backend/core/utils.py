@@ -1,5 +1,27 @@
 from collections import defaultdict
 
+# A comment's materialized path is its chain of ancestor ids, root first and
+# its own id last, each zero-padded to a fixed width. Plain string order is
+# then thread display order and a subtree is one contiguous range.
+PATH_SEGMENT_WIDTH = 10
+# Deeper paths would not fit a PostgreSQL btree index entry
+MAX_COMMENT_DEPTH = 200
+PATH_MAX_LENGTH = PATH_SEGMENT_WIDTH * (MAX_COMMENT_DEPTH + 1)
+
+
+def comment_path(parent_path, comment_id):
+    return f'{parent_path}{comment_id:0{PATH_SEGMENT_WIDTH}d}'
+
+
+def subtree_range(path):
+    """
+    Bounds [lower, upper) of the paths of a comment and all its replies:
+    every descendant path extends ``path``, so it sorts before the path
+    with the comment's own id incremented.
+    """
+    parent_path, own_id = path[:-PATH_SEGMENT_WIDTH], int(path[-PATH_SEGMENT_WIDTH:])
+    return path, comment_path(parent_path, own_id + 1)
+
 
 def build_comment_tree(comments):
     comment_map = defaultdict(list)
@@ -10,7 +32,9 @@ def build_comment_tree(comments):
         comment.replies_list = []
 
     for comment in comments:
-        if comment.parent_id:
+        # Comments whose parent was not loaded (e.g. the root of a subtree)
+        # are treated as top-level
+        if comment.parent_id in comment_by_id:
             comment_map[comment.parent_id].append(comment)
         else:
             comment_map[None].append(comment)
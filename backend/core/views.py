@@ -1,144 +1,420 @@
-from django.db.models import Count
+import hashlib
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 
+from core import events
+from core.authentication import MaskedUserAuthentication, get_masked_user
+from core.caching import (
+    get_feed_version,
+    get_hot_feed_version,
+    get_leaderboard,
+    get_post_detail,
+    get_post_version,
+    invalidate_feed,
+    invalidate_post,
+)
+from core.likebuffer import get_like_buffer, get_liked_targets, mark_liked_by_me, merge_pending_likes
+from core.metrics import render_prometheus
 from core.models import Post, Comment
+from core.pagination import (
+    CommentCursorPagination,
+    FeedCursorPagination,
+    HotFeedCursorPagination,
+    SearchCursorPagination,
+)
+from core.ranking import initial_hot_score
+from core.routing import primary_reads, read_from_replica
 from core.serializers import (
     PostSerializer,
     CommentSerializer,
+    CommentSearchSerializer,
+    CommentTreeSerializer,
     PostCreateSerializer,
     CommentCreateSerializer,
+    LikeBatchSerializer,
 )
 from core.services import (
     like_post,
     like_comment,
-    get_leaderboard_last_24h,
+    set_likes,
+    get_comment_subtrees,
+    get_top_users,
+)
+from core.streaming import (
+    ITERATOR_CHUNK_SIZE,
+    comment_rows,
+    feed_page_parts,
+    json_parts_response,
+    json_stream_response,
+    post_detail_parts,
 )
 from core.utils import build_comment_tree
 
+# Levels of replies loaded below each top-level comment (or subtree root)
+# in depth-limited mode
+DEFAULT_REPLY_DEPTH = 3
+MAX_REPLY_DEPTH = 10
+
+
+def get_reply_depth(request):
+    try:
+        depth = int(request.query_params.get('depth', DEFAULT_REPLY_DEPTH))
+    except ValueError:
+        raise ValidationError({'depth': 'A valid integer is required.'})
+    if not 0 <= depth <= MAX_REPLY_DEPTH:
+        raise ValidationError({'depth': f'Must be between 0 and {MAX_REPLY_DEPTH}.'})
+    return depth
+
+
+FEED_PAGINATION = {
+    'new': FeedCursorPagination,
+    'hot': HotFeedCursorPagination,
+}
+
+
+def get_feed_sort(request):
+    sort = request.query_params.get('sort', 'new')
+    if sort not in FEED_PAGINATION:
+        raise ValidationError({'sort': f'Must be one of: {", ".join(FEED_PAGINATION)}.'})
+    return sort
+
+
+SEARCH_TYPES = {
+    'post': (Post, PostSerializer),
+    'comment': (Comment, CommentSearchSerializer),
+}
+
+
+def get_search_type(request):
+    search_type = request.query_params.get('type', 'post')
+    if search_type not in SEARCH_TYPES:
+        raise ValidationError({'type': f'Must be one of: {", ".join(SEARCH_TYPES)}.'})
+    return search_type
+
+
+def wants_stream(request):
+    return request.query_params.get('stream') == '1'
+
+
+def get_more_replies_links(request, truncated, depth):
+    """Links to the subtrees of comments whose replies were cut off."""
+    return {
+        comment_id: replace_query_param(
+            request.build_absolute_uri(reverse('comment-thread', args=[comment_id])),
+            'depth',
+            depth,
+        )
+        for comment_id in truncated
+    }
+
+
+def serialize_comment_subtrees(request, roots, depth):
+    """
+    Serialize the given comments with up to ``depth`` levels of replies;
+    comments whose replies were cut off link to their own subtree.
+    """
+    comments, truncated = get_comment_subtrees(roots, depth)
+    more_replies = get_more_replies_links(request, truncated, depth)
+    return CommentTreeSerializer(build_comment_tree(comments), more_replies).data
+
+
+def make_etag(version, request, user):
+    """
+    ETag of a response built from data at ``version``, for the requesting
+    ``user`` (whose liked_by_me flags it carries). The absolute URL and Accept
+    header are mixed in because pagination links embed the former and
+    content negotiation depends on the latter.
+    """
+    if settings.LIKE_BUFFER_ENABLED:
+        # Buffered likes change the counts without bumping any version
+        version = f'{version}:{get_like_buffer().revision}'
+    key = (
+        f'{version}:{user.pk}:{request.build_absolute_uri()}:'
+        f'{request.headers.get("Accept", "")}'
+    )
+    return hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()
+
+
+def get_request_user(request):
+    """
+    The user MaskedUserMixin authenticates ``request`` as. ETags are computed
+    before DRF authenticates the request, so they resolve the user here.
+    """
+    # Inactive and anonymous users are turned away by SessionAuthentication
+    if request.user.is_active:
+        return request.user
+    return get_masked_user()
+
+
+def feed_etag(request):
+    if request.GET.get('sort') == 'hot':
+        return make_etag(get_hot_feed_version(), request, get_request_user(request))
+    return make_etag(get_feed_version(), request, get_request_user(request))
+
+
+def post_detail_etag(request, post_id):
+    return make_etag(get_post_version(post_id), request, get_request_user(request))
 
-class PostListView(APIView):
+
+class MaskedUserMixin:
+    """
+    Attributes writes from anonymous clients to the shared masked user, and
+    resolves reads' liked_by_me flags for the same user.
+    """
+    authentication_classes = [SessionAuthentication, MaskedUserAuthentication]
+
+
+class PostListView(MaskedUserMixin, APIView):
+    """
+    The feed, newest first or, with ``sort=hot``, by hot score; ``stream=1``
+    streams the page (see core.streaming).
+    """
     permission_classes = [AllowAny]
 
+    # Polling clients get a 304 from the cached feed version alone,
+    # before any query runs
+    @method_decorator(condition(etag_func=feed_etag))
+    @read_from_replica
     def get(self, request):
-        posts = (
-            Post.objects
-            .annotate(like_count=Count('likes'))
-            .select_related('author')
-            .order_by('-created_at')
-        )
-        serializer = PostSerializer(posts, many=True)
-        return Response(serializer.data)
+        posts = Post.objects.select_related('author')
+
+        paginator = FEED_PAGINATION[get_feed_sort(request)]()
+        if wants_stream(request):
+            page_queryset = paginator.get_page_queryset(posts, request)
+            liked = get_liked_targets(request.user, post_ids=page_queryset.values('id'))
+            return json_stream_response(request, feed_page_parts(paginator, page_queryset, liked))
+        page = paginator.paginate_queryset(posts, request, view=self)
+        serializer = PostSerializer(page, many=True)
+        data = mark_liked_by_me(merge_pending_likes(serializer.data), request.user)
+        return paginator.get_paginated_response(data)
 
     def post(self, request):
-        if not request.user.is_authenticated:
-            from django.contrib.auth.models import User
-            request.user, created = User.objects.get_or_create(
-                username='masked-username',
-                defaults={'email': 'masked@example.com'}
-            )
         serializer = PostCreateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        post = serializer.save(author=request.user)
+        post = serializer.save(author=request.user, hot_score=initial_hot_score())
+        invalidate_feed()
+        # A client may hold the ETag of a 404 for this id
+        invalidate_post(post.id)
 
-        return Response(
-            PostSerializer(post).data,
-            status=status.HTTP_201_CREATED
-        )
+        data = PostSerializer(post).data
+        events.publish(events.POST_CREATED, data, post_id=post.id)
+        return Response(data, status=status.HTTP_201_CREATED)
 
 
-class PostDetailView(APIView):
+class PostDetailView(MaskedUserMixin, APIView):
+    """
+    A post with its full comment tree, or, when any of ``limit``, ``depth``
+    or ``cursor`` is given, with one page of top-level comments and a
+    bounded number of reply levels below them. ``stream=1`` streams the
+    full tree, bypassing the cache. The full tree is encoded from flat
+    rows either way (see core.streaming), so threads of any depth render.
+    """
     permission_classes = [AllowAny]
+    pagination_class = CommentCursorPagination
+    bounded_params = {'limit', 'depth', 'cursor'}
 
+    @method_decorator(condition(etag_func=post_detail_etag))
+    @read_from_replica
     def get(self, request, post_id):
-        post = (
-            Post.objects
-            .select_related('author')
-            .annotate(like_count=Count('likes'))
-            .get(id=post_id)
+        if self.bounded_params & request.query_params.keys():
+            data = self.serialize_bounded(request, post_id)
+            return Response(mark_liked_by_me(merge_pending_likes(data), request.user))
+
+        liked = get_liked_targets(
+            request.user,
+            post_ids=[post_id],
+            comment_ids=Comment.objects.filter(post_id=post_id).values('id'),
+        )
+        if wants_stream(request):
+            post = get_object_or_404(Post.objects.select_related('author'), id=post_id)
+            rows = comment_rows(self.get_comments(post).iterator(chunk_size=ITERATOR_CHUNK_SIZE))
+            return json_stream_response(request, post_detail_parts(PostSerializer(post).data, rows, liked))
+        post_data, rows = get_post_detail(post_id, lambda: self.serialize(post_id))
+        return json_parts_response(request, post_detail_parts(post_data, rows, liked))
+
+    def serialize_bounded(self, request, post_id):
+        post = get_object_or_404(Post.objects.select_related('author'), id=post_id)
+        depth = get_reply_depth(request)
+
+        paginator = self.pagination_class()
+        roots = paginator.paginate_queryset(
+            Comment.objects.filter(post=post, depth=0).only('id', 'post', 'path', 'depth'),
+            request,
+            view=self,
         )
 
-        comments = (
+        post_data = PostSerializer(post).data
+        post_data['comments'] = serialize_comment_subtrees(request, roots, depth)
+        post_data['comments_next'] = paginator.get_next_link()
+        return post_data
+
+    def get_comments(self, post):
+        """The whole thread in display (path) order."""
+        return (
             Comment.objects
             .filter(post=post)
             .select_related('author')
-            .annotate(like_count=Count('likes'))
-            .order_by('created_at')
+            .order_by('path')
         )
 
-        comment_tree = build_comment_tree(comments)
-        comments_data = CommentSerializer(comment_tree, many=True).data
+    def serialize(self, post_id):
+        """
+        The post's data and the flat comment_rows of its thread, for the
+        cache; nesting them would make deep threads too deep to pickle.
+        """
+        # Fills the shared cache, which a lagging replica must not stale
+        with primary_reads():
+            post = get_object_or_404(Post.objects.select_related('author'), id=post_id)
+            return PostSerializer(post).data, list(comment_rows(self.get_comments(post)))
 
-        post_data = PostSerializer(post).data
-        post_data['comments'] = comments_data
 
-        return Response(post_data)
+class CommentThreadView(MaskedUserMixin, APIView):
+    """A single comment with up to ``depth`` levels of its replies."""
+    permission_classes = [AllowAny]
 
+    def get(self, request, comment_id):
+        comment = get_object_or_404(
+            Comment.objects.only('id', 'post', 'path', 'depth'), id=comment_id
+        )
+        depth = get_reply_depth(request)
+        data = merge_pending_likes(serialize_comment_subtrees(request, [comment], depth)[0])
+        return Response(mark_liked_by_me(data, request.user))
 
-class CommentCreateView(APIView):
+
+class CommentCreateView(MaskedUserMixin, APIView):
     permission_classes = [AllowAny]
 
     def post(self, request):
-        if not request.user.is_authenticated:
-            from django.contrib.auth.models import User
-            request.user, created = User.objects.get_or_create(
-                username='masked-username',
-                defaults={'email': 'masked@example.com'}
-            )
         serializer = CommentCreateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
         comment = serializer.save(author=request.user)
+        invalidate_post(comment.post_id)
 
-        return Response(
-            CommentSerializer(comment).data,
-            status=status.HTTP_201_CREATED
+        data = CommentSerializer(comment).data
+        events.publish(
+            events.COMMENT_CREATED,
+            {'post_id': comment.post_id, 'parent_id': comment.parent_id, 'comment': data},
+            post_id=comment.post_id,
         )
+        return Response(data, status=status.HTTP_201_CREATED)
 
 
-class LikePostView(APIView):
+class LikePostView(MaskedUserMixin, APIView):
     permission_classes = [AllowAny]
 
     def post(self, request, post_id):
-        if not request.user.is_authenticated:
-            from django.contrib.auth.models import User
-            request.user, created = User.objects.get_or_create(
-                username='masked-username',
-                defaults={'email': 'masked@example.com'}
-            )
-        success = like_post(request.user, post_id)
+        if settings.LIKE_BUFFER_ENABLED:
+            success = get_like_buffer().toggle(request.user, 'post', post_id)
+        else:
+            success = like_post(request.user, post_id)
         return Response(
             {"success": success},
             status=status.HTTP_200_OK
         )
 
 
-class LikeCommentView(APIView):
+class LikeCommentView(MaskedUserMixin, APIView):
     permission_classes = [AllowAny]
 
     def post(self, request, comment_id):
-        if not request.user.is_authenticated:
-            from django.contrib.auth.models import User
-            request.user, created = User.objects.get_or_create(
-                username='masked-username',
-                defaults={'email': 'masked@example.com'}
-            )
-        success = like_comment(request.user, comment_id)
+        if settings.LIKE_BUFFER_ENABLED:
+            success = get_like_buffer().toggle(request.user, 'comment', comment_id)
+        else:
+            success = like_comment(request.user, comment_id)
         return Response(
             {"success": success},
             status=status.HTTP_200_OK
         )
 
 
+class LikeBatchView(MaskedUserMixin, APIView):
+    """
+    Applies a list of desired like states (e.g. replayed by an offline
+    client) in one transaction and reports the outcome for each item.
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        serializer = LikeBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data['items']
+
+        try:
+            outcomes = set_likes(
+                request.user,
+                [(item['type'], item['id'], item['liked']) for item in items],
+            )
+        except IntegrityError:
+            # A concurrent request from the same user changed one of the likes
+            return Response(
+                {"detail": "Likes changed concurrently, retry the batch."},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        # Repeated targets report the state of their last entry, which wins
+        final = {(item['type'], item['id']): item['liked'] for item in items}
+        results = []
+        for item in items:
+            key = item['type'], item['id']
+            results.append({
+                'type': item['type'],
+                'id': item['id'],
+                'result': outcomes[key],
+                'liked': None if outcomes[key] == 'not_found' else final[key],
+            })
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+
+class SearchView(MaskedUserMixin, APIView):
+    """
+    Posts, or with ``type=comment`` comments, containing every word of
+    ``q``, best match first (see core.search).
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'This field is required.'})
+        model, serializer_class = SEARCH_TYPES[get_search_type(request)]
+
+        paginator = SearchCursorPagination()
+        page = paginator.paginate_search(model.objects.select_related('author'), query, request)
+        data = merge_pending_likes(serializer_class(page, many=True).data)
+        return paginator.get_paginated_response(mark_liked_by_me(data, request.user))
+
+
 class LeaderboardView(APIView):
+    @read_from_replica
     def get(self, request):
-        # Temporarily show all time leaderboard for testing
-        data = get_leaderboard_last_24h()
-        if not data:
-            # If no data in last 24h, show all time
-            from core.services import get_leaderboard_all_time
-            data = get_leaderboard_all_time()
-        return Response(data)
+        return Response(get_leaderboard(get_top_users))
+
+
+class MetricsView(APIView):
+    """Request metrics of this process in the Prometheus text format."""
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(
+            render_prometheus(),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
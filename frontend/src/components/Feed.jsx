@@ -1,4 +1,5 @@
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
+import { isLive, subscribe } from "../liveEvents";
 
 // This line allows the app to use the Vercel variable or fallback to local for dev
 const API_BASE_URL = import.meta.env.VITE_API_URL || "http://127.0.0.1:8000";
@@ -10,26 +11,67 @@ export default function Feed({ onLike }) {
   const [commentForms, setCommentForms] = useState({});
   const [replyForms, setReplyForms] = useState({});
   const [replyContent, setReplyContent] = useState({});
-  const [likedPosts, setLikedPosts] = useState(new Set());
+  const [nextPage, setNextPage] = useState(null);
 
-  const fetchPosts = () => {
+  const fetchPosts = (url = `${API_BASE_URL}/api/posts/`) => {
     // UPDATED: URL now uses the dynamic base
-    fetch(`${API_BASE_URL}/api/posts/`, {
+    fetch(url, {
       credentials: "include",
     })
       .then((res) => res.json())
       .then((data) => {
         console.log("posts:", data);
-        setPosts(data);
+        // Follow-up pages (cursor links) are appended to the current feed
+        setPosts((prev) => (url === nextPage ? [...prev, ...data.results] : data.results));
+        setNextPage(data.next);
       })
       .catch((err) => {
         console.error("fetch failed", err);
         setPosts([]);
+        setNextPage(null);
       });
   };
 
+  // Read by the event listener, which is registered once
+  const commentsRef = useRef(comments);
+  commentsRef.current = comments;
+
+  const fetchComments = (postId) => {
+    fetch(`${API_BASE_URL}/api/posts/${postId}/`, {
+      credentials: "include",
+    })
+      .then((res) => res.json())
+      .then((data) => {
+        setComments((prev) => ({ ...prev, [postId]: data.comments }));
+      })
+      .catch((err) => console.error("Fetch comments failed", err));
+  };
+
+  const handleEvent = (type, data) => {
+    if (type === "post_created") {
+      setPosts((prev) => (prev.some((p) => p.id === data.id) ? prev : [data, ...prev]));
+    } else if (type === "comment_created") {
+      setPosts((prev) =>
+        prev.map((p) => (p.id === data.post_id ? { ...p, comment_count: p.comment_count + 1 } : p))
+      );
+      // Reload open threads so the reply lands under its parent
+      if (commentsRef.current[data.post_id]) fetchComments(data.post_id);
+    } else if (type === "like" && data.type === "post") {
+      setPosts((prev) =>
+        prev.map((p) => (p.id === data.id ? { ...p, like_count: p.like_count + data.delta } : p))
+      );
+    } else if (type === "like" && data.type === "comment") {
+      setComments((prev) =>
+        prev[data.post_id]
+          ? { ...prev, [data.post_id]: updateCommentLikeCount(prev[data.post_id], data.id, data.delta) }
+          : prev
+      );
+    }
+  };
+
   useEffect(() => {
     fetchPosts();
+    return subscribe(handleEvent);
   }, []);
 
 function Comment({ comment, level, onReply, onLike, postId, replyForms, setReplyForms, replyContent, setReplyContent }) {
@@ -44,7 +86,7 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
           className="text-red-500 hover:text-red-600 transition-colors flex items-center space-x-1 text-sm"
           onClick={() => onLike(comment.id, postId)}
         >
-          <span>❤️</span>
+          <span>{comment.liked_by_me ? '❤️' : '🤍'}</span>
           <span>{comment.like_count || 0}</span>
         </button>
         <button
@@ -108,21 +150,13 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
       .then((res) => res.json())
       .then((data) => {
         setPosts((prev) =>
-          prev.map((p) =>
-            p.id === postId
-              ? { ...p, like_count: data.success ? p.like_count + 1 : p.like_count - 1 }
-              : p
-          )
+          prev.map((p) => {
+            if (p.id !== postId) return p;
+            // With the live stream open, the count arrives as an event
+            const like_count = isLive() ? p.like_count : p.like_count + (data.success ? 1 : -1);
+            return { ...p, like_count, liked_by_me: data.success };
+          })
         );
-        setLikedPosts((prev) => {
-          const newSet = new Set(prev);
-          if (data.success) {
-            newSet.add(postId);
-          } else {
-            newSet.delete(postId);
-          }
-          return newSet;
-        });
         if (onLike) onLike();
       })
       .catch((err) => {
@@ -143,7 +177,7 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
     })
       .then((res) => res.json())
       .then((data) => {
-        setPosts((prev) => [data, ...prev]);
+        setPosts((prev) => (prev.some((p) => p.id === data.id) ? prev : [data, ...prev]));
         setNewPostContent("");
       })
       .catch((err) => console.error("Create post failed", err));
@@ -154,15 +188,13 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
       setComments((prev) => ({ ...prev, [postId]: null }));
       return;
     }
-    // UPDATED URL
-    fetch(`${API_BASE_URL}/api/posts/${postId}/`, {
-      credentials: "include",
-    })
-      .then((res) => res.json())
-      .then((data) => {
-        setComments((prev) => ({ ...prev, [postId]: data.comments }));
-      })
-      .catch((err) => console.error("Fetch comments failed", err));
+    fetchComments(postId);
+  };
+
+  const countComment = (postId) => {
+    setPosts((prev) =>
+      prev.map((p) => (p.id === postId ? { ...p, comment_count: p.comment_count + 1 } : p))
+    );
   };
 
   const handleCreateComment = (postId, content) => {
@@ -177,10 +209,16 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
     })
       .then((res) => res.json())
       .then((data) => {
-        setComments((prev) => ({
-          ...prev,
-          [postId]: [...(prev[postId] || []), data],
-        }));
+        if (!isLive()) {
+          countComment(postId);
+          setComments((prev) => ({
+            ...prev,
+            [postId]: [...(prev[postId] || []), data],
+          }));
+        } else if (!commentsRef.current[postId]) {
+          // Open threads reload on the event; open this one to show it
+          fetchComments(postId);
+        }
         setCommentForms((prev) => ({ ...prev, [postId]: false }));
       })
       .catch((err) => console.error("Create comment failed", err));
@@ -198,28 +236,34 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
     })
       .then((res) => res.json())
       .then((data) => {
-        setComments((prev) => ({
-          ...prev,
-          [postId]: [...(prev[postId] || []), data],
-        }));
+        if (!isLive()) {
+          countComment(postId);
+          setComments((prev) => ({
+            ...prev,
+            [postId]: [...(prev[postId] || []), data],
+          }));
+        }
         setReplyForms((prev) => ({ ...prev, [commentId]: false }));
         setReplyContent((prev) => ({ ...prev, [commentId]: "" }));
       })
       .catch((err) => console.error("Reply failed", err));
   };
 
-  const updateCommentLikeCount = (comments, commentId, increment) => {
+  const updateComment = (comments, commentId, update) => {
     return comments.map((c) => {
       if (c.id === commentId) {
-        return { ...c, like_count: (c.like_count || 0) + increment };
+        return { ...c, ...update(c) };
       }
       if (c.replies && c.replies.length > 0) {
-        return { ...c, replies: updateCommentLikeCount(c.replies, commentId, increment) };
+        return { ...c, replies: updateComment(c.replies, commentId, update) };
       }
       return c;
     });
   };
 
+  const updateCommentLikeCount = (comments, commentId, increment) =>
+    updateComment(comments, commentId, (c) => ({ like_count: (c.like_count || 0) + increment }));
+
   const handleLikeComment = (commentId, postId) => {
     // UPDATED URL
     fetch(`${API_BASE_URL}/api/comments/${commentId}/like/`, {
@@ -231,7 +275,11 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
         const increment = data.success ? 1 : -1;
         setComments((prev) => ({
           ...prev,
-          [postId]: updateCommentLikeCount(prev[postId], commentId, increment),
+          [postId]: updateComment(prev[postId], commentId, (c) => ({
+            // With the live stream open, the count arrives as an event
+            like_count: isLive() ? c.like_count : (c.like_count || 0) + increment,
+            liked_by_me: data.success,
+          })),
         }));
         if (onLike) onLike();
       })
@@ -276,7 +324,7 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
               className="text-red-500 hover:text-red-600 transition-colors flex items-center space-x-1"
               onClick={() => handleLike(post.id)}
             >
-              <span>{likedPosts.has(post.id) ? '❤️' : '🤍'}</span>
+              <span>{post.liked_by_me ? '❤️' : '🤍'}</span>
               <span>{post.like_count}</span>
             </button>
             <button
@@ -287,6 +335,15 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
             >
               Comment
             </button>
+            {post.comment_count > 0 && (
+              <button
+                className="text-gray-600 hover:text-gray-800 transition-colors"
+                onClick={() => handleShowComments(post.id)}
+              >
+                {comments[post.id] ? "Hide" : "Show"} {post.comment_count}{" "}
+                {post.comment_count === 1 ? "comment" : "comments"}
+              </button>
+            )}
           </div>
 
           {commentForms[post.id] && (
@@ -333,6 +390,15 @@ function Comment({ comment, level, onReply, onLike, postId, replyForms, setReply
           )}
         </div>
       ))}
+
+      {nextPage && (
+        <button
+          className="w-full py-2 text-gray-600 hover:text-gray-800 transition-colors"
+          onClick={() => fetchPosts(nextPage)}
+        >
+          Load more
+        </button>
+      )}
     </div>
   );
 }
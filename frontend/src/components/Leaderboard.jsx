@@ -1,4 +1,5 @@
 import { useEffect, useState, forwardRef, useImperativeHandle } from "react";
+import { isLive, subscribe } from "../liveEvents";
 
 const API_BASE_URL = import.meta.env.VITE_API_URL || "http://127.0.0.1:8000";
 
@@ -18,10 +19,19 @@ const Leaderboard = forwardRef((props, ref) => {
   }));
 
   useEffect(() => {
-    fetchLeaders(); 
-    const interval = setInterval(fetchLeaders, 5000); 
-
-    return () => clearInterval(interval); 
+    fetchLeaders();
+    const unsubscribe = subscribe((type, data) => {
+      if (type === "leaderboard") setLeaders(data);
+    });
+    // Poll only while the live stream is unavailable
+    const interval = setInterval(() => {
+      if (!isLive()) fetchLeaders();
+    }, 5000);
+
+    return () => {
+      clearInterval(interval);
+      unsubscribe();
+    };
   }, []);
 
   return (
@@ -0,0 +1,45 @@
+const API_BASE_URL = import.meta.env.VITE_API_URL || "http://127.0.0.1:8000";
+
+const EVENT_TYPES = ["post_created", "comment_created", "like", "leaderboard"];
+
+// One stream shared by every component that listens
+let source = null;
+let live = false;
+const listeners = new Set();
+
+function connect() {
+  if (source || typeof EventSource === "undefined") return;
+
+  source = new EventSource(`${API_BASE_URL}/api/events/`, { withCredentials: true });
+  source.onopen = () => {
+    live = true;
+  };
+  source.onerror = () => {
+    // The browser reconnects by itself unless the server refused the
+    // stream (e.g. a WSGI deployment); callers fall back to polling
+    live = false;
+  };
+  for (const type of EVENT_TYPES) {
+    source.addEventListener(type, (e) => {
+      const data = JSON.parse(e.data);
+      listeners.forEach((listener) => listener(type, data));
+    });
+  }
+}
+
+export function subscribe(listener) {
+  listeners.add(listener);
+  connect();
+  return () => {
+    listeners.delete(listener);
+    if (listeners.size === 0 && source) {
+      source.close();
+      source = null;
+      live = false;
+    }
+  };
+}
+
+// True while the stream is open: counts then arrive as events, so
+// components should not also update them optimistically
+export const isLive = () => live;